@@ -0,0 +1,5 @@
+from ftp import create_app
+from ftp.streaming import StreamingApp
+
+# For ASGI servers, e.g. `uvicorn asgi:app`
+app = StreamingApp(create_app())
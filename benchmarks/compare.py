@@ -0,0 +1,73 @@
+# benchmarks/compare.py
+# Compare two benchmarks.load result files, e.g. before and after a change.
+#
+#   python -m benchmarks.compare BASELINE.json CANDIDATE.json [--threshold 10]
+#
+# Prints the change in throughput and p50/p99 latency per scenario and
+# exits with status 1 if any scenario got worse by more than the threshold
+# (in percent), so it can gate a CI job.
+
+import argparse
+import json
+import sys
+
+# metric -> True when bigger is better
+METRICS = {
+    "requests_per_second": True,
+    "p50_ms": False,
+    "p99_ms": False,
+}
+
+
+def change(before, after):
+    if not before:
+        return 0.0
+    return (after - before) / before * 100
+
+
+def compare(baseline, candidate, threshold):
+    rows = []
+    regressed = False
+    for scenario, old in baseline["results"].items():
+        new = candidate["results"].get(scenario)
+        if new is None:
+            continue
+        for metric, higher_is_better in METRICS.items():
+            delta = change(old[metric], new[metric])
+            worse = -delta if higher_is_better else delta
+            flag = "REGRESSION" if worse > threshold else ""
+            regressed |= bool(flag)
+            rows.append((scenario, metric, old[metric], new[metric], f"{delta:+.1f}%", flag))
+        if new["errors"] > old["errors"]:
+            regressed = True
+            rows.append((scenario, "errors", old["errors"], new["errors"], "", "REGRESSION"))
+    return rows, regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files.")
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--threshold", type=float, default=10.0, help="allowed slowdown in percent")
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+
+    for key in ("shape", "scale", "profile", "concurrency"):
+        if baseline["meta"].get(key) != candidate["meta"].get(key):
+            print(f"warning: runs differ in {key}: {baseline['meta'].get(key)} vs {candidate['meta'].get(key)}")
+
+    print(f"baseline  {baseline['meta']['commit']}  {baseline['meta']['timestamp']}")
+    print(f"candidate {candidate['meta']['commit']}  {candidate['meta']['timestamp']}")
+    rows, regressed = compare(baseline, candidate, args.threshold)
+    widths = [max(len(str(row[i])) for row in rows) for i in range(6)] if rows else []
+    for row in rows:
+        print("  ".join(str(value).ljust(width) for value, width in zip(row, widths)).rstrip())
+    sys.exit(1 if regressed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+# benchmarks/fake_go.py
+# Local stand-in for microservices/main.go, so benchmarks need no Go
+# toolchain. It serves /raw/<path> from a base directory with the same
+# behaviour the proxy relies on: Content-Type, Content-Length, the same
+# ETag as the real service (with If-None-Match), single Range requests and
+# 404 for missing files.
+
+import mimetypes
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+from ftp import caching
+
+RANGE_RE = re.compile(r"bytes=(\d*)-(\d*)$")
+
+
+class FakeGoServer:
+    def __init__(self, base_path, host="127.0.0.1", port=0):
+        handler = type("Handler", (_RawHandler,), {"base_path": os.path.abspath(base_path)})
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="fake-go", daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class _RawHandler(BaseHTTPRequestHandler):
+    base_path = None
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if not self.path.startswith("/raw/"):
+            self._empty(200)
+            return
+
+        rel = unquote(self.path[len("/raw/"):].split("?", 1)[0])
+        full_path = os.path.abspath(os.path.join(self.base_path, rel))
+        if os.path.commonpath([self.base_path, full_path]) != self.base_path or not os.path.isfile(full_path):
+            self._empty(404)
+            return
+
+        st = os.stat(full_path)
+        size = st.st_size
+        etag = f'"{caching.file_etag(st)}"'
+        if etag in self.headers.get("If-None-Match", ""):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        start, length, status = 0, size, 200
+        match = RANGE_RE.match(self.headers.get("Range", ""))
+        if self.headers.get("If-Range", etag) != etag:
+            match = None   # the client's copy is stale: send the whole file
+        if match and (match.group(1) or match.group(2)):
+            if match.group(1):
+                start = int(match.group(1))
+                end = int(match.group(2)) if match.group(2) else size - 1
+            else:
+                start = max(0, size - int(match.group(2)))
+                end = size - 1
+            end = min(end, size - 1)
+            if start > end:
+                self._empty(416)
+                return
+            length, status = end - start + 1, 206
+
+        mime_type, _ = mimetypes.guess_type(full_path)
+        self.send_response(status)
+        self.send_header("Content-Type", mime_type or "application/octet-stream")
+        self.send_header("Content-Length", str(length))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{start + length - 1}/{size}")
+        self.end_headers()
+        with open(full_path, "rb") as f:
+            self.wfile.flush()
+            try:
+                self.connection.sendfile(f, start, length)
+            except (BrokenPipeError, ConnectionResetError):
+                self.close_connection = True   # the proxy stopped reading
+
+    def _empty(self, status):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
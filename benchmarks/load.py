@@ -0,0 +1,302 @@
+# benchmarks/load.py
+# End-to-end load test of the real server over real sockets.
+#
+#   python -m benchmarks.load [--shape wide] [--scale 1.0] [--profile threaded]
+#                             [--concurrency 16] [--requests 300]
+#                             [--scenarios listing view ...] [--output FILE]
+#
+# A synthetic tree (see trees.py) is generated in a temporary directory,
+# one or more (--backends) fake Go services (fake_go.py) serve it, and
+# start.py is launched against them with the chosen SERVER_PROFILE, exactly
+# as in production.
+# Each scenario is then driven by a pool of keep-alive clients. For each
+# scenario the results record throughput, p50/p99 latency (full body read)
+# and bytes on the wire, of the requests that succeeded; failed ones (a
+# refused connection, or a 429/503 answered in a millisecond) are counted
+# as errors only, so they cannot make a run look faster. The rate limit and
+# admission limits are off unless RATE_LIMIT / ADMISSION_LIMITS say
+# otherwise. They are written as JSON together with the commit
+# they were taken on; compare two runs with benchmarks/compare.py.
+#
+# The clients run on the same machine as the server, so absolute numbers
+# include their CPU use; compare runs made on the same host.
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+import requests
+
+from benchmarks import trees
+from benchmarks.fake_go import FakeGoServer
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ("listing", "view", "download", "proxy", "upload", "upload-folder", "delete")
+UPLOAD_DIR = "bench-uploads"
+READ_CHUNK = 64 * 1024
+
+
+class Server:
+    """start.py in its own working directory (ftp.db, .cache, .env)."""
+
+    def __init__(self, workdir, base_path, go_urls, profile, port):
+        self.workdir = workdir
+        self.port = port
+        self.url = f"http://127.0.0.1:{port}"
+        self.env = dict(
+            os.environ,
+            PYTHONPATH=REPO_ROOT,
+            BASE_PATH=base_path,
+            GO_FILE_SERVER_URLS=",".join(go_urls),
+            HOST="127.0.0.1",
+            PORT=str(port),
+            SERVER_PROFILE=profile,
+            FLASK_SECRET_KEY="benchmark",
+            LOG_LEVEL=os.getenv("LOG_LEVEL", "WARNING"),
+            # every client shares one address; measure the server, not the limiter
+            RATE_LIMIT=os.getenv("RATE_LIMIT", "0"),
+            ADMISSION_LIMITS=os.getenv("ADMISSION_LIMITS", ""),
+        )
+        self.process = None
+
+    def start(self, timeout=60):
+        # start.py runs the setup wizard when there is no .env
+        with open(os.path.join(self.workdir, ".env"), "w") as f:
+            f.write(f"BASE_PATH={self.env['BASE_PATH']}\n")
+        subprocess.run(
+            [sys.executable, "-c", "import db_create; db_create.setup_database()"],
+            cwd=self.workdir, env=self.env, check=True, stdout=subprocess.DEVNULL
+        )
+        self.log = open(os.path.join(self.workdir, "server.log"), "w")
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.join(REPO_ROOT, "start.py")],
+            cwd=self.workdir, env=self.env, stdout=self.log, stderr=subprocess.STDOUT
+        )
+
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"Server exited early, see {self.log.name}")
+            try:
+                if requests.get(self.url + "/", timeout=1).status_code == 200:
+                    return self
+            except requests.RequestException:
+                pass
+            time.sleep(0.2)
+        raise RuntimeError(f"Server did not come up within {timeout}s, see {self.log.name}")
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self.log.close()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+_local = threading.local()
+
+
+def _session(concurrency):
+    session = getattr(_local, "session", None)
+    if session is None:
+        session = _local.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        session.mount("http://", adapter)
+    return session
+
+
+def run_scenario(base_url, make_request, count, concurrency):
+    """Send `count` requests from `concurrency` clients and summarise them."""
+
+    def one(i):
+        method, path, kwargs, expected = make_request(i)
+        started = time.perf_counter()
+        try:
+            r = _session(concurrency).request(
+                method, base_url + path, allow_redirects=False, stream=True, timeout=120, **kwargs
+            )
+            size = sum(len(chunk) for chunk in r.raw.stream(READ_CHUNK, decode_content=False))
+            r.close()
+            return time.perf_counter() - started, size, r.status_code in expected
+        except requests.RequestException:
+            return time.perf_counter() - started, 0, False
+
+    latencies = []
+    errors = 0
+    total_bytes = 0
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for elapsed, size, ok in pool.map(one, range(count)):
+            if not ok:
+                errors += 1
+                continue
+            latencies.append(elapsed)
+            total_bytes += size
+    wall = time.perf_counter() - started
+    return summarise(latencies, errors, total_bytes, wall)
+
+
+def summarise(latencies, errors, total_bytes, wall):
+    if len(latencies) >= 2:
+        cuts = statistics.quantiles(latencies, n=100, method="inclusive")
+        p50, p99 = cuts[49], cuts[98]
+    else:
+        p50 = p99 = latencies[0] if latencies else 0.0
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "seconds": round(wall, 3),
+        "requests_per_second": round(len(latencies) / wall, 1) if wall else 0.0,
+        "p50_ms": round(p50 * 1000, 2),
+        "p99_ms": round(p99 * 1000, 2),
+        "max_ms": round(max(latencies, default=0.0) * 1000, 2),
+        "bytes": total_bytes,
+        "megabytes_per_second": round(total_bytes / wall / 1e6, 2) if wall else 0.0,
+    }
+
+
+def scenario_requests(tree, run_id):
+    """Request factories: i -> (method, path, requests kwargs, expected statuses)."""
+    directories = tree.directories
+    small = tree.small_files()
+    large = tree.largest_files(16)
+    upload_payload = os.urandom(64 * 1024)
+    part_payload = b"x" * 4096
+
+    def listing(i):
+        d = directories[i % len(directories)]
+        return "GET", f"/{quote(d)}/" if d else "/", {}, (200,)
+
+    def view(i):
+        return "GET", f"/file/{quote(small[i % len(small)])}", {}, (200,)
+
+    def download(i):
+        return "GET", f"/download?path={quote(large[i % len(large)])}", {}, (200,)
+
+    def proxy(i):
+        return "GET", f"/raw/{quote(large[i % len(large)])}", {}, (200,)
+
+    def upload(i):
+        files = {"file": (f"up-{run_id}-{i}.bin", upload_payload, "application/octet-stream")}
+        return "POST", f"/{UPLOAD_DIR}/upload", {"files": files}, (302,)
+
+    def upload_folder(i):
+        files = [("files", (f"batch-{run_id}-{i}/part-{j}.txt", part_payload, "text/plain")) for j in range(10)]
+        return "POST", f"/{UPLOAD_DIR}/upload_folder", {"files": files}, (302,)
+
+    def delete(i):
+        # Removes what the upload scenario created
+        data = {"filepath": f"{UPLOAD_DIR}/up-{run_id}-{i}.bin"}
+        return "POST", "/delete_file", {"data": data}, (302,)
+
+    return {
+        "listing": listing,
+        "view": view,
+        "download": download,
+        "proxy": proxy,
+        "upload": upload,
+        "upload-folder": upload_folder,
+        "delete": delete,
+    }
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=REPO_ROOT,
+                               capture_output=True, text=True).stdout.strip()
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end load benchmark over real sockets.")
+    parser.add_argument("--shape", choices=trees.SHAPES, default="wide")
+    parser.add_argument("--scale", type=float, default=1.0)
+    parser.add_argument("--profile", choices=("threaded", "workers", "async"), default="threaded")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=300, help="requests per scenario")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--output", help="results file (default benchmarks/results/<time>-<shape>-<profile>.json)")
+    parser.add_argument("--backends", type=int, default=1, help="number of fake Go backends")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary tree and server log")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="ftp-bench-")
+    base_path = os.path.join(workdir, "base")
+    print(f"Generating '{args.shape}' tree (scale {args.scale}) in {base_path}", file=sys.stderr)
+    tree = trees.generate(base_path, args.shape, args.scale)
+
+    go_servers = [FakeGoServer(base_path).start() for _ in range(max(1, args.backends))]
+    server = Server(workdir, base_path, [go.url for go in go_servers], args.profile, free_port())
+    results = {}
+    try:
+        server.start()
+        factories = scenario_requests(tree, run_id=int(time.time()))
+        # Warm up templates, bytecode caches and connection pools
+        run_scenario(server.url, factories["listing"], min(20, args.requests), args.concurrency)
+        for name in args.scenarios:
+            print(f"Running {name} ...", file=sys.stderr)
+            results[name] = run_scenario(server.url, factories[name], args.requests, args.concurrency)
+    finally:
+        server.stop()
+        for go in go_servers:
+            go.stop()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "shape": args.shape,
+            "scale": args.scale,
+            "files": len(tree.files),
+            "directories": len(tree.directories),
+            "tree_bytes": tree.total_bytes,
+            "profile": args.profile,
+            "concurrency": args.concurrency,
+            "backends": len(go_servers),
+            "requests_per_scenario": args.requests,
+        },
+        "results": results,
+    }
+
+    output = args.output
+    if output is None:
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        output = os.path.join(REPO_ROOT, "benchmarks", "results", f"{stamp}-{args.shape}-{args.profile}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+    print(f"Results written to {output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
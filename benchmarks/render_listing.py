@@ -0,0 +1,60 @@
+# benchmarks/render_listing.py
+# Measures how long it takes to build and render a directory listing page.
+#
+#   python -m benchmarks.render_listing [--sizes 1000 10000 100000] [--repeat 5]
+#
+# Entries are synthetic, so no BASE_PATH or Go service is needed; this only
+# exercises listing.build_entries and the Jinja templates.
+
+import argparse
+import json
+import statistics
+import time
+
+from ftp import create_app
+from ftp.routes.hypermedia import hypermedia_response
+
+EXTENSIONS = ["txt", "jpg", "png", "json", "mp4", "pdf", "css", "log", "bin", ""]
+
+
+def synthetic_listing(count):
+    directories = [f"folder-{i}" for i in range(count // 10)]
+    files = []
+    for i in range(count - len(directories)):
+        ext = EXTENSIONS[i % len(EXTENSIONS)]
+        name = f"file-{i}.{ext}" if ext else f"file-{i}"
+        files.append({"name": name, "mime_type": "application/octet-stream", "size": i * 37})
+    return directories, files
+
+
+def bench(app, count, repeat):
+    directories, files = synthetic_listing(count)
+    timings = []
+    size = 0
+    for _ in range(repeat):
+        with app.test_request_context("/bench/"):
+            start = time.perf_counter()
+            response = hypermedia_response(dirpath="bench", directories=directories, files=files)
+            timings.append(time.perf_counter() - start)
+            size = len(response.get_data())
+    return {
+        "entries": count,
+        "median_ms": round(statistics.median(timings) * 1000, 2),
+        "min_ms": round(min(timings) * 1000, 2),
+        "bytes": size,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    app = create_app(start_go=False)
+    results = [bench(app, count, args.repeat) for count in args.sizes]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
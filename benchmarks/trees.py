@@ -0,0 +1,100 @@
+# benchmarks/trees.py
+# Synthetic BASE_PATH trees for the load benchmarks.
+#
+#   wide        one folder holding thousands of small files
+#   deep        a chain of nested folders with a few files at every level
+#   many-small  hundreds of folders of small files
+#   few-huge    a handful of large binary files
+#
+# Generation is seeded, so the same shape and scale always produce the same
+# tree. `scale` multiplies file counts (and file sizes for few-huge).
+
+import os
+import random
+from dataclasses import dataclass, field
+
+SHAPES = ("wide", "deep", "many-small", "few-huge")
+TEXT_EXTENSIONS = ("txt", "log", "json", "md", "csv")
+BLOCK = 1024 * 1024
+
+
+@dataclass
+class Tree:
+    root: str
+    shape: str
+    directories: list = field(default_factory=list)   # relative paths, "" is the root
+    files: list = field(default_factory=list)         # (relative path, size)
+
+    @property
+    def total_bytes(self):
+        return sum(size for _, size in self.files)
+
+    def small_files(self, limit=64 * 1024):
+        return [path for path, size in self.files if size <= limit] or [path for path, _ in self.files]
+
+    def largest_files(self, count=8):
+        return [path for path, _ in sorted(self.files, key=lambda f: -f[1])[:count]]
+
+
+def generate(root, shape, scale=1.0, seed=1234):
+    if shape not in SHAPES:
+        raise ValueError(f"Unknown tree shape: {shape}")
+    rng = random.Random(seed)
+    tree = Tree(root=root, shape=shape, directories=[""])
+    os.makedirs(root, exist_ok=True)
+
+    if shape == "wide":
+        _add_files(tree, "wide", int(5000 * scale), rng, 1024, 4096)
+    elif shape == "deep":
+        path = ""
+        for depth in range(40):
+            path = f"{path}/level-{depth}" if path else f"level-{depth}"
+            _add_files(tree, path, max(1, int(20 * scale)), rng, 512, 8192)
+    elif shape == "many-small":
+        for i in range(int(200 * scale)):
+            _add_files(tree, f"group-{i // 20}/set-{i}", 50, rng, 512, 2048)
+    else:
+        _add_huge_files(tree, "huge", 4, int(64 * BLOCK * scale), rng)
+    return tree
+
+
+def _text(rng, size):
+    words = ("alpha", "bravo", "charlie", "delta", "echo", "foxtrot", "golf", "hotel")
+    out = []
+    length = 0
+    while length < size:
+        line = " ".join(rng.choice(words) for _ in range(12)) + "\n"
+        out.append(line)
+        length += len(line)
+    return "".join(out)[:size].encode("ascii")
+
+
+def _add_files(tree, directory, count, rng, min_size, max_size):
+    os.makedirs(os.path.join(tree.root, directory), exist_ok=True)
+    parts = directory.split("/")
+    for depth in range(1, len(parts) + 1):
+        path = "/".join(parts[:depth])
+        if path not in tree.directories:
+            tree.directories.append(path)
+
+    for i in range(count):
+        ext = TEXT_EXTENSIONS[i % len(TEXT_EXTENSIONS)]
+        rel = f"{directory}/file-{i:05d}.{ext}"
+        size = rng.randint(min_size, max_size)
+        with open(os.path.join(tree.root, rel), "wb") as f:
+            f.write(_text(rng, size))
+        tree.files.append((rel, size))
+
+
+def _add_huge_files(tree, directory, count, size, rng):
+    os.makedirs(os.path.join(tree.root, directory), exist_ok=True)
+    tree.directories.append(directory)
+    block = rng.randbytes(BLOCK)
+    for i in range(count):
+        rel = f"{directory}/blob-{i}.bin"
+        with open(os.path.join(tree.root, rel), "wb") as f:
+            remaining = size
+            while remaining > 0:
+                f.write(block[:min(BLOCK, remaining)])
+                remaining -= BLOCK
+        tree.files.append((rel, size))
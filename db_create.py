@@ -33,6 +33,102 @@ def setup_database():
     )
     """)
 
+    # Create trash table (see ftp/trash.py)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS trash (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        original_path TEXT NOT NULL,
+        trash_path TEXT,
+        kind TEXT NOT NULL,
+        item_name TEXT NOT NULL,
+        deleted_at DATETIME NOT NULL,
+        state TEXT NOT NULL DEFAULT 'trashed'
+    )
+    """)
+
+    # Create jobs table (see ftp/jobs.py)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        description TEXT,
+        state TEXT NOT NULL DEFAULT 'running',
+        total_bytes INTEGER DEFAULT 0,
+        done_bytes INTEGER DEFAULT 0,
+        error TEXT,
+        pid INTEGER,
+        created_at DATETIME NOT NULL,
+        finished_at DATETIME
+    )
+    """)
+
+    # Create checksum catalog table (see ftp/hashes.py)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS file_hashes (
+        path TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        inode INTEGER NOT NULL,
+        sha256 TEXT NOT NULL,
+        hashed_at DATETIME NOT NULL
+    )
+    """)
+
+    # Create scrub findings table (see ftp/hashes.py)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS scrub_findings (
+        job_id INTEGER NOT NULL,
+        path TEXT NOT NULL,
+        expected TEXT NOT NULL,
+        actual TEXT,
+        error TEXT,
+        found_at DATETIME NOT NULL
+    )
+    """)
+
+    # Create change journal tables (see ftp/journal.py)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS changes (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        op TEXT NOT NULL,
+        path TEXT NOT NULL,
+        new_path TEXT,
+        kind TEXT NOT NULL,
+        size INTEGER,
+        source TEXT NOT NULL,
+        changed_at DATETIME NOT NULL
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS journal_files (
+        path TEXT PRIMARY KEY,
+        kind TEXT NOT NULL,
+        size INTEGER,
+        mtime_ns INTEGER,
+        inode INTEGER
+    )
+    """)
+
+    # Create content search tables (see ftp/search.py)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS search_files (
+        id INTEGER PRIMARY KEY,
+        path TEXT UNIQUE NOT NULL,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        inode INTEGER NOT NULL,
+        mime_type TEXT
+    )
+    """)
+    cursor.execute("CREATE TABLE IF NOT EXISTS search_state (key TEXT PRIMARY KEY, value)")
+    try:
+        cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(body)")
+    except sqlite3.OperationalError:
+        print("SQLite has no FTS5; content search will be disabled.")
+
+    # Create bandwidth shaping settings table (see ftp/shaping.py)
+    cursor.execute("CREATE TABLE IF NOT EXISTS shaping_settings (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+
     conn.commit()
     conn.close()
     print(f"{DB_PATH} created.")
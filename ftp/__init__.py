@@ -1,19 +1,138 @@
 # ftp/__init__.py
 
+import logging
 import os
+import signal
 import subprocess
 import atexit
+import hmac
 import threading
 import time
-from flask import Flask
+from contextlib import contextmanager
+from flask import Flask, abort, current_app, request
+import jinja2
+from jinja2 import FileSystemBytecodeCache
 from dotenv import load_dotenv
 import requests
+from .backends import backend_urls
+from .logs import init_logging
 from .routes import register_routes
 
-go_process = None
+log = logging.getLogger(__name__)
+go_log = logging.getLogger("ftp.go")
+
+go_processes = []
+go_owner_pid = None
+
+# Go services handed from a gunicorn master to the one replacing it
+# (serving.rolling_reload), as "pid:fd:port" of their output pipes
+GO_HANDOVER_ENV = "FTP_GO_SERVICES"
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+@contextmanager
+def host_lock(path):
+    """Exclusive lock shared by every server process on this host."""
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def try_host_lock(lock_file):
+    """Take the lock on the open `lock_file` unless another process holds it."""
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except BlockingIOError:
+        return False
+
+# Background work done by one process per host: name -> (lock, work, interval, wait first)
+_host_tasks = {}
+_host_tasks_pid = None
+_host_tasks_lock = threading.Lock()
+
+def run_on_one_process(name, lock_path, work, interval, wait_first=False):
+    """
+    Call `work` every `interval` seconds, at idle I/O priority, in whichever
+    server process on this host holds `lock_path`. The threads start with
+    the first request each process serves (start_host_tasks), not here:
+    threads do not survive the fork into gunicorn workers.
+    """
+    _host_tasks[name] = (lock_path, work, interval, wait_first)
+
+def start_host_tasks():
+    # before_request hook, so it runs in the process that serves requests
+    global _host_tasks_pid
+    if _host_tasks_pid == os.getpid():
+        return
+    with _host_tasks_lock:
+        if _host_tasks_pid == os.getpid():
+            return
+        _host_tasks_pid = os.getpid()
+        for name, task in _host_tasks.items():
+            threading.Thread(target=_host_task_forever, args=(name, *task), name=name, daemon=True).start()
+
+def _host_task_forever(name, lock_path, work, interval, wait_first):
+    from .trash import lower_io_priority
+    lower_io_priority()
+    os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+    if wait_first:
+        time.sleep(interval)
+    while True:
+        try:
+            with open(lock_path, "w") as lock_file:
+                if try_host_lock(lock_file):   # else another process is doing it
+                    work()
+        except Exception:
+            log.exception("Background task %s failed", name)
+        time.sleep(interval)
+
+def require_admin():
+    """403 unless the request carries ADMIN_TOKEN as its Bearer token."""
+    token = current_app.config["ADMIN_TOKEN"]
+    supplied = request.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+    if not token or not hmac.compare_digest(supplied.encode(), token.encode()):
+        abort(403)
+
+def go_service_running(go_url):
+    try:
+        requests.get(go_url, timeout=1)
+        return True
+    except requests.RequestException:
+        return False
 
 def start_go_service():
-    global go_process
+    # One Go service per backend on this host, however many server processes
+    # there are: the first one to take the lock starts them, the rest find
+    # them running. Backends on other hosts are left to those hosts.
+    from .backends import backend_urls, is_local, port_of
+    _take_over_go_services()
+    with host_lock(os.path.join(".cache", "go-service.lock")):
+        ready_events = []
+        for go_url in backend_urls():
+            if not is_local(go_url):
+                continue
+            if go_service_running(go_url):
+                log.info("Go microservice already running at %s.", go_url)
+                continue
+            ready_events.append(_spawn_go_service(go_url, port_of(go_url)))
+        for ready_event in ready_events:
+            if not ready_event.wait(timeout=200):
+                log.warning("Go microservice did not signal readiness in time. Requests may fail.")
+
+def _spawn_go_service(go_url, port):
+    global go_owner_pid
     go_executable = os.path.join("microservices", "main.go")
 
     if not os.path.exists(go_executable):
@@ -22,64 +141,222 @@ def start_go_service():
     env = os.environ.copy()
     env["BASE_PATH"] = os.getenv("BASE_PATH", "C:/ftp-server")
     env["UPLOAD_BASE_PATH"] = os.getenv("UPLOAD_BASE_PATH", env["BASE_PATH"])
-    env["GO_FILE_SERVER_URL"] = os.getenv("GO_FILE_SERVER_URL", "http://localhost:8000")
+    env["GO_FILE_SERVER_URL"] = go_url
+    env["GO_PORT"] = str(port)
                                 
+    # The whole package: main.go and its per-platform files (inode_*.go)
     go_process = subprocess.Popen(
-        ["go", "run", go_executable],
+        ["go", "run", "./" + os.path.dirname(go_executable)],
         stdout=subprocess.PIPE,
         stderr=subprocess.STDOUT,
         text=True,
         env=env
     )
-    print("[INFO] Go microservice started.")
+    go_process.port = port
+    go_processes.append(go_process)
+    go_owner_pid = os.getpid()
+    log.info("Go microservice started on port %s.", port)
 
     ready_event = threading.Event()
+    threading.Thread(target=_relay_go_output, args=(go_process, ready_event), daemon=True).start()
+    return ready_event
+
+def _relay_go_output(go_process, ready_event):
+    # Relays the Go service's output into our logs, one record per line
+    for line in go_process.stdout:
+        line = line.strip()
+        go_log.info("%s", line)
+        if "Go file server running" in line:
+            ready_event.set()
+    if go_process.poll() is not None:
+        log.error("Go process on port %s exited unexpectedly.", go_process.port)
+
+class _HandedOverGoService:
+    """A Go service started by the gunicorn master this one replaced."""
 
-    go_url = os.getenv("GO_FILE_SERVER_URL", "http://localhost:8000")
-    ready = False
-    max_wait_seconds = 10
-    start_time = time.time()
+    def __init__(self, pid, fd, port):
+        self.pid = pid
+        self.stdout = os.fdopen(fd, "r")
+        self.port = port
 
-    def monitor_stdout():
-        for line in go_process.stdout:
-            line = line.strip()
-            print(f"[GO] {line}")
-            if "Go file server running" in line:
-                ready_event.set()
-        if go_process.poll() is not None:
-            print("[ERROR] Go process exited unexpectedly.")
+    def poll(self):
+        try:
+            os.kill(self.pid, 0)
+            return None
+        except ProcessLookupError:
+            return -1
 
-    threading.Thread(target=monitor_stdout, daemon=True).start()
+    def terminate(self):
+        try:
+            os.kill(self.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
 
-    if not ready_event.wait(timeout=200):
-        print("[WARNING] Go microservice did not signal readiness in 10 seconds. Requests may fail.")
+def go_service_handover():
+    """
+    Environment for a gunicorn master about to replace this one: the Go
+    services' output pipes are left open across its exec, so it can relay
+    their output and keep them running once this master has exited (Go
+    exits when nothing reads its output any more).
+    """
+    handed = []
+    for go_process in go_processes:
+        fd = go_process.stdout.fileno()
+        os.set_inheritable(fd, True)
+        handed.append(f"{go_process.pid}:{fd}:{go_process.port}")
+    return {GO_HANDOVER_ENV: ",".join(handed)} if handed else {}
+
+def release_go_service():
+    """Exit without stopping the Go services: the master that replaced this one has them."""
+    go_processes.clear()
+
+def _take_over_go_services():
+    global go_owner_pid
+    for item in filter(None, os.environ.pop(GO_HANDOVER_ENV, "").split(",")):
+        pid, fd, port = (int(part) for part in item.split(":"))
+        go_process = _HandedOverGoService(pid, fd, port)
+        go_processes.append(go_process)
+        go_owner_pid = os.getpid()
+        log.info("Took over the Go microservice on port %s (pid %s).", port, pid)
+        threading.Thread(target=_relay_go_output, args=(go_process, threading.Event()), daemon=True).start()
 
 def stop_go_service():
-    global go_process 
-    if go_process:
+    # Forked workers inherit go_processes but must not stop the master's services
+    if os.getpid() != go_owner_pid:
+        return
+    for go_process in go_processes:
         go_process.terminate()
-        print("[INFO] Go microservice terminated.")
+        log.info("Go microservice terminated.")
+    go_processes.clear()
 
-def create_app():
+def create_app(start_go=True):
+    init_logging()
     app = Flask(__name__)
     app.config["BASE_PATH"] = os.getenv("BASE_PATH", "")
     app.config["UPLOAD_BASE_PATH"] = os.getenv("UPLOAD_BASE_PATH", app.config["BASE_PATH"])
-    app.config["GO_FILE_SERVER_URL"] = os.getenv("GO_FILE_SERVER_URL")
+    app.config["GO_FILE_SERVER_URLS"] = backend_urls()
+    app.config["GO_FILE_SERVER_URL"] = app.config["GO_FILE_SERVER_URLS"][0]
+    app.config["BACKEND_STRATEGY"] = os.getenv("BACKEND_STRATEGY", "hash")  # or least-connections
+    app.config["BACKEND_HEALTH_INTERVAL"] = float(os.getenv("BACKEND_HEALTH_INTERVAL", 5.0))  # seconds
     app.secret_key = os.getenv("FLASK_SECRET_KEY", "")
 
     app.config["DATABASE"] = "ftp.db"
     app.config["MAX_CONTENT_LENGTH"] = 50 * 1024 * 1024  # 50MB
+    app.config["PUT_MAX_CONTENT_LENGTH"] = int(os.getenv("PUT_MAX_CONTENT_LENGTH", 16 * 1024 ** 3))  # 16GB, raw PUT bodies go straight to disk
+    app.config["THUMBNAIL_CACHE_PATH"] = os.getenv("THUMBNAIL_CACHE_PATH", os.path.join(".cache", "thumbnails"))
+    app.config["THUMBNAIL_CACHE_MAX_BYTES"] = int(os.getenv("THUMBNAIL_CACHE_MAX_BYTES", 512 * 1024 * 1024))  # 512MB
+    app.config["THUMBNAIL_WORKERS"] = int(os.getenv("THUMBNAIL_WORKERS", max(1, (os.cpu_count() or 2) // 2)))
+    app.config["JINJA_CACHE_PATH"] = os.getenv("JINJA_CACHE_PATH", os.path.join(".cache", "jinja"))
+    app.config["STATIC_BUILD_PATH"] = os.getenv("STATIC_BUILD_PATH", os.path.join(".cache", "static"))
+    app.config["COMPRESS_MIN_SIZE"] = int(os.getenv("COMPRESS_MIN_SIZE", 1024))  # bytes
+    app.config["ADMIN_TOKEN"] = os.getenv("ADMIN_TOKEN")  # enables /admin/... endpoints
+    app.config["PROFILE_PATH"] = os.getenv("PROFILE_PATH", os.path.join(".cache", "profiles"))
+    # Admission control (see ftp/admission.py); limits default to shares of the thread pool
+    threads = int(os.getenv("WEB_THREADS", 8))
+    app.config["RATE_LIMIT"] = float(os.getenv("RATE_LIMIT", 20))  # requests/second per client, 0 disables
+    app.config["RATE_BURST"] = float(os.getenv("RATE_BURST", 100))
+    default_limits = f"transfer={max(1, threads // 2)},write={max(1, threads // 4)}"
+    if os.getenv("SERVER_PROFILE") != "async":
+        # Followed files and long polls hold a thread each for as long as they stay open
+        default_limits += f",follow={max(1, threads // 4)}"
+    app.config["ADMISSION_LIMITS"] = os.getenv("ADMISSION_LIMITS", default_limits)
+    app.config["ADMISSION_QUEUE_TIMEOUT"] = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", 2.0))  # seconds
+    app.config["ADMISSION_QUEUE_DEPTH"] = int(os.getenv("ADMISSION_QUEUE_DEPTH", max(1, threads // 4)))
+    app.config["CACHE_CONTROL"] = os.getenv("CACHE_CONTROL", "no-cache")  # for /raw and /download
+    app.config["CACHE_RULES"] = os.getenv("CACHE_RULES", "")  # per-path overrides, see ftp/caching.py
+    app.config["HOT_CACHE_MAX_FILE_BYTES"] = int(os.getenv("HOT_CACHE_MAX_FILE_BYTES", 256 * 1024))  # 256KB
+    app.config["HOT_CACHE_MAX_BYTES"] = int(os.getenv("HOT_CACHE_MAX_BYTES", 64 * 1024 * 1024))  # 64MB, 0 disables
+    app.config["TRASH_RETENTION"] = float(os.getenv("TRASH_RETENTION", 7 * 24 * 3600))  # seconds before purging
+    app.config["TRASH_PURGE_INTERVAL"] = float(os.getenv("TRASH_PURGE_INTERVAL", 60))  # seconds, 0 disables the purger
+    app.config["TRASH_PURGE_RATE"] = float(os.getenv("TRASH_PURGE_RATE", 2000))  # entries removed per second
+    app.config["COPY_INLINE_BYTES"] = int(os.getenv("COPY_INLINE_BYTES", 64 * 1024 * 1024))  # bigger copies run as jobs
+    app.config["COPY_INLINE_ENTRIES"] = int(os.getenv("COPY_INLINE_ENTRIES", 1000))  # and so do folders with more entries
+    app.config["COPY_BUFFER_BYTES"] = int(os.getenv("COPY_BUFFER_BYTES", 1024 * 1024))  # when the kernel cannot copy
+    app.config["JOB_WORKERS"] = int(os.getenv("JOB_WORKERS", 2))
+    app.config["DUPLICATE_WORKERS"] = int(os.getenv("DUPLICATE_WORKERS", os.cpu_count() or 2))  # hashing processes
+    app.config["CHECKSUM_INTERVAL"] = float(os.getenv("CHECKSUM_INTERVAL", 3600))  # seconds between catalog passes, 0 disables
+    app.config["CHECKSUM_RATE"] = int(os.getenv("CHECKSUM_RATE", 50 * 1024 * 1024))  # bytes/second read for hashing, 0 = no limit
+    app.config["CHECKSUM_HEADERS"] = os.getenv("CHECKSUM_HEADERS", "1").lower() in ("1", "true", "yes", "on")
+    app.config["JOURNAL_RETENTION"] = float(os.getenv("JOURNAL_RETENTION", 30 * 24 * 3600))  # seconds changes are kept
+    app.config["JOURNAL_SCAN_INTERVAL"] = float(os.getenv("JOURNAL_SCAN_INTERVAL", 300))  # seconds between looks for outside changes, 0 disables
+    app.config["SEARCH_INTERVAL"] = float(os.getenv("SEARCH_INTERVAL", 3600))  # seconds between full index passes, 0 disables indexing
+    app.config["SEARCH_WORKERS"] = int(os.getenv("SEARCH_WORKERS", os.cpu_count() or 2))  # processes reading files to index
+    app.config["SEARCH_MAX_FILE_BYTES"] = int(os.getenv("SEARCH_MAX_FILE_BYTES", 4 * 1024 * 1024))  # bigger files are not indexed
+    app.config["SIGNATURE_CACHE_PATH"] = os.getenv("SIGNATURE_CACHE_PATH", os.path.join(".cache", "signatures"))
+    app.config["SIGNATURE_CACHE_MAX_BYTES"] = int(os.getenv("SIGNATURE_CACHE_MAX_BYTES", 256 * 1024 * 1024))  # 256MB of block signatures for delta uploads
+    # Bandwidth shaping (see ftp/shaping.py); rates are for the whole host
+    app.config["SHAPING_RATE"] = int(os.getenv("SHAPING_RATE", 0))  # bytes/second for all transfers, 0 = no limit
+    app.config["SHAPING_CLIENT_RATE"] = int(os.getenv("SHAPING_CLIENT_RATE", 0))  # bytes/second per client address, 0 = no limit
+    app.config["SHAPING_QUANTUM"] = int(os.getenv("SHAPING_QUANTUM", 64 * 1024))  # bytes a transfer sends per turn
+    app.config["SHAPING_SMALL_BYTES"] = int(os.getenv("SHAPING_SMALL_BYTES", 1024 * 1024))  # smaller bodies never wait
+    app.config["SHAPING_WEIGHTS"] = os.getenv("SHAPING_WEIGHTS", "")  # e.g. "raw=2,download=1"
+    app.config["TAIL_POLL_INTERVAL"] = float(os.getenv("TAIL_POLL_INTERVAL", 1.0))  # only used without inotify
+
+    # Compiled templates survive restarts, so cold starts skip Jinja compilation.
+    # The cache only checks template sources, so options that change the
+    # compiled output go into the file names.
+    app.jinja_env.trim_blocks = True
+    app.jinja_env.lstrip_blocks = True
+    os.makedirs(app.config["JINJA_CACHE_PATH"], exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(
+        app.config["JINJA_CACHE_PATH"],
+        pattern=f"__jinja2_{jinja2.__version__}_tb{int(app.jinja_env.trim_blocks)}_lb{int(app.jinja_env.lstrip_blocks)}_%s.cache"
+    )
 
-    start_go_service()
-    atexit.register(stop_go_service)
+    if start_go:
+        start_go_service()
+        atexit.register(stop_go_service)
 
     import ftp.models as models
     import ftp.routes.hypermedia as hypermedia
     import ftp.routes.directories as directories
+    import ftp.tail as tail
+    import ftp.thumbnails as thumbnails
+    import ftp.compression as compression
+    import ftp.assets as assets
+    import ftp.metrics as metrics
+    import ftp.profiling as profiling
+    import ftp.admission as admission
+    import ftp.shaping as shaping
+    import ftp.backends as backends
+    import ftp.caching as caching
+    import ftp.hotcache as hotcache
+    import ftp.trash as trash
+    import ftp.jobs as jobs
+    import ftp.fileops as fileops
+    import ftp.hashes as hashes
+    import ftp.delta as delta
+    import ftp.duplicates as duplicates
+    import ftp.journal as journal
+    import ftp.search as search
     
+    # after_request hooks run in reverse order; compression must see the final
+    # response, shaping must pace the compressed body, and request timings
+    # should include compression
+    metrics.init_app(app)
+    profiling.init_app(app)
+    admission.init_app(app)
+    shaping.init_app(app)
+    backends.init_app(app)
+    caching.init_app(app)
+    hotcache.init_app(app)
+    compression.init_app(app)
+    assets.init_app(app)
     models.init_app(app)
+    trash.init_app(app)
+    jobs.init_app(app)
+    fileops.init_app(app)
+    hashes.init_app(app)
+    delta.init_app(app)
+    duplicates.init_app(app)
+    journal.init_app(app)
+    search.init_app(app)
     hypermedia.init_app(app)
     directories.init_app(app)
+    tail.init_app(app)
+    thumbnails.init_app(app)
+    app.before_request(start_host_tasks)
+    atexit.register(thumbnails.shutdown)
 
     register_routes(app)
 
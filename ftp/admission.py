@@ -0,0 +1,268 @@
+# ftp/admission.py
+# Admission control, so that one client crawling every directory or a
+# burst of bulk transfers cannot take every worker thread.
+#
+# Two checks run before each request:
+#
+#   - a token bucket per client address: RATE_LIMIT requests per second,
+#     with bursts of up to RATE_BURST. A client whose bucket is empty gets
+#     429 with Retry-After straight away.
+#   - a concurrency cap per route class (ADMISSION_LIMITS, for example
+#     "browse=16,transfer=8,write=2,thumbnail=4"). A request whose class is
+#     full waits up to ADMISSION_QUEUE_TIMEOUT seconds for a slot, with at
+#     most ADMISSION_QUEUE_DEPTH requests waiting per class, and is
+#     otherwise shed with 503 and Retry-After.
+#
+# A slot is held until the response body has been sent, so a transfer
+# counts for as long as it streams. Static files, /metrics and the admin
+# endpoints are never limited. Like the metrics, all state is per process.
+#
+# Followed files (SSE) and /changes long polls are the "follow" class. Under
+# the threaded and workers profiles each one holds a server thread for as
+# long as it stays open, so the class is capped by default there, and a
+# follower over the cap is shed straight away: waiting in the queue would
+# not help when slots free up only as tabs are closed. The async profile
+# serves them from its event loop and leaves them uncapped.
+
+import math
+import threading
+import time
+from flask import abort, g, request
+import ftp.metrics as metrics
+
+# endpoint -> route class
+ROUTE_CLASSES = {
+    "directories.list_root_directory": "browse",
+    "directories.list_directory": "browse",
+    "directories.view_file": "browse",
+    "directories.serve_file": "transfer",
+    "directories.download_file": "transfer",
+    "directories.upload_file": "write",
+    "directories.upload_folder": "write",
+    "directories.create_directory": "write",
+    "directories.delete_file": "write",
+    "directories.delete_directory": "write",
+    "directories.restore_from_trash": "write",
+    "directories.move_path": "write",
+    "directories.copy_path": "write",
+    "files.put_file": "write",
+    "files.delete_path": "write",
+    "files.patch_file": "write",
+    "files.get_signature": "transfer",
+    "directories.list_jobs": "browse",
+    "directories.list_changes": "browse",
+    "directories.search_content": "browse",
+    "directories.job_status": "browse",
+    "directories.list_trash": "browse",
+    "directories.thumbnail": "thumbnail",
+}
+EXEMPT_ENDPOINTS = {"static", "metrics", "admin_profile", "admin_duplicates", "admin_scrub", "admin_shaping", "directories.favicon"}
+
+# Tokens each class takes from the client's bucket. A listing page pulls in
+# one thumbnail per image, which should not count like a page view.
+RATE_COSTS = {"thumbnail": 0.1, "write": 2.0}
+
+# Classes whose requests stay open for minutes: shed at once when full
+UNQUEUED_CLASSES = {"follow"}
+FOLLOW_RETRY_AFTER = 15   # seconds
+
+MAX_BUCKETS = 10000   # client buckets kept before idle ones are dropped
+
+rate_limiter = None
+gates = {}
+queue_timeout = 0.0
+
+
+class TokenBucketLimiter:
+    """Token buckets keyed by client, refilled lazily when a client is seen."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}   # client -> [tokens, last refill]
+        self._lock = threading.Lock()
+
+    def take(self, client, cost=1.0):
+        """Take `cost` tokens. Returns 0 if allowed, else seconds until it would be."""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(client)
+            if bucket is None:
+                if len(self._buckets) >= MAX_BUCKETS:
+                    self._prune(now)
+                bucket = self._buckets[client] = [self.burst, now]
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if tokens >= cost:
+                bucket[0] = tokens - cost
+                return 0.0
+            bucket[0] = tokens
+            return (cost - tokens) / self.rate
+
+    def _prune(self, now):
+        # A bucket that would have refilled completely is the same as a new one
+        full_after = self.burst / self.rate
+        for client, (_, last) in list(self._buckets.items()):
+            if now - last >= full_after:
+                del self._buckets[client]
+
+
+class Gate:
+    """Counting semaphore with a bounded number of waiters."""
+
+    def __init__(self, name, limit, max_waiting):
+        self.name = name
+        self.limit = limit
+        self.max_waiting = max_waiting
+        self.active = 0
+        self.waiting = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, timeout):
+        """Take a slot, waiting up to `timeout` seconds. Returns False if shed."""
+        with self._cond:
+            if self.active < self.limit:
+                self.active += 1
+                return True
+            if self.waiting >= self.max_waiting or timeout <= 0:
+                return False
+            self.waiting += 1
+            try:
+                deadline = time.monotonic() + timeout
+                while self.active >= self.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+                self.active += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+
+class _Slot:
+    """One held gate slot; release() is safe to call more than once."""
+
+    def __init__(self, gate):
+        self.gate = gate
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self.gate.release()
+
+
+def parse_limits(spec):
+    """'browse=16,transfer=8' -> {'browse': 16, 'transfer': 8}"""
+    limits = {}
+    for part in (spec or "").split(","):
+        name, _, value = part.partition("=")
+        if name.strip() and value.strip():
+            limits[name.strip()] = int(value)
+    return limits
+
+
+def init_app(app):
+    global rate_limiter, gates, queue_timeout
+    rate = app.config["RATE_LIMIT"]
+    rate_limiter = TokenBucketLimiter(rate, max(1.0, app.config["RATE_BURST"])) if rate > 0 else None
+    queue_timeout = app.config["ADMISSION_QUEUE_TIMEOUT"]
+    gates = {
+        name: Gate(name, limit, app.config["ADMISSION_QUEUE_DEPTH"])
+        for name, limit in parse_limits(app.config["ADMISSION_LIMITS"]).items()
+        if limit > 0
+    }
+
+    app.before_request(_admit)
+    app.after_request(_hold_until_sent)
+    app.teardown_request(_release_unsent)
+
+
+def route_class(endpoint, args):
+    if endpoint == "directories.view_file" and args.get("follow"):
+        return "follow"
+    if endpoint == "directories.list_changes" and args.get("wait"):
+        return "follow"   # a long poll mostly waits
+    return ROUTE_CLASSES.get(endpoint)
+
+
+def retry_after(seconds):
+    return max(1, math.ceil(seconds))
+
+
+def check_rate(client, cls):
+    """Seconds the client must wait before this request is allowed, or 0."""
+    if rate_limiter is None:
+        return 0.0
+    return rate_limiter.take(client, RATE_COSTS.get(cls, 1.0))
+
+
+def _admit():
+    if request.endpoint in EXEMPT_ENDPOINTS:
+        return
+    cls = route_class(request.endpoint, request.args)
+
+    wait = check_rate(request.remote_addr, cls)
+    if wait:
+        metrics.ADMISSION_REJECTED.inc(cls or "other", "rate")
+        abort(429, retry_after=retry_after(wait))
+
+    gate = gates.get(cls)
+    if gate is None:
+        return
+    started = time.perf_counter()
+    admitted = gate.acquire(0 if cls in UNQUEUED_CLASSES else queue_timeout)
+    metrics.ADMISSION_WAIT_SECONDS.observe(time.perf_counter() - started, cls)
+    if not admitted:
+        metrics.ADMISSION_REJECTED.inc(cls, "busy")
+        abort(503, retry_after=FOLLOW_RETRY_AFTER if cls in UNQUEUED_CLASSES else retry_after(queue_timeout))
+    g.admission_slot = _Slot(gate)
+
+
+def _hold_until_sent(response):
+    slot = g.pop("admission_slot", None)
+    if slot is None:
+        return response
+    response.call_on_close(slot.release)
+    if response.direct_passthrough:
+        # Passthrough bodies (send_file) are handed to the server as they
+        # are, so the response's close hooks never run; hook the body instead
+        _release_on_close(response.response, slot)
+    return response
+
+
+def _release_on_close(body, slot):
+    close = getattr(body, "close", None)
+
+    def closing():
+        try:
+            if close is not None:
+                close()
+        finally:
+            slot.release()
+
+    try:
+        body.close = closing
+    except AttributeError:
+        slot.release()   # nothing to hook into
+
+
+def _release_unsent(exc):
+    # The request failed before a response took over the slot
+    slot = g.pop("admission_slot", None)
+    if slot is not None:
+        slot.release()
+
+
+def in_flight():
+    return {(name,): gate.active for name, gate in gates.items()}
+
+
+def queued():
+    return {(name,): gate.waiting for name, gate in gates.items()}
@@ -0,0 +1,146 @@
+# ftp/assets.py
+# Content-fingerprinted URLs for everything under ftp/static.
+#
+# At startup every static file is hashed and given a versioned name
+# (style.css -> style.3f9c0a1b2d4e.css). url_for('static', ...) emits the
+# versioned name, and those URLs are served with a one year immutable
+# Cache-Control, so browsers stop revalidating icons and stylesheets on
+# every page view. Stylesheets are rewritten so their url(...) references
+# point at versioned icons too.
+
+import hashlib
+import mimetypes
+import os
+import re
+from dataclasses import dataclass
+from flask import current_app
+from werkzeug.exceptions import NotFound
+import ftp.compression as compression
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+DIGEST_LENGTH = 12
+
+FINGERPRINT_RE = re.compile(r"^(?P<stem>.+)\.(?P<digest>[0-9a-f]{%d})(?P<ext>\.[^./]+)$" % DIGEST_LENGTH)
+CSS_URL_RE = re.compile(r"""url\((?P<quote>['"]?)(?P<url>[^'")]+)(?P=quote)\)""")
+
+
+@dataclass
+class Asset:
+    digest: str
+    versioned_name: str   # what templates link to
+    path: str             # file on disk that is actually served
+
+
+manifest = {}   # logical name ("icons/file.svg") -> Asset
+
+
+def init_app(app):
+    build_dir = os.path.abspath(app.config["STATIC_BUILD_PATH"])
+    build_manifest(app.static_folder, build_dir, app.static_url_path)
+
+    app.url_defaults(versioned_static_url)
+    app.view_functions["static"] = serve_static
+
+
+def _versioned(name, digest):
+    stem, ext = os.path.splitext(name)
+    return f"{stem}.{digest}{ext}"
+
+
+def _static_files(static_folder):
+    skip = tuple(compression.SUFFIXES.values()) + (".tmp",)
+    for dirpath, _, filenames in os.walk(static_folder):
+        for filename in filenames:
+            if filename.endswith(skip):
+                continue
+            path = os.path.join(dirpath, filename)
+            yield os.path.relpath(path, static_folder).replace(os.sep, "/"), path
+
+
+def build_manifest(static_folder, build_dir, static_url_path):
+    manifest.clear()
+    stylesheets = []
+
+    for name, path in _static_files(static_folder):
+        if name.endswith(".css"):
+            stylesheets.append((name, path))
+            continue
+        with open(path, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()[:DIGEST_LENGTH]
+        manifest[name] = Asset(digest, _versioned(name, digest), path)
+
+    # Stylesheets go last: their hash must cover the rewritten icon URLs
+    for name, path in stylesheets:
+        with open(path, "r", encoding="utf-8") as f:
+            css = f.read()
+        css = CSS_URL_RE.sub(lambda m: _rewrite_css_url(m, name, static_url_path), css)
+        data = css.encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()[:DIGEST_LENGTH]
+
+        built_path = os.path.join(build_dir, *_versioned(name, digest).split("/"))
+        if not os.path.exists(built_path):
+            os.makedirs(os.path.dirname(built_path), exist_ok=True)
+            tmp = f"{built_path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, built_path)
+        if len(data) >= compression.min_size:
+            compression.precompress_file(built_path)
+        manifest[name] = Asset(digest, _versioned(name, digest), built_path)
+
+
+def _rewrite_css_url(match, stylesheet, static_url_path):
+    url = match.group("url")
+    prefix = static_url_path.rstrip("/") + "/"
+    if url.startswith(prefix):
+        name = url[len(prefix):]
+    elif "://" in url or url.startswith(("/", "data:", "#")):
+        return match.group(0)
+    else:
+        name = os.path.normpath(os.path.join(os.path.dirname(stylesheet), url)).replace(os.sep, "/")
+
+    asset = manifest.get(name)
+    if asset is None:
+        return match.group(0)
+    q = match.group("quote")
+    return f"url({q}{prefix}{asset.versioned_name}{q})"
+
+
+def versioned_static_url(endpoint, values):
+    """url_defaults hook: url_for('static', filename=...) -> versioned filename."""
+    if endpoint != "static":
+        return
+    asset = manifest.get(values.get("filename"))
+    if asset is not None:
+        values["filename"] = asset.versioned_name
+
+
+def serve_static(filename):
+    """
+    /static/<name>                  current content, revalidated as before
+    /static/<name>.<current hash>   current content, cached for a year
+    /static/<name>.<older hash>     current content, not cached, so a page
+                                    from a previous deploy still renders
+    """
+    match = FINGERPRINT_RE.match(filename)
+    if match:
+        name = match.group("stem") + match.group("ext")
+        asset = manifest.get(name)
+        if asset is not None:
+            response = _send(asset.path, name, max_age=IMMUTABLE_MAX_AGE)
+            if match.group("digest") == asset.digest:
+                response.cache_control.immutable = True
+            else:
+                response.cache_control.max_age = 0
+                response.cache_control.no_cache = True
+            return response
+
+    asset = manifest.get(filename)
+    if asset is None:
+        raise NotFound()
+    return _send(asset.path, filename, max_age=current_app.get_send_file_max_age(filename))
+
+
+def _send(path, name, max_age):
+    mimetype, _ = mimetypes.guess_type(name)
+    return compression.send_precompressed(path, mimetype or "application/octet-stream", max_age=max_age)
@@ -0,0 +1,158 @@
+# ftp/backends.py
+# Pool of Go file services behind the /raw proxy.
+#
+# GO_FILE_SERVER_URLS lists the backends, comma separated (a single
+# GO_FILE_SERVER_URL still works). Each /raw request gets an ordered list of
+# backends to try:
+#
+#   hash               rendezvous hashing on the file path, so a file is
+#                      always read through the same backend and stays warm
+#                      in that host's page cache (default)
+#   least-connections  the backend with the fewest transfers in progress
+#
+# A backend that refuses a connection or times out is taken out of rotation
+# straight away and the request moves on to the next one. A background
+# thread probes /healthz on every backend each BACKEND_HEALTH_INTERVAL
+# seconds and puts recovered backends back.
+
+import hashlib
+import logging
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+import requests
+
+log = logging.getLogger(__name__)
+
+DEFAULT_URL = "http://localhost:8000"
+STRATEGIES = ("hash", "least-connections")
+
+pool = None
+
+
+def backend_urls():
+    """Backend URLs from the environment, in the order they were given."""
+    urls = os.getenv("GO_FILE_SERVER_URLS") or os.getenv("GO_FILE_SERVER_URL") or DEFAULT_URL
+    return [url.strip().rstrip("/") for url in urls.split(",") if url.strip()]
+
+
+def is_local(url):
+    return urlsplit(url).hostname in ("localhost", "127.0.0.1", "::1")
+
+
+def port_of(url):
+    parts = urlsplit(url)
+    return parts.port or (443 if parts.scheme == "https" else 80)
+
+
+class Backend:
+    def __init__(self, url):
+        self.url = url
+        self.healthy = True
+        self.active = 0          # transfers in progress
+        self.failures = 0        # consecutive failures
+        self._lock = threading.Lock()
+
+    def begin(self):
+        with self._lock:
+            self.active += 1
+
+    def end(self):
+        with self._lock:
+            self.active -= 1
+
+    def __repr__(self):
+        return f"<Backend {self.url} {'up' if self.healthy else 'down'} active={self.active}>"
+
+
+class BackendPool:
+    def __init__(self, urls, strategy="hash", health_interval=5.0):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown backend strategy: {strategy}")
+        self.backends = [Backend(url) for url in urls]
+        self.strategy = strategy
+        self.health_interval = health_interval
+        self._checker_pid = None
+        self._checker_lock = threading.Lock()
+
+    def candidates(self, path):
+        """Backends to try for `path`, best first; backends marked down go last."""
+        self._ensure_checker()
+        if self.strategy == "hash":
+            ordered = sorted(self.backends, key=lambda b: _score(b.url, path), reverse=True)
+        else:
+            ordered = sorted(self.backends, key=lambda b: b.active)
+        # Health can be stale, so down backends are still tried as a last resort
+        return [b for b in ordered if b.healthy] + [b for b in ordered if not b.healthy]
+
+    def mark_failed(self, backend, reason):
+        backend.failures += 1
+        if backend.healthy:
+            backend.healthy = False
+            log.warning("Go backend %s marked down (%s)", backend.url, reason)
+
+    def mark_ok(self, backend):
+        backend.failures = 0
+        if not backend.healthy:
+            backend.healthy = True
+            log.info("Go backend %s is back up", backend.url)
+
+    def check(self, backend):
+        try:
+            r = requests.get(f"{backend.url}/healthz", timeout=1)
+            # Older Go services have no /healthz, but answering at all means they are up
+            ok = r.status_code < 500
+        except requests.RequestException:
+            ok = False
+        if ok:
+            self.mark_ok(backend)
+        else:
+            self.mark_failed(backend, "health check")
+        return ok
+
+    def check_all(self):
+        for backend in self.backends:
+            self.check(backend)
+
+    def _ensure_checker(self):
+        # Started lazily in the process that serves requests: threads do not
+        # survive the fork into gunicorn workers
+        if self._checker_pid == os.getpid() or self.health_interval <= 0:
+            return
+        with self._checker_lock:
+            if self._checker_pid != os.getpid():
+                self._checker_pid = os.getpid()
+                threading.Thread(target=self._check_forever, name="backend-health", daemon=True).start()
+
+    def _check_forever(self):
+        while True:
+            time.sleep(self.health_interval)
+            try:
+                self.check_all()
+            except Exception:
+                log.exception("Backend health check failed")
+
+
+def _score(url, path):
+    digest = hashlib.blake2b(f"{url}\0{path}".encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+def init_app(app):
+    global pool
+    pool = BackendPool(
+        app.config["GO_FILE_SERVER_URLS"],
+        strategy=app.config["BACKEND_STRATEGY"],
+        health_interval=app.config["BACKEND_HEALTH_INTERVAL"],
+    )
+    log.info("Go backends (%s): %s", pool.strategy, ", ".join(b.url for b in pool.backends))
+
+
+def health():
+    """{(url,): 1/0} for the metrics gauge."""
+    return {(b.url,): int(b.healthy) for b in pool.backends} if pool else {}
+
+
+def in_flight():
+    return {(b.url,): b.active for b in pool.backends} if pool else {}
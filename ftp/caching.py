@@ -0,0 +1,61 @@
+# ftp/caching.py
+# Validators and Cache-Control for file bodies (/raw and /download).
+#
+# Every file body carries a strong ETag built from the file's inode, size
+# and modification time in nanoseconds, "<ino>-<size>-<mtime_ns>" in hex
+# (the inode is left out on Windows). The Go service builds exactly the
+# same tag, so a validator stays good whichever of the two served the
+# file. Writing, replacing or restoring a file changes at least one of the
+# three.
+#
+# How long browsers may reuse a body without asking is set per path by
+# CACHE_RULES: rules separated by ";", each a list of glob patterns
+# (matched against the path relative to BASE_PATH), "=", and the
+# Cache-Control value to send:
+#
+#   CACHE_RULES="*.jpg *.jpeg *.png *.webp=public, max-age=86400; logs/*=no-store"
+#
+# The first matching rule wins. Paths no rule matches get CACHE_CONTROL,
+# "no-cache" by default: always revalidate, which costs a 304 and no body
+# while the file is unchanged.
+
+import fnmatch
+import os
+
+# Request headers that make a GET conditional; the proxy forwards all of them
+CONDITIONAL_HEADERS = ("If-None-Match", "If-Modified-Since", "If-Match", "If-Unmodified-Since", "If-Range")
+
+default_policy = "no-cache"
+rules = []
+
+
+def init_app(app):
+    global default_policy, rules
+    default_policy = app.config["CACHE_CONTROL"]
+    rules = parse_rules(app.config["CACHE_RULES"])
+
+
+def parse_rules(spec):
+    """'*.jpg *.png=public, max-age=60; logs/*=no-store' -> [(['*.jpg', '*.png'], 'public, max-age=60'), ...]"""
+    parsed = []
+    for rule in (spec or "").split(";"):
+        patterns, sep, policy = rule.partition("=")
+        if sep and patterns.split() and policy.strip():
+            parsed.append((patterns.split(), policy.strip()))
+    return parsed
+
+
+def cache_control(path):
+    """Cache-Control value for a file at `path` (relative to BASE_PATH)."""
+    path = path.replace("\\", "/").lstrip("/")
+    for patterns, policy in rules:
+        for pattern in patterns:
+            if fnmatch.fnmatchcase(path, pattern):
+                return policy
+    return default_policy
+
+
+def file_etag(st):
+    """Strong ETag value (without quotes) for an os.stat() result."""
+    ino = 0 if os.name == "nt" else st.st_ino   # Go cannot see Windows file IDs
+    return f"{ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"
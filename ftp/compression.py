@@ -0,0 +1,260 @@
+# ftp/compression.py
+# Content-Encoding negotiation for HTML, JSON and text responses.
+#
+# Dynamic responses are compressed on the way out, with the level picked
+# from how busy the CPU currently is. Static assets never change while the
+# server runs, so they are compressed once at startup at the highest level
+# and the precompressed variant (style.css.br, style.css.gz, ...) is sent
+# as-is by send_precompressed(). Variants are written under
+# STATIC_BUILD_PATH, like the rewritten stylesheets (ftp/assets.py), never
+# into ftp/static, which may be read-only; where they cannot be written the
+# files are sent uncompressed.
+#
+# File bodies (/raw and /download) are never compressed on the fly: they keep
+# their strong ETag, Content-Length and byte ranges, so resumed downloads and
+# If-Match keep working.
+
+import gzip
+import logging
+import mimetypes
+import os
+import time
+import zlib
+from flask import request, send_file
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSIBLE_TYPES = ("text/", "application/json", "application/javascript", "image/svg+xml")
+UNCOMPRESSIBLE_TYPES = ("text/event-stream",)  # must reach the browser unbuffered
+FILE_ENDPOINTS = ("directories.serve_file", "directories.download_file")
+
+SUFFIXES = {"br": ".br", "zstd": ".zst", "gzip": ".gz"}
+
+# (low, medium, high) CPU-load tiers; "high" is used when the CPU is idle
+LEVELS = {
+    "br": (1, 4, 6),
+    "zstd": (1, 3, 6),
+    "gzip": (1, 4, 6),
+}
+PRECOMPRESS_LEVELS = {"br": 11, "zstd": 19, "gzip": 9}
+
+log = logging.getLogger(__name__)
+
+min_size = 1024
+_variant_dirs = {}      # folder with static files -> folder their variants are written to
+_load_tier = (0.0, 1)   # (checked at, tier index)
+
+
+def init_app(app):
+    global min_size
+    min_size = app.config["COMPRESS_MIN_SIZE"]
+
+    precompress_directory(app.static_folder, os.path.join(app.config["STATIC_BUILD_PATH"], "precompressed"))
+    app.after_request(compress_response)
+
+
+def available_encodings():
+    encodings = []
+    if brotli is not None:
+        encodings.append("br")
+    if zstandard is not None:
+        encodings.append("zstd")
+    encodings.append("gzip")
+    return encodings
+
+
+def negotiate(accept_encoding, candidates=None):
+    """Pick the best encoding the client accepts, in our order of preference."""
+    if not accept_encoding:
+        return None
+    accepted = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip().lower()] = q
+
+    for encoding in candidates or available_encodings():
+        if accepted.get(encoding, accepted.get("*", 0)) > 0:
+            return encoding
+    return None
+
+
+def is_compressible(mimetype):
+    if not mimetype or mimetype.startswith(UNCOMPRESSIBLE_TYPES):
+        return False
+    return mimetype.startswith(COMPRESSIBLE_TYPES)
+
+
+def current_level(encoding):
+    """
+    Cheaper levels when the machine is busy: at high load the extra ratio
+    is not worth delaying other requests for.
+    """
+    global _load_tier
+    checked_at, tier = _load_tier
+    now = time.monotonic()
+    if now - checked_at > 1.0:
+        try:
+            load = os.getloadavg()[0] / (os.cpu_count() or 1)
+            tier = 2 if load < 0.5 else 1 if load < 1.0 else 0
+        except (AttributeError, OSError):
+            tier = 1  # no load average on Windows
+        _load_tier = (now, tier)
+    return LEVELS[encoding][tier]
+
+
+def compress(data, encoding, level):
+    if encoding == "br":
+        return brotli.compress(data, quality=level)
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def compress_stream(chunks, encoding, level):
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=level)
+        process, finish = compressor.process, compressor.finish
+    elif encoding == "zstd":
+        compressor = zstandard.ZstdCompressor(level=level).compressobj()
+        process, finish = compressor.compress, compressor.flush
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # 31 = gzip container
+        process, finish = compressor.compress, compressor.flush
+
+    try:
+        for chunk in chunks:
+            out = process(chunk)
+            if out:
+                yield out
+        yield finish()
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+def compress_response(response):
+    if (request.method == "HEAD"
+            or request.endpoint in FILE_ENDPOINTS
+            or response.status_code != 200
+            or "Content-Encoding" in response.headers
+            or not is_compressible(response.mimetype)
+            or "no-transform" in response.headers.get("Cache-Control", "")):
+        return response
+
+    length = response.content_length
+    if length is not None and length < min_size:
+        return response
+
+    encoding = negotiate(request.headers.get("Accept-Encoding"))
+    response.vary.add("Accept-Encoding")
+    if encoding is None:
+        return response
+    level = current_level(encoding)
+
+    if response.direct_passthrough or response.is_streamed:
+        # Streamed bodies: compress as they stream, never buffer them
+        response.direct_passthrough = False
+        response.response = compress_stream(response.response, encoding, level)
+        response.headers.pop("Content-Length", None)
+        response.accept_ranges = None
+    else:
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+        response.set_data(compress(data, encoding, level))
+
+    response.headers["Content-Encoding"] = encoding
+    # Digests describe the uncompressed file
+    response.headers.pop("Repr-Digest", None)
+    response.headers.pop("Digest", None)
+    # A compressed body is a different representation; a weak validator still
+    # lets If-None-Match revalidate against the uncompressed original
+    etag, _ = response.get_etag()
+    if etag:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def variant_path(path, encoding):
+    """Where the `encoding` variant of the static file `path` is kept."""
+    path = os.path.abspath(path)
+    for directory, variant_dir in _variant_dirs.items():
+        if path.startswith(directory + os.sep):
+            return os.path.join(variant_dir, os.path.relpath(path, directory)) + SUFFIXES[encoding]
+    return path + SUFFIXES[encoding]   # built files sit in a cache already
+
+
+def precompress_file(path):
+    """Write the .br/.zst/.gz variants of `path`, skipping those already up to date."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return
+    data = None
+    for encoding in available_encodings():
+        target = variant_path(path, encoding)
+        try:
+            if os.stat(target).st_mtime_ns >= st.st_mtime_ns:
+                continue
+        except OSError:
+            pass   # not written yet, or cannot be: found out below
+        if data is None:
+            with open(path, "rb") as f:
+                data = f.read()
+        compressed = compress(data, encoding, PRECOMPRESS_LEVELS[encoding])
+        if len(compressed) >= len(data):
+            continue
+        tmp = f"{target}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(tmp, "wb") as f:
+                f.write(compressed)
+            os.replace(tmp, target)
+        except OSError as e:
+            log.warning("Cannot write %s, sending %s uncompressed: %s", target, path, e)
+            return
+
+
+def precompress_directory(directory, variant_dir):
+    """Precompress the static files in `directory`, keeping the variants in `variant_dir`."""
+    _variant_dirs[os.path.abspath(directory)] = os.path.abspath(variant_dir)
+    for dirpath, _, filenames in os.walk(directory):
+        for name in filenames:
+            if name.endswith(tuple(SUFFIXES.values())) or name.endswith(".tmp"):
+                continue
+            path = os.path.join(dirpath, name)
+            mimetype, _ = mimetypes.guess_type(name)
+            if is_compressible(mimetype) and os.path.getsize(path) >= min_size:
+                precompress_file(path)
+
+
+def send_precompressed(path, mimetype, **kwargs):
+    """
+    send_file() for files that may have precompressed siblings: the best
+    variant the client accepts is sent, otherwise the file itself.
+    """
+    candidates = [e for e in available_encodings() if os.path.isfile(variant_path(path, e))]
+    encoding = negotiate(request.headers.get("Accept-Encoding"), candidates) if candidates else None
+    if encoding is None:
+        response = send_file(path, mimetype=mimetype, conditional=True, **kwargs)
+    else:
+        response = send_file(variant_path(path, encoding), mimetype=mimetype, conditional=True, **kwargs)
+        response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    return response
+
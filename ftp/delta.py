@@ -0,0 +1,272 @@
+# ftp/delta.py
+# Delta uploads: after a few bytes of a multi-GB file change, only the
+# changed parts go over the network, rsync style.
+#
+#   1. GET /signature/<path> returns the block signatures of the server's
+#      copy: for each block, its Adler-32 (the rolling checksum) and the
+#      first 16 bytes of its SHA-256. The ETag is the file's own.
+#   2. The client slides a window over its version of the file. Where the
+#      window's Adler-32 and then SHA-256 match a block, that block is
+#      already on the server; everything else is new data.
+#   3. PATCH /<path> with If-Match: <that ETag> sends the delta: which byte
+#      ranges of the old file to reuse, and the new bytes in between.
+#
+# Blocks are a power of two near the square root of the file size, 4KB to
+# 256KB, so a 4GB file has 64KB blocks and a 2.5MB signature. Signatures
+# are computed once per version of a file and cached on disk like the
+# thumbnails (SIGNATURE_CACHE_PATH, SIGNATURE_CACHE_MAX_BYTES); a version
+# rebuilt from a delta has its signature cached as it is verified, so the
+# next round trip needs no extra read.
+#
+# The new version is built in a hidden staging file next to the old one.
+# Where the filesystem can (Btrfs, XFS, ...) the staging file starts as a
+# reflink clone of the old file, so reused ranges that stay in place are
+# never written at all and the two versions share their unchanged blocks;
+# ranges that moved are copied with copy_file_range. The result is checked
+# against the client's Repr-Digest, if it sent one, and renamed over the
+# old file only if that is still the version the delta was made from.
+#
+# Formats (integers big-endian):
+#
+#   signature: b"FTPSIG01", block size (u32), file size (u64), then for
+#              each block its Adler-32 (u32) and SHA-256 prefix (16 bytes).
+#              The last block may be short.
+#   delta:     b"FTPDLT01", then operations, each a one-byte code:
+#              b"C" offset (u64) length (u64): copy from the old file
+#              b"D" length (u32) and that many bytes: new data
+#              b"E": end of the delta
+#
+# `python -m ftp.upload URL FILE` is a client (ftp/upload.py).
+
+import base64
+import hashlib
+import logging
+import os
+import struct
+import threading
+import uuid
+import zlib
+from werkzeug.exceptions import RequestEntityTooLarge
+import ftp.fileops as fileops
+import ftp.hashes as hashes
+import ftp.metrics as metrics
+
+log = logging.getLogger(__name__)
+
+SIGNATURE_MIME = "application/vnd.ftp-signature"
+DELTA_MIME = "application/vnd.ftp-delta"
+SIGNATURE_MAGIC = b"FTPSIG01"
+DELTA_MAGIC = b"FTPDLT01"
+SIGNATURE_HEADER = struct.Struct(">IQ")   # block size, file size
+BLOCK = struct.Struct(">I16s")            # Adler-32, SHA-256 prefix
+COPY = struct.Struct(">QQ")               # offset, length
+DATA = struct.Struct(">I")                # length
+MIN_BLOCK_SIZE = 4 * 1024     # whole filesystem blocks, so reused ranges can stay shared
+MAX_BLOCK_SIZE = 256 * 1024
+WRITE_SIZE = 1024 * 1024      # new data is written (and sent) in pieces this big
+ADLER_MOD = 65521
+
+cache_dir = None
+max_cache_bytes = 0
+
+_lock = threading.Lock()
+_computing = {}   # cache key -> lock held while its signature is computed
+_cache_bytes = 0
+
+
+def init_app(app):
+    global cache_dir, max_cache_bytes, _cache_bytes
+    cache_dir = os.path.abspath(app.config["SIGNATURE_CACHE_PATH"])
+    max_cache_bytes = app.config["SIGNATURE_CACHE_MAX_BYTES"]
+    os.makedirs(cache_dir, exist_ok=True)
+    _cache_bytes = sum(size for _, _, size in _cached_files())
+
+
+def block_size_for(size):
+    block_size = MIN_BLOCK_SIZE
+    while block_size < MAX_BLOCK_SIZE and block_size * block_size < size:
+        block_size *= 2
+    return block_size
+
+
+def compute_signature(path):
+    """
+    (hex SHA-256 of the whole file, its signature, stat result from before
+    reading) for the file at `path`, in one read.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb", buffering=0) as f:
+        st = os.fstat(f.fileno())
+        block_size = block_size_for(st.st_size)
+        parts = [SIGNATURE_MAGIC, SIGNATURE_HEADER.pack(block_size, st.st_size)]
+        buf = bytearray(block_size)
+        view = memoryview(buf)
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            block = view[:n]
+            digest.update(block)
+            parts.append(BLOCK.pack(zlib.adler32(block), hashlib.sha256(block).digest()[:16]))
+    return digest.hexdigest(), b"".join(parts), st
+
+
+def parse_signature(data):
+    """(block size, file size, [(adler32, sha256 prefix), ...]) from a signature."""
+    if data[:len(SIGNATURE_MAGIC)] != SIGNATURE_MAGIC:
+        raise ValueError("not a block signature")
+    block_size, size = SIGNATURE_HEADER.unpack_from(data, len(SIGNATURE_MAGIC))
+    start = len(SIGNATURE_MAGIC) + SIGNATURE_HEADER.size
+    return block_size, size, [entry for entry in BLOCK.iter_unpack(data[start:])]
+
+
+# Signature cache
+
+def cache_key(st):
+    """Identify a signature by the exact version of its file, like thumbnails."""
+    ident = f"{st.st_dev}:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}"
+    return hashlib.sha256(ident.encode()).hexdigest()
+
+
+def _cache_path(key):
+    return os.path.join(cache_dir, key[:2], f"{key}.sig")
+
+
+def _cached_files():
+    for dirpath, _, filenames in os.walk(cache_dir):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            yield path, st.st_mtime, st.st_size
+
+
+def _evict():
+    """Drop least recently used signatures until the cache is back under 90% of budget."""
+    global _cache_bytes
+    target = max_cache_bytes * 0.9
+    for path, _, size in sorted(_cached_files(), key=lambda entry: entry[1]):
+        if _cache_bytes <= target:
+            break
+        try:
+            os.remove(path)
+            _cache_bytes -= size
+        except OSError:
+            pass
+
+
+def store_signature(st, signature):
+    """Cache the signature of the file version `st` describes."""
+    global _cache_bytes
+    dest = _cache_path(cache_key(st))
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    tmp = f"{dest}.{uuid.uuid4().hex}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(signature)
+    os.replace(tmp, dest)
+    with _lock:
+        _cache_bytes += len(signature)
+        if _cache_bytes > max_cache_bytes:
+            _evict()
+    return dest
+
+
+def signature(full_path):
+    """
+    (path of the cached signature, stat result) for the file at
+    `full_path`, computing the signature first if needed. None if the file
+    changed while it was being read.
+    """
+    st = os.stat(full_path)
+    key = cache_key(st)
+    dest = _cache_path(key)
+    with _lock:
+        key_lock = _computing.setdefault(key, threading.Lock())
+    try:
+        # Concurrent requests for the same file wait for one computation
+        with key_lock:
+            try:
+                # Touch on hit so eviction is least-recently-used rather than oldest-first
+                os.utime(dest)
+                metrics.CACHE_LOOKUPS.inc("signatures", "hit")
+                return dest, st
+            except FileNotFoundError:
+                metrics.CACHE_LOOKUPS.inc("signatures", "miss")
+
+            sha256, data, read_st = compute_signature(full_path)
+            if cache_key(read_st) != key or cache_key(os.stat(full_path)) != key:
+                return None
+            hashes.store([(hashes.relative(full_path), st, sha256)])   # read anyway
+            return store_signature(st, data), st
+    finally:
+        with _lock:
+            _computing.pop(key, None)
+
+
+# Applying a delta
+
+def _read_exact(stream, n):
+    data = stream.read(n)
+    while len(data) < n:
+        more = stream.read(n - len(data))
+        if not more:
+            raise ValueError("delta ends early")
+        data += more
+    return data
+
+
+def apply(stream, base, staging, max_size):
+    """
+    Build `staging` from `base`, the old version open for reading, and the
+    delta read from `stream`. Returns (bytes reused, bytes sent). Raises
+    ValueError if the delta is malformed.
+    """
+    if _read_exact(stream, len(DELTA_MAGIC)) != DELTA_MAGIC:
+        raise ValueError("not a delta")
+    base_size = os.fstat(base.fileno()).st_size
+    reused = sent = pos = 0
+    with open(staging, "xb") as out:
+        cloned = fileops.reflink(base, out)
+        while True:
+            op = _read_exact(stream, 1)
+            if op == b"E":
+                break
+            if op == b"C":
+                offset, length = COPY.unpack(_read_exact(stream, COPY.size))
+                if offset + length > base_size:
+                    raise ValueError("copy past the end of the old file")
+                if pos + length > max_size:
+                    raise RequestEntityTooLarge()
+                # A clone already holds the range where it was
+                if not (cloned and offset == pos):
+                    fileops.copy_range(base, out, offset, pos, length)
+                reused += length
+            elif op == b"D":
+                (length,) = DATA.unpack(_read_exact(stream, DATA.size))
+                if pos + length > max_size:
+                    raise RequestEntityTooLarge()
+                written = 0
+                while written < length:
+                    chunk = _read_exact(stream, min(WRITE_SIZE, length - written))
+                    os.pwrite(out.fileno(), chunk, pos + written)
+                    written += len(chunk)
+                sent += length
+            else:
+                raise ValueError(f"unknown delta operation {op!r}")
+            pos += length
+        out.truncate(pos)
+    return reused, sent
+
+
+def expected_sha256(repr_digest):
+    """The hex SHA-256 in a Repr-Digest header, if it has one."""
+    for item in (repr_digest or "").split(","):
+        name, _, value = item.strip().partition("=")
+        if name.strip().lower() == "sha-256" and value.startswith(":") and value.endswith(":"):
+            try:
+                return base64.b64decode(value[1:-1], validate=True).hex()
+            except ValueError:
+                return None
+    return None
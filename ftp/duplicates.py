@@ -0,0 +1,228 @@
+# ftp/duplicates.py
+# Duplicate file report for BASE_PATH.
+#
+# Reading every byte of a multi-terabyte tree is what makes finding
+# duplicates slow, so candidates are narrowed down in stages, each more
+# expensive than the one before and run on fewer files:
+#
+#   1. size: one walk of the tree buckets files by size. A file whose size
+#      is unique cannot have a duplicate and is never opened. Hard links
+#      to the same inode count once.
+#   2. head and tail: PARTIAL_BYTES from each end of the remaining files
+#      are hashed on a thread pool. Same-size files that differ usually
+#      differ in their headers or trailers.
+#   3. full SHA-256 of what is left, on a process pool. Hashes are kept in
+#      the file_hashes table (ftp/hashes.py) and reused while the file is
+#      unchanged, so a second report reads almost nothing.
+#
+# Groups are produced as soon as they are confirmed, largest files first,
+# as JSON lines ending with a summary:
+#
+#   python -m ftp.duplicates [--json] [--min-size BYTES] [subdir]
+#   curl -H "Authorization: Bearer $ADMIN_TOKEN" http://host/admin/duplicates
+#
+# The endpoint does not exist unless ADMIN_TOKEN is set.
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from flask import Response, abort, request
+import ftp
+import ftp.hashes as hashes
+from ftp.listing import display_size
+
+PARTIAL_BYTES = 64 * 1024
+HASH_BATCH = 256   # files sent to the process pool at a time
+
+base_path = None
+workers = None
+
+
+def init_app(app):
+    global base_path, workers
+    base_path = os.path.abspath(app.config["BASE_PATH"])
+    workers = app.config["DUPLICATE_WORKERS"]
+    if app.config["ADMIN_TOKEN"]:
+        app.add_url_rule("/admin/duplicates", "admin_duplicates", admin_duplicates)
+
+
+class Stats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.files = 0
+        self.groups = 0
+        self.duplicate_files = 0
+        self.reclaimable_bytes = 0
+        self.bytes_read = 0
+
+    def as_dict(self):
+        return {
+            "files_scanned": self.files,
+            "groups": self.groups,
+            "duplicate_files": self.duplicate_files,
+            "reclaimable_bytes": self.reclaimable_bytes,
+            "bytes_read": self.bytes_read,
+            "seconds": round(time.perf_counter() - self.started, 3),
+        }
+
+
+def _scan(root, min_size, stats):
+    """{size: [(relative path, stat result)]}, one entry per inode."""
+    by_size = {}
+    seen_inodes = set()
+    for rel_path, st in hashes.walk_files(root):
+        stats.files += 1
+        if st.st_size < min_size or (st.st_dev, st.st_ino) in seen_inodes:
+            continue
+        seen_inodes.add((st.st_dev, st.st_ino))
+        by_size.setdefault(st.st_size, []).append((rel_path, st))
+    return by_size
+
+
+def _partial_hash(path, size):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb", buffering=0) as f:
+        digest.update(f.read(PARTIAL_BYTES))
+        f.seek(size - PARTIAL_BYTES)
+        digest.update(f.read(PARTIAL_BYTES))
+    return digest.digest()
+
+
+def _group(items, key):
+    groups = {}
+    for item, k in zip(items, key):
+        if k is not None:
+            groups.setdefault(k, []).append(item)
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def find_duplicates(root=None, min_size=1, stats=None):
+    """Yield {"size", "sha256", "paths", "reclaimable_bytes"} for each set of identical files."""
+    stats = stats or Stats()
+    by_size = _scan(root or base_path, min_size, stats)
+    buckets = sorted(((size, files) for size, files in by_size.items() if len(files) > 1), reverse=True,
+                     key=lambda bucket: bucket[0])
+    del by_size
+
+    with ThreadPoolExecutor(max_workers=workers) as threads, ProcessPoolExecutor(max_workers=workers) as processes:
+        # Stage 2, lazily and in order, so the biggest groups come out first
+        def candidates():
+            for size, files in buckets:
+                if size <= 2 * PARTIAL_BYTES:
+                    yield size, files   # reading the ends would read the whole file anyway
+                    continue
+                keys = list(threads.map(lambda f: _safe(_partial_hash, f[0], size), files))
+                stats.bytes_read += 2 * PARTIAL_BYTES * len(files)
+                for group in _group(files, keys):
+                    yield size, group
+
+        # Stage 3, in batches, so the process pool always has enough to do
+        batch = []
+        for candidate in candidates():
+            batch.append(candidate)
+            if sum(len(files) for _, files in batch) >= HASH_BATCH:
+                yield from _confirm(batch, processes, stats)
+                batch = []
+        yield from _confirm(batch, processes, stats)
+
+
+def _safe(fn, rel_path, *args):
+    # Files can vanish or become unreadable mid-walk; they just drop out
+    try:
+        return fn(os.path.join(base_path, rel_path), *args)
+    except OSError:
+        return None
+
+
+def _confirm(batch, processes, stats):
+    files = [f for _, group in batch for f in group]
+    known = hashes.lookup(files)
+    todo = [f for f in files if f[0] not in known]
+    hashed = []
+    for (rel_path, st), sha256 in zip(todo, processes.map(_full_hash, [os.path.join(base_path, p) for p, _ in todo])):
+        if sha256 is not None:
+            known[rel_path] = sha256
+            hashed.append((rel_path, st, sha256))
+            stats.bytes_read += st.st_size
+    hashes.store(hashed)
+
+    for size, group in batch:
+        for same in _group(group, [known.get(rel_path) for rel_path, _ in group]):
+            reclaimable = size * (len(same) - 1)
+            stats.groups += 1
+            stats.duplicate_files += len(same) - 1
+            stats.reclaimable_bytes += reclaimable
+            yield {
+                "size": size,
+                "sha256": known[same[0][0]],
+                "paths": sorted(rel_path for rel_path, _ in same),
+                "reclaimable_bytes": reclaimable,
+            }
+
+
+def _full_hash(path):
+    try:
+        return hashes.sha256_file(path)
+    except OSError:
+        return None
+
+
+def report_lines(root=None, min_size=1):
+    """JSON lines: one per group, then {"summary": {...}}."""
+    stats = Stats()
+    for group in find_duplicates(root, min_size, stats):
+        yield json.dumps(group) + "\n"
+    yield json.dumps({"summary": stats.as_dict()}) + "\n"
+
+
+def admin_duplicates():
+    ftp.require_admin()
+
+    root = os.path.abspath(os.path.join(base_path, request.args.get("path", "")))
+    if os.path.commonpath([base_path, root]) != base_path or not os.path.isdir(root):
+        abort(404)
+    min_size = request.args.get("min_size", 1, type=int)
+    return Response(report_lines(root, min_size), mimetype="application/x-ndjson",
+                    headers={"Cache-Control": "no-store"})
+
+
+def main(argv=None):
+    global base_path, workers
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(prog="python -m ftp.duplicates", description="Report duplicate files under BASE_PATH.")
+    parser.add_argument("path", nargs="?", default="", help="only look in this folder (relative to BASE_PATH)")
+    parser.add_argument("--min-size", type=int, default=1, help="ignore files smaller than this many bytes")
+    parser.add_argument("--workers", type=int, default=None, help="hashing processes (default: CPU count)")
+    parser.add_argument("--json", action="store_true", help="print JSON lines instead of a readable report")
+    args = parser.parse_args(argv)
+
+    load_dotenv(".env")
+    base_path = hashes.base_path = os.path.abspath(os.getenv("BASE_PATH", ""))
+    workers = args.workers or int(os.getenv("DUPLICATE_WORKERS", 0)) or os.cpu_count()
+    hashes.ensure_table()
+    root = os.path.join(base_path, args.path)
+
+    if args.json:
+        for line in report_lines(root, args.min_size):
+            sys.stdout.write(line)
+        return
+
+    stats = Stats()
+    for group in find_duplicates(root, args.min_size, stats):
+        print(f"{len(group['paths'])} copies of {display_size(group['size'])}, "
+              f"{display_size(group['reclaimable_bytes'])} reclaimable (sha256 {group['sha256'][:16]})")
+        for path in group["paths"]:
+            print(f"    {path}")
+    summary = stats.as_dict()
+    print(f"{summary['groups']} groups, {summary['duplicate_files']} duplicate files, "
+          f"{display_size(summary['reclaimable_bytes'])} reclaimable. Scanned {summary['files_scanned']} files "
+          f"and read {display_size(summary['bytes_read'])} in {summary['seconds']}s.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,343 @@
+# ftp/fileops.py
+# Server-side move, rename and copy, so files never have to be downloaded
+# and uploaded again.
+#
+# A move or rename within one filesystem is a single rename(2): only
+# metadata changes, however big the file or folder is. A move to another
+# filesystem is a copy followed by removing the source.
+#
+# Copies use the cheapest way the filesystem offers, file by file:
+#
+#   - reflink (FICLONE): a copy-on-write clone, no data is copied at all
+#     (Btrfs, XFS, bcachefs, ...)
+#   - os.copy_file_range: the kernel copies without going through Python,
+#     and network filesystems can copy on the server
+#   - otherwise a read/write loop with COPY_BUFFER_BYTES buffers
+#
+# A copy is built under a hidden staging name next to its destination and
+# renamed into place when complete, so half-finished copies never show up.
+# Copies bigger than COPY_INLINE_BYTES, or of folders with more than
+# COPY_INLINE_ENTRIES entries, run as background jobs (ftp/jobs.py). The
+# request only walks a folder until it is past one of those; the job
+# measures the whole of it.
+# The directories/files rows change in the same transaction as the final
+# rename.
+
+import datetime
+import errno
+import logging
+import os
+import shutil
+import stat
+import sys
+import uuid
+import ftp.hashes as hashes
+import ftp.jobs as jobs
+import ftp.journal as journal
+import ftp.trash as trash
+from ftp.models import ensure_directory_exists, get_db_connection, lookup_directory_id
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+STAGING_PREFIX = ".ftp-copy-"
+FICLONE = 0x40049409   # linux/fs.h
+COPY_CHUNK = 64 * 1024 * 1024   # bytes per copy_file_range call, between progress reports
+# copy_file_range errors that mean "not between these two files", not "failed"
+FALLBACK_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF}
+
+upload_base_path = None
+inline_bytes = 0
+inline_entries = 0
+buffer_size = 1024 * 1024
+
+
+def init_app(app):
+    global upload_base_path, inline_bytes, inline_entries, buffer_size
+    upload_base_path = os.path.abspath(app.config["UPLOAD_BASE_PATH"])
+    inline_bytes = app.config["COPY_INLINE_BYTES"]
+    inline_entries = app.config["COPY_INLINE_ENTRIES"]
+    buffer_size = app.config["COPY_BUFFER_BYTES"]
+
+
+def resolve(path):
+    """(normalized relative path, physical path) for a path from a form."""
+    if path.startswith("root/"):
+        path = path[5:]
+    path = path.strip("/")
+    physical_path = os.path.abspath(os.path.join(upload_base_path, path))
+    if not path or os.path.commonpath([upload_base_path, physical_path]) != upload_base_path or trash.is_hidden(path):
+        raise ValueError(f"Invalid path: '{path}'")
+    return os.path.relpath(physical_path, upload_base_path).replace(os.sep, "/"), physical_path
+
+
+def _kind(physical_path):
+    return "directory" if os.path.isdir(physical_path) and not os.path.islink(physical_path) else "file"
+
+
+def _table(kind):
+    return ("files", "directory_id") if kind == "file" else ("directories", "parent_id")
+
+
+def _check(src, src_path, dest, dest_path):
+    if not os.path.lexists(src_path):
+        raise FileNotFoundError(f"'{src}' does not exist")
+    if os.path.lexists(dest_path):
+        raise FileExistsError(f"'{dest}' already exists")
+    if not os.path.isdir(os.path.dirname(dest_path)):
+        raise FileNotFoundError(f"Folder '{os.path.dirname(dest) or '/'}' does not exist")
+    if _kind(src_path) == "directory" and (dest_path + os.sep).startswith(src_path + os.sep):
+        raise ValueError("A folder cannot be moved or copied into itself")
+
+
+def move(src, dest):
+    """
+    Move or rename `src` to `dest` (paths relative to the upload base).
+    Returns a job ID if the move became a background copy, else None.
+    """
+    src, src_path = resolve(src)
+    dest, dest_path = resolve(dest)
+    _check(src, src_path, dest, dest_path)
+
+    if os.lstat(src_path).st_dev != os.stat(os.path.dirname(dest_path)).st_dev:
+        return _start_copy(src, dest, remove_source=True)
+
+    dest_parent_id = ensure_directory_exists(os.path.dirname(dest))
+    with get_db_connection() as conn:
+        _move_rows(conn.cursor(), src, dest, dest_parent_id, _kind(src_path))
+        hashes.move(conn.cursor(), src, dest)
+        # Last, so a failed rename rolls the transaction back
+        os.rename(src_path, dest_path)
+        journal.record("move", src, dest, conn=conn)
+
+    log.info("Moved '%s' to '%s'", src, dest)
+    return None
+
+
+def copy(src, dest):
+    """
+    Copy `src` to `dest` (paths relative to the upload base). Returns a job
+    ID if the copy runs in the background, else None.
+    """
+    src, src_path = resolve(src)
+    dest, dest_path = resolve(dest)
+    _check(src, src_path, dest, dest_path)
+    return _start_copy(src, dest, remove_source=False)
+
+
+def _start_copy(src, dest, remove_source):
+    src_path = os.path.join(upload_base_path, src)
+    if _tree_size(src_path, max_bytes=inline_bytes, max_entries=inline_entries) is not None:
+        _copy(src, dest, remove_source, lambda nbytes: None)
+        return None
+
+    def run(progress):
+        progress.set_total(_tree_size(src_path))
+        _copy(src, dest, remove_source, progress.advance)
+
+    verb = "move" if remove_source else "copy"
+    return jobs.submit(verb, f"{verb.capitalize()} '{src}' to '{dest}'", 0, run)
+
+
+def _tree_size(path, max_bytes=None, max_entries=None):
+    """Bytes in the files under `path`, or None as soon as it is past max_bytes or max_entries."""
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode):
+        return st.st_size if max_bytes is None or st.st_size <= max_bytes else None
+    total = entries = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        entries += len(dirnames) + len(filenames)
+        if max_entries is not None and entries > max_entries:
+            return None
+        for name in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                pass
+        if max_bytes is not None and total > max_bytes:
+            return None
+    return total
+
+
+def _copy(src, dest, remove_source, advance):
+    src_path = os.path.join(upload_base_path, src)
+    dest_path = os.path.join(upload_base_path, dest)
+    kind = _kind(src_path)
+    staging = os.path.join(os.path.dirname(dest_path), f"{STAGING_PREFIX}{uuid.uuid4().hex}")
+
+    try:
+        if kind == "directory":
+            _copy_tree(src_path, staging, advance)
+        else:
+            _copy_file(src_path, staging, advance)
+
+        dest_parent_id = ensure_directory_exists(os.path.dirname(dest))
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            if remove_source:
+                _move_rows(cursor, src, dest, dest_parent_id, kind)
+            else:
+                _copy_rows(cursor, src, dest, dest_parent_id, kind)
+            if os.path.lexists(dest_path):
+                raise FileExistsError(f"'{dest}' already exists")
+            os.rename(staging, dest_path)
+            if remove_source:
+                journal.record("move", src, dest, conn=conn)
+            else:
+                journal.record("create", dest, conn=conn)
+    except BaseException:
+        _remove(staging)
+        raise
+
+    if remove_source:
+        _remove(src_path)
+    log.info("%s '%s' to '%s'", "Moved" if remove_source else "Copied", src, dest)
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+def _copy_tree(src_path, dest_path, advance):
+    os.mkdir(dest_path)
+    for dirpath, dirnames, filenames in os.walk(src_path):
+        target = os.path.join(dest_path, os.path.relpath(dirpath, src_path))
+        for name in dirnames:
+            source = os.path.join(dirpath, name)
+            if os.path.islink(source):
+                os.symlink(os.readlink(source), os.path.join(target, name))
+            else:
+                os.mkdir(os.path.join(target, name))
+                shutil.copymode(source, os.path.join(target, name))
+        for name in filenames:
+            _copy_file(os.path.join(dirpath, name), os.path.join(target, name), advance)
+    shutil.copymode(src_path, dest_path)
+
+
+def _copy_file(src_path, dest_path, advance):
+    st = os.lstat(src_path)
+    if stat.S_ISLNK(st.st_mode):
+        os.symlink(os.readlink(src_path), dest_path)
+        advance(st.st_size)
+        return
+    with open(src_path, "rb") as fsrc, open(dest_path, "xb") as fdst:
+        if reflink(fsrc, fdst):
+            advance(st.st_size)
+        else:
+            _copy_data(fsrc, fdst, advance)
+    shutil.copymode(src_path, dest_path)
+
+
+def reflink(fsrc, fdst):
+    """Make `fdst` a copy-on-write clone of `fsrc`; False if the filesystem cannot."""
+    if fcntl is None or not sys.platform.startswith("linux"):
+        return False
+    try:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        return True
+    except OSError:
+        return False
+
+
+def _copy_data(fsrc, fdst, advance):
+    if hasattr(os, "copy_file_range"):
+        try:
+            while True:
+                copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), COPY_CHUNK)
+                if copied == 0:
+                    return
+                advance(copied)
+        except OSError as e:
+            # Both offsets have moved past what was copied, so the loop
+            # below carries on from there
+            if e.errno not in FALLBACK_ERRNOS:
+                raise
+
+    buf = bytearray(buffer_size)
+    view = memoryview(buf)
+    while True:
+        n = fsrc.readinto(buf)
+        if not n:
+            return
+        fdst.write(view[:n])
+        advance(n)
+
+
+def copy_range(fsrc, fdst, src_offset, dst_offset, length):
+    """Copy `length` bytes from `fsrc` at `src_offset` to `fdst` at `dst_offset`."""
+    if hasattr(os, "copy_file_range"):
+        try:
+            while length > 0:
+                copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), min(length, COPY_CHUNK), src_offset, dst_offset)
+                if copied == 0:
+                    return   # the source is shorter than that
+                src_offset += copied
+                dst_offset += copied
+                length -= copied
+            return
+        except OSError as e:
+            if e.errno not in FALLBACK_ERRNOS:
+                raise
+
+    while length > 0:
+        data = os.pread(fsrc.fileno(), min(length, buffer_size), src_offset)
+        if not data:
+            return
+        os.pwrite(fdst.fileno(), data, dst_offset)
+        src_offset += len(data)
+        dst_offset += len(data)
+        length -= len(data)
+
+
+def _move_rows(cursor, src, dest, dest_parent_id, kind):
+    # Children point at their parent's ID, so moving a folder is one row
+    src_parts = src.split("/")
+    src_parent_id = lookup_directory_id(cursor, src_parts[:-1])
+    if src_parent_id is False:
+        return
+    table, parent_column = _table(kind)
+    cursor.execute(
+        f"UPDATE {table} SET name=?, {parent_column}=? WHERE name=? AND {parent_column} IS ?",
+        (dest.split("/")[-1], dest_parent_id, src_parts[-1], src_parent_id)
+    )
+
+
+def _copy_rows(cursor, src, dest, dest_parent_id, kind):
+    src_parts = src.split("/")
+    src_parent_id = lookup_directory_id(cursor, src_parts[:-1])
+    if src_parent_id is False:
+        return
+    now = datetime.datetime.utcnow().isoformat()
+    name = dest.split("/")[-1]
+
+    if kind == "file":
+        cursor.execute(
+            "INSERT INTO files (name, directory_id, mime_type, size, content, creation_date) "
+            "SELECT ?, ?, mime_type, size, content, ? FROM files WHERE name=? AND directory_id IS ?",
+            (name, dest_parent_id, now, src_parts[-1], src_parent_id)
+        )
+        return
+
+    cursor.execute("SELECT id FROM directories WHERE name=? AND parent_id IS ?", (src_parts[-1], src_parent_id))
+    pending = [(row["id"], name, dest_parent_id) for row in cursor.fetchall()]
+    while pending:
+        old_id, new_name, new_parent_id = pending.pop()
+        cursor.execute("INSERT INTO directories (name, parent_id) VALUES (?, ?)", (new_name, new_parent_id))
+        new_id = cursor.lastrowid
+        cursor.execute(
+            "INSERT INTO files (name, directory_id, mime_type, size, content, creation_date) "
+            "SELECT name, ?, mime_type, size, content, ? FROM files WHERE directory_id=?",
+            (new_id, now, old_id)
+        )
+        cursor.execute("SELECT id, name FROM directories WHERE parent_id=?", (old_id,))
+        pending.extend((row["id"], row["name"], new_id) for row in cursor.fetchall())
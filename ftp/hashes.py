@@ -0,0 +1,390 @@
+# ftp/hashes.py
+# Checksum catalog: the SHA-256 of every file under BASE_PATH.
+#
+# Hashes live in the file_hashes table, keyed by the file's path relative
+# to BASE_PATH together with its size, mtime (ns) and inode. A stored hash
+# is only used while all three still match, and a file whose three match
+# is never hashed again.
+#
+# Hashes come from three places:
+#
+#   - uploads are hashed while they are written, at no extra read;
+#   - a background thread walks the tree every CHECKSUM_INTERVAL seconds
+#     and hashes new and changed files, reading at most CHECKSUM_RATE
+#     bytes per second at idle I/O priority. Only one process per host
+#     runs it;
+#   - the duplicate finder (ftp/duplicates.py) stores what it computes.
+#
+# A file keeps its hash when it is moved, renamed or put in the trash and
+# back: fileops and trash rename its row in the same transaction as the
+# file (move()), and the catalog keeps the rows of trashed files until they
+# are purged.
+#
+# /raw and /download send the stored hash as Repr-Digest (RFC 9530) and
+# Digest (RFC 3230), so clients can check what they received. A scrub
+# (POST /admin/scrub) re-reads every catalogued file that has not changed
+# since it was hashed and reports any whose contents no longer match:
+# bit rot, or a write that bypassed the filesystem's timestamps.
+
+import base64
+import ctypes
+import datetime
+import errno
+import hashlib
+import logging
+import os
+import sys
+import time
+from flask import abort, jsonify, request
+import ftp
+import ftp.fileops as fileops
+import ftp.jobs as jobs
+import ftp.trash as trash
+from ftp.models import children_where, get_db_connection
+
+log = logging.getLogger(__name__)
+
+READ_SIZE = 1024 * 1024
+QUERY_BATCH = 500   # paths per SELECT ... IN (...)
+FALLOC_FL_KEEP_SIZE = 0x01   # linux/falloc.h
+
+base_path = None
+rate = 0
+interval = 0
+send_digests = True
+
+
+
+def init_app(app):
+    global base_path, rate, interval, send_digests
+    base_path = os.path.abspath(app.config["BASE_PATH"])
+    rate = app.config["CHECKSUM_RATE"]
+    interval = app.config["CHECKSUM_INTERVAL"]
+    send_digests = app.config["CHECKSUM_HEADERS"]
+    ensure_table()
+
+    if app.config["ADMIN_TOKEN"]:
+        app.add_url_rule("/admin/scrub", "admin_scrub", admin_scrub, methods=["GET", "POST"])
+    if interval > 0:
+        start_hasher()
+
+
+def ensure_table():
+    # Databases created before hashes were stored
+    with get_db_connection() as conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS file_hashes (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                inode INTEGER NOT NULL,
+                sha256 TEXT NOT NULL,
+                hashed_at DATETIME NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS scrub_findings (
+                job_id INTEGER NOT NULL,
+                path TEXT NOT NULL,
+                expected TEXT NOT NULL,
+                actual TEXT,
+                error TEXT,
+                found_at DATETIME NOT NULL
+            )
+        """)
+
+
+class Pacer:
+    """Sleeps as needed to keep reads at or below `rate` bytes per second (0: no limit)."""
+
+    def __init__(self, rate, advance=None):
+        self.rate = rate
+        self.advance = advance
+        self.done = 0
+        self.started = time.monotonic()
+
+    def __call__(self, nbytes):
+        self.done += nbytes
+        if self.advance is not None:
+            self.advance(nbytes)
+        if self.rate > 0:
+            ahead = self.done / self.rate - (time.monotonic() - self.started)
+            if ahead > 0:
+                time.sleep(ahead)
+
+
+def sha256_file(path, on_read=None):
+    """Hex SHA-256 of the file at `path`. Module level so process pools can run it."""
+    digest = hashlib.sha256()
+    buf = bytearray(READ_SIZE)
+    view = memoryview(buf)
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            digest.update(view[:n])
+            if on_read is not None:
+                on_read(n)
+    return digest.hexdigest()
+
+
+def save_stream(stream, path, size=None, exclusive=False):
+    """
+    Write `stream` to `path`, hashing it on the way. Returns the hex
+    SHA-256. Space for `size` bytes, if given, is reserved first.
+    """
+    digest = hashlib.sha256()
+    with open(path, "xb" if exclusive else "wb") as f:
+        if size:
+            preallocate(f.fileno(), size)
+        while True:
+            chunk = stream.read(READ_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            f.write(chunk)
+    return digest.hexdigest()
+
+
+def preallocate(fd, size):
+    """
+    Reserve `size` bytes for a file about to be written, so it is laid out
+    in one piece and a full disk fails before the write instead of midway.
+    The file's size is left alone. Best effort: fallocate(2) only, never
+    posix_fallocate, which writes zeros where the filesystem cannot.
+    """
+    if not sys.platform.startswith("linux"):
+        return
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.fallocate(fd, FALLOC_FL_KEEP_SIZE, ctypes.c_int64(0), ctypes.c_int64(size)) != 0:
+            if ctypes.get_errno() == errno.ENOSPC:
+                raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+    except (AttributeError, TypeError):
+        pass
+
+
+def relative(full_path):
+    return os.path.relpath(full_path, base_path).replace(os.sep, "/")
+
+
+def walk_files(root):
+    """(relative path, stat result) for every regular file under `root`, trash and staged copies excluded."""
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.name == trash.TRASH_DIR or entry.name.startswith(fileops.STAGING_PREFIX):
+                        continue
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            yield relative(entry.path), entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+        except OSError:
+            continue
+
+
+def _validator(st):
+    return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+
+def lookup(files):
+    """
+    Stored hashes still valid for `files`, a list of (relative path, stat
+    result). Returns {relative path: sha256}.
+    """
+    wanted = {path: _validator(st) for path, st in files}
+    found = {}
+    paths = list(wanted)
+    with get_db_connection() as conn:
+        for i in range(0, len(paths), QUERY_BATCH):
+            batch = paths[i:i + QUERY_BATCH]
+            rows = conn.execute(
+                f"SELECT path, size, mtime_ns, inode, sha256 FROM file_hashes WHERE path IN ({','.join('?' * len(batch))})",
+                batch
+            ).fetchall()
+            for row in rows:
+                if (row["size"], row["mtime_ns"], row["inode"]) == wanted[row["path"]]:
+                    found[row["path"]] = row["sha256"]
+    return found
+
+
+def store(hashed):
+    """Remember hashes; `hashed` is a list of (relative path, stat result, sha256)."""
+    if not hashed:
+        return
+    now = datetime.datetime.utcnow().isoformat()
+    with get_db_connection() as conn:
+        conn.cursor().executemany(
+            "INSERT OR REPLACE INTO file_hashes (path, size, mtime_ns, inode, sha256, hashed_at) VALUES (?, ?, ?, ?, ?, ?)",
+            [(path, st.st_size, st.st_mtime_ns, st.st_ino, sha256, now) for path, st, sha256 in hashed]
+        )
+
+
+def move(cursor, old, new):
+    """
+    Carry the hashes of `old` (a file, or everything below a folder) over to
+    `new`, both relative to BASE_PATH, as part of the transaction `cursor`
+    belongs to. A rename keeps size, mtime and inode, so they stay valid.
+    """
+    where, args = children_where(old)
+    cursor.execute(
+        f"UPDATE OR REPLACE file_hashes SET path = ? || substr(path, ?) WHERE path = ? OR ({where})",
+        (new, len(old) + 1, old) + args
+    )
+
+
+def store_file(full_path, sha256):
+    """Remember the hash of a file that was just written."""
+    try:
+        store([(relative(full_path), os.stat(full_path), sha256)])
+    except OSError:
+        pass
+
+
+# Digest headers
+
+def digest_headers(rel_path):
+    """Repr-Digest and Digest headers for a file, if its current hash is known."""
+    if not send_digests:
+        return {}
+    try:
+        st = os.stat(os.path.join(base_path, rel_path))
+    except OSError:
+        return {}
+    sha256 = lookup([(rel_path, st)]).get(rel_path)
+    if sha256 is None:
+        return {}
+    b64 = base64.b64encode(bytes.fromhex(sha256)).decode("ascii")
+    return {"Repr-Digest": f"sha-256=:{b64}:", "Digest": f"SHA-256={b64}"}
+
+
+def add_digest_headers(response, rel_path):
+    if response.status_code in (200, 206):
+        response.headers.update(digest_headers(rel_path))
+    return response
+
+
+# Background catalog
+
+def catalog_pass(pacer=None):
+    """Hash every new or changed file and forget files that are gone. Returns the number hashed."""
+    pacer = pacer or Pacer(rate)
+    seen = set()
+    count = 0
+    batch = []
+
+    def flush():
+        nonlocal count
+        known = lookup(batch)
+        hashed = []
+        for rel_path, st in batch:
+            if rel_path in known:
+                continue
+            try:
+                hashed.append((rel_path, st, sha256_file(os.path.join(base_path, rel_path), pacer)))
+            except OSError:
+                continue
+        store(hashed)
+        count += len(hashed)
+        batch.clear()
+
+    for rel_path, st in walk_files(base_path):
+        seen.add(rel_path)
+        batch.append((rel_path, st))
+        if len(batch) >= QUERY_BATCH:
+            flush()
+    flush()
+
+    with get_db_connection() as conn:
+        gone = [
+            row["path"] for row in conn.execute("SELECT path FROM file_hashes")
+            if row["path"] not in seen
+            # Trashed files are not walked, but keep their hash until purged
+            and not (trash.is_hidden(row["path"]) and os.path.lexists(os.path.join(base_path, row["path"])))
+        ]
+        conn.cursor().executemany("DELETE FROM file_hashes WHERE path=?", [(path,) for path in gone])
+    if count or gone:
+        log.info("Checksum catalog: hashed %s files, forgot %s", count, len(gone))
+    return count
+
+
+def start_hasher():
+    ftp.run_on_one_process("checksum-catalog", os.path.join(".cache", "checksum.lock"), catalog_pass, interval)
+
+
+# Scrub
+
+def scrub(progress):
+    """Re-hash every catalogued file that has not changed since; record mismatches."""
+    trash.lower_io_priority()
+    pacer = Pacer(rate, progress.advance)
+    last_path = ""
+    bad = 0
+    while True:
+        with get_db_connection() as conn:
+            rows = conn.execute(
+                "SELECT path, size, mtime_ns, inode, sha256 FROM file_hashes WHERE path > ? ORDER BY path LIMIT ?",
+                (last_path, QUERY_BATCH)
+            ).fetchall()
+        if not rows:
+            break
+        last_path = rows[-1]["path"]
+
+        findings = []
+        for row in rows:
+            full_path = os.path.join(base_path, row["path"])
+            try:
+                st = os.stat(full_path)
+            except OSError:
+                continue   # gone; the catalog will forget it
+            if _validator(st) != (row["size"], row["mtime_ns"], row["inode"]):
+                continue   # changed legitimately; the catalog will rehash it
+            try:
+                actual, error = sha256_file(full_path, pacer), None
+            except OSError as e:
+                actual, error = None, str(e)
+            if actual != row["sha256"]:
+                log.error("Scrub: '%s' does not match its checksum (%s)", row["path"], error or actual)
+                findings.append((progress.job_id, row["path"], row["sha256"], actual, error,
+                                 datetime.datetime.utcnow().isoformat()))
+        if findings:
+            bad += len(findings)
+            with get_db_connection() as conn:
+                conn.cursor().executemany(
+                    "INSERT INTO scrub_findings (job_id, path, expected, actual, error, found_at) VALUES (?, ?, ?, ?, ?, ?)",
+                    findings
+                )
+    log.info("Scrub %s finished: %s damaged files", progress.job_id, bad)
+
+
+def start_scrub():
+    with get_db_connection() as conn:
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM file_hashes").fetchone()[0]
+    return jobs.submit("scrub", "Verify stored files against their checksums", total, scrub)
+
+
+def admin_scrub():
+    ftp.require_admin()
+
+    if request.method == "POST":
+        return jsonify(job=jobs.get(start_scrub())), 202
+
+    job_id = request.args.get("job", type=int)
+    with get_db_connection() as conn:
+        if job_id is None:
+            row = conn.execute("SELECT id FROM jobs WHERE kind='scrub' ORDER BY id DESC LIMIT 1").fetchone()
+            job_id = row["id"] if row else None
+        findings = [dict(row) for row in conn.execute(
+            "SELECT path, expected, actual, error, found_at FROM scrub_findings WHERE job_id=? ORDER BY path", (job_id,)
+        )]
+    job = jobs.get(job_id) if job_id is not None else None
+    if job is None:
+        abort(404)
+    return jsonify(job=job, findings=findings)
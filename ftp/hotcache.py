@@ -0,0 +1,154 @@
+# ftp/hotcache.py
+# In-process cache for the bodies of small, frequently requested files.
+#
+# Listings embed many small files (icons, images, JSON), and without this
+# each of them makes the trip Flask -> Go -> disk -> Go -> Flask. /raw and
+# /download look here first and answer from memory when they can.
+#
+#   - only files up to HOT_CACHE_MAX_FILE_BYTES are cached, and only once
+#     they have been asked for twice, so one-off downloads do not push out
+#     the files every page uses;
+#   - the cache holds at most HOT_CACHE_MAX_BYTES of file data and evicts
+#     the least recently used file first;
+#   - every hit is checked against a fresh stat() (inode, size, mtime), so
+#     a changed file is never served stale.
+#
+# Each file is held as a single immutable bytes object, which is handed to
+# the server as the response body as is, so a hit copies nothing. Like the
+# metrics, the cache is per process.
+
+import collections
+import os
+import stat
+import threading
+import unicodedata
+from urllib.parse import quote
+from flask import Response, request
+import ftp.caching as caching
+import ftp.metrics as metrics
+
+SEEN_KEYS = 4096   # paths remembered as requested once
+
+base_path = None
+max_file_bytes = 0
+max_total_bytes = 0
+
+_entries = collections.OrderedDict()   # path -> Entry, least recently used first
+_seen = collections.OrderedDict()      # path -> None, requested once
+_total_bytes = 0
+_lock = threading.Lock()
+
+
+class Entry:
+    __slots__ = ("validator", "data", "etag", "mtime")
+
+    def __init__(self, st, data):
+        self.validator = (st.st_ino, st.st_size, st.st_mtime_ns)
+        self.data = data
+        self.etag = caching.file_etag(st)
+        self.mtime = st.st_mtime
+
+
+def init_app(app):
+    global base_path, max_file_bytes, max_total_bytes
+    base_path = os.path.abspath(app.config["BASE_PATH"])
+    max_file_bytes = app.config["HOT_CACHE_MAX_FILE_BYTES"]
+    max_total_bytes = app.config["HOT_CACHE_MAX_BYTES"]
+
+
+def lookup(full_path):
+    """
+    Cached Entry for `full_path`, loading it now if it qualifies, or None
+    if the request should be served the usual way.
+    """
+    if max_total_bytes <= 0:
+        return None
+    try:
+        st = os.stat(full_path)
+    except OSError:
+        return None
+    if not stat.S_ISREG(st.st_mode) or st.st_size > max_file_bytes:
+        return None
+
+    validator = (st.st_ino, st.st_size, st.st_mtime_ns)
+    with _lock:
+        entry = _entries.get(full_path)
+        if entry is not None and entry.validator == validator:
+            _entries.move_to_end(full_path)
+            metrics.CACHE_LOOKUPS.inc("hot", "hit")
+            return entry
+        metrics.CACHE_LOOKUPS.inc("hot", "miss")
+        if entry is not None:
+            _discard(full_path)
+        elif full_path not in _seen:
+            _seen[full_path] = None
+            if len(_seen) > SEEN_KEYS:
+                _seen.popitem(last=False)
+            return None
+        _seen.pop(full_path, None)
+
+    try:
+        with open(full_path, "rb") as f:
+            data = f.read(max_file_bytes + 1)
+            st_after = os.fstat(f.fileno())
+    except OSError:
+        return None
+    entry = Entry(st_after, data)
+    if entry.validator != validator or len(data) != st.st_size:
+        return None   # changed while we were reading it; try again next time
+
+    _store(full_path, entry)
+    return entry
+
+
+def lookup_file(rel_path):
+    """lookup() for a path relative to BASE_PATH; None for paths outside it."""
+    full_path = os.path.abspath(os.path.join(base_path, rel_path))
+    if os.path.commonpath([base_path, full_path]) != base_path:
+        return None
+    return lookup(full_path)
+
+
+def _store(full_path, entry):
+    global _total_bytes
+    with _lock:
+        if full_path in _entries:
+            _discard(full_path)
+        _entries[full_path] = entry
+        _total_bytes += len(entry.data)
+        while _total_bytes > max_total_bytes and _entries:
+            _discard(next(iter(_entries)))
+
+
+def _discard(full_path):
+    # Called with _lock held
+    global _total_bytes
+    entry = _entries.pop(full_path)
+    _total_bytes -= len(entry.data)
+
+
+def cached_bytes():
+    return _total_bytes
+
+
+def make_response(entry, mimetype, cache_control, download_name=None, as_attachment=False):
+    """
+    Response for a cached file, with the same validators, ranges and
+    conditional handling as send_file and the Go service.
+    """
+    response = Response(entry.data, mimetype=mimetype)
+    response.set_etag(entry.etag)
+    response.last_modified = entry.mtime
+    response.headers["Cache-Control"] = cache_control
+    if download_name is not None:
+        try:
+            download_name.encode("ascii")
+        except UnicodeEncodeError:
+            simple = unicodedata.normalize("NFKD", download_name).encode("ascii", "ignore").decode("ascii")
+            names = {"filename": simple, "filename*": f"UTF-8''{quote(download_name, safe='!#$&+-.^_`|~')}"}
+        else:
+            names = {"filename": download_name}
+        response.headers.set("Content-Disposition", "attachment" if as_attachment else "inline", **names)
+    response = response.make_conditional(request, accept_ranges=True, complete_length=len(entry.data))
+    response.accept_ranges = "bytes"   # make_conditional only says so on a 206
+    return response
@@ -0,0 +1,156 @@
+# ftp/jobs.py
+# Background jobs for operations too long to run inside a request (large
+# copies and cross-filesystem moves).
+#
+# A job runs on a small thread pool (JOB_WORKERS threads) in the process
+# that started it. Its state lives in the `jobs` table, so every worker
+# process can answer GET /jobs/<id>. Progress is written at most every
+# PROGRESS_INTERVAL seconds. A job whose process has gone away before it
+# finished is reported as "interrupted".
+
+import datetime
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from ftp.models import get_db_connection
+
+log = logging.getLogger(__name__)
+
+PROGRESS_INTERVAL = 0.5   # seconds between progress writes
+KEEP_FINISHED = 24 * 3600  # seconds finished jobs stay listed
+
+max_workers = 2
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def init_app(app):
+    global max_workers
+    max_workers = app.config["JOB_WORKERS"]
+
+    # Databases created before jobs existed
+    with get_db_connection() as conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                description TEXT,
+                state TEXT NOT NULL DEFAULT 'running',
+                total_bytes INTEGER DEFAULT 0,
+                done_bytes INTEGER DEFAULT 0,
+                error TEXT,
+                pid INTEGER,
+                created_at DATETIME NOT NULL,
+                finished_at DATETIME
+            )
+        """)
+
+
+class Progress:
+    """Counts the bytes a job has processed and writes them out now and then."""
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.done = 0
+        self._written_at = time.monotonic()
+
+    def advance(self, nbytes):
+        self.done += nbytes
+        if time.monotonic() - self._written_at >= PROGRESS_INTERVAL:
+            self.flush()
+
+    def set_total(self, nbytes):
+        """For jobs that only find out how much there is to do once they run."""
+        with get_db_connection() as conn:
+            conn.execute("UPDATE jobs SET total_bytes=? WHERE id=?", (nbytes, self.job_id))
+
+    def flush(self):
+        self._written_at = time.monotonic()
+        with get_db_connection() as conn:
+            conn.execute("UPDATE jobs SET done_bytes=? WHERE id=?", (self.done, self.job_id))
+
+
+def _get_executor():
+    # Threads do not survive the fork into gunicorn workers
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def submit(kind, description, total_bytes, fn):
+    """
+    Run fn(progress) in the background; the job reports progress through
+    progress.advance(nbytes). Returns the job ID.
+    """
+    now = datetime.datetime.utcnow()
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "DELETE FROM jobs WHERE state != 'running' AND finished_at < ?",
+            ((now - datetime.timedelta(seconds=KEEP_FINISHED)).isoformat(),)
+        )
+        cursor.execute(
+            "INSERT INTO jobs (kind, description, total_bytes, pid, created_at) VALUES (?, ?, ?, ?, ?)",
+            (kind, description, total_bytes, os.getpid(), now.isoformat())
+        )
+        job_id = cursor.lastrowid
+
+    _get_executor().submit(_run, job_id, fn)
+    log.info("Started job %s: %s", job_id, description)
+    return job_id
+
+
+def _run(job_id, fn):
+    progress = Progress(job_id)
+    try:
+        fn(progress)
+        state, error = "done", None
+        log.info("Job %s finished", job_id)
+    except Exception as e:
+        log.exception("Job %s failed", job_id)
+        state, error = "failed", str(e)
+    with get_db_connection() as conn:
+        conn.execute(
+            "UPDATE jobs SET state=?, error=?, done_bytes=?, finished_at=? WHERE id=?",
+            (state, error, progress.done, datetime.datetime.utcnow().isoformat(), job_id)
+        )
+
+
+def _alive(pid):
+    if pid == os.getpid() or os.name == "nt":   # os.kill() would terminate it on Windows
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass   # exists, but belongs to someone else
+    return True
+
+
+def _as_dict(row):
+    job = dict(row)
+    pid = job.pop("pid")
+    if job["state"] == "running" and not _alive(pid):
+        job["state"] = "interrupted"
+    job["progress"] = job["done_bytes"] / job["total_bytes"] if job["total_bytes"] else None
+    return job
+
+
+def get(job_id):
+    with get_db_connection() as conn:
+        row = conn.execute("SELECT * FROM jobs WHERE id=?", (job_id,)).fetchone()
+    return _as_dict(row) if row else None
+
+
+def recent(limit=50):
+    with get_db_connection() as conn:
+        rows = conn.execute("SELECT * FROM jobs ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+    return [_as_dict(row) for row in rows]
@@ -0,0 +1,351 @@
+# ftp/journal.py
+# Change journal, so mirrors can sync incrementally instead of crawling.
+#
+# Every change to the tree under BASE_PATH is appended to the `changes`
+# table with an increasing sequence number: create, modify, delete and
+# move, for files and directories. A client asks for everything after the
+# last sequence number it has seen:
+#
+#   GET /changes                      -> {"changes": [], "cursor": <latest>}
+#   GET /changes?since=1234&limit=500 -> the next page, "more": true if there is one
+#   GET /changes?since=1234&wait=30   -> waits up to 30s for something to happen
+#
+# so a poll costs O(changes), not O(tree). Deleting or moving a directory
+# is one change that covers everything inside it; creating one lists its
+# contents as well. Changes older than JOURNAL_RETENTION seconds are
+# dropped every PRUNE_INTERVAL, by one process per host, whether or not
+# the disk is scanned; a client whose cursor is older than that gets 410
+# Gone and has to crawl once more.
+#
+# The server records its own changes as it makes them. Changes made
+# directly on disk are found by comparing the tree against a snapshot
+# (the journal_files table) every JOURNAL_SCAN_INTERVAL seconds, in one
+# process per host at idle I/O priority. Files and directories that
+# vanish in one place and turn up in another with the same inode are
+# reported as moves.
+
+import datetime
+import logging
+import os
+import stat
+import threading
+import time
+import ftp
+import ftp.fileops as fileops
+import ftp.trash as trash
+from ftp.models import children_where, get_db_connection
+
+log = logging.getLogger(__name__)
+
+MAX_PAGE = 1000
+MAX_WAIT = 30.0        # seconds a long poll may wait
+WAIT_POLL = 1.0        # how often waiting requests look for changes from other processes
+PRUNE_INTERVAL = 3600  # seconds between drops of changes past JOURNAL_RETENTION
+
+base_path = None
+retention = 0
+scan_interval = 0
+
+_changed = threading.Condition()
+
+
+def init_app(app):
+    global base_path, retention, scan_interval
+    base_path = os.path.abspath(app.config["BASE_PATH"])
+    retention = app.config["JOURNAL_RETENTION"]
+    scan_interval = app.config["JOURNAL_SCAN_INTERVAL"]
+
+    # Databases created before the journal existed
+    with get_db_connection() as conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS changes (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                op TEXT NOT NULL,
+                path TEXT NOT NULL,
+                new_path TEXT,
+                kind TEXT NOT NULL,
+                size INTEGER,
+                source TEXT NOT NULL,
+                changed_at DATETIME NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS journal_files (
+                path TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                size INTEGER,
+                mtime_ns INTEGER,
+                inode INTEGER
+            )
+        """)
+
+    if scan_interval > 0:
+        start_scanner()
+    if retention > 0:
+        start_pruner()
+
+
+def _physical(path):
+    return os.path.join(base_path, path)
+
+
+def _state(st):
+    kind = "directory" if stat.S_ISDIR(st.st_mode) else "file"
+    return kind, (st.st_size if kind == "file" else None), st.st_mtime_ns, st.st_ino
+
+
+def _append(cursor, op, path, kind, size=None, new_path=None, source="app"):
+    cursor.execute(
+        "INSERT INTO changes (op, path, new_path, kind, size, source, changed_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (op, path, new_path, kind, size, source, datetime.datetime.utcnow().isoformat())
+    )
+
+
+def _notify():
+    with _changed:
+        _changed.notify_all()
+
+
+# Changes made by the server
+
+def record(op, path, new_path=None, kind=None, conn=None):
+    """
+    Journal a change the server just made to `path` (relative to
+    BASE_PATH). op is "create", "modify", "delete" or "move" (to
+    `new_path`); a delete should say what `kind` of thing went. Pass
+    `conn` to make it part of an open transaction.
+    """
+    args = (op, path.strip("/"), new_path and new_path.strip("/"), kind)
+    if conn is None:
+        with get_db_connection() as own:
+            _record(own.cursor(), *args)
+    else:
+        _record(conn.cursor(), *args)
+    _notify()
+
+
+def _record(cursor, op, path, new_path, kind=None, source="app"):
+    where, args = children_where(path)
+    if op == "delete":
+        if kind is None:
+            row = cursor.execute("SELECT kind FROM journal_files WHERE path=?", (path,)).fetchone()
+            kind = row["kind"] if row else "file"
+        _append(cursor, "delete", path, kind, source=source)
+        cursor.execute("DELETE FROM journal_files WHERE path=?", (path,))
+        cursor.execute(f"DELETE FROM journal_files WHERE {where}", args)
+        return
+
+    if op == "move":
+        try:
+            kind, size, mtime_ns, inode = _state(os.lstat(_physical(new_path)))
+        except OSError:
+            return
+        _append(cursor, "move", path, kind, size, new_path, source)
+        cursor.execute("DELETE FROM journal_files WHERE path=?", (path,))
+        cursor.execute(
+            "INSERT OR REPLACE INTO journal_files (path, kind, size, mtime_ns, inode) VALUES (?, ?, ?, ?, ?)",
+            (new_path, kind, size, mtime_ns, inode)
+        )
+        cursor.execute(f"UPDATE OR REPLACE journal_files SET path=? || substr(path, ?) WHERE {where}",
+                       (new_path, len(path) + 1) + args)
+        return
+
+    # create / modify; a new directory brings its contents along
+    try:
+        st = os.lstat(_physical(path))
+    except OSError:
+        return
+    _snapshot(cursor, path, st, op, source)
+    if stat.S_ISDIR(st.st_mode):
+        for dirpath, dirnames, filenames in os.walk(_physical(path)):
+            for name in sorted(dirnames) + sorted(filenames):
+                full = os.path.join(dirpath, name)
+                try:
+                    _snapshot(cursor, os.path.relpath(full, base_path).replace(os.sep, "/"), os.lstat(full), "create", source)
+                except OSError:
+                    continue
+
+
+def _snapshot(cursor, path, st, op, source="app"):
+    kind, size, mtime_ns, inode = _state(st)
+    _append(cursor, op, path, kind, size, source=source)
+    cursor.execute(
+        "INSERT OR REPLACE INTO journal_files (path, kind, size, mtime_ns, inode) VALUES (?, ?, ?, ?, ?)",
+        (path, kind, size, mtime_ns, inode)
+    )
+
+
+def first_missing(full_path):
+    """
+    The topmost directory os.makedirs(full_path) is about to create, or
+    None. Journalling its creation afterwards covers everything below it.
+    """
+    missing = None
+    while full_path != base_path and not os.path.exists(full_path):
+        missing = os.path.relpath(full_path, base_path).replace(os.sep, "/")
+        full_path = os.path.dirname(full_path)
+    return missing
+
+
+# Reading the journal
+
+def latest():
+    with get_db_connection() as conn:
+        # Still right when every row has been pruned
+        return conn.execute("SELECT COALESCE((SELECT seq FROM sqlite_sequence WHERE name='changes'), 0)").fetchone()[0]
+
+
+def changes_since(since, limit, wait=0.0):
+    """
+    (changes, more) after sequence number `since`, waiting up to `wait`
+    seconds for the first one. changes is None if the journal no longer
+    reaches back that far.
+    """
+    deadline = time.monotonic() + min(wait, MAX_WAIT)
+    while True:
+        changes, more = _page(since, limit)
+        remaining = deadline - time.monotonic()
+        if changes is None or changes or remaining <= 0:
+            return changes, more
+        # Notified by changes in this process; other processes' changes
+        # are picked up by looking again
+        with _changed:
+            _changed.wait(min(remaining, WAIT_POLL))
+
+
+def _page(since, limit):
+    with get_db_connection() as conn:
+        # AUTOINCREMENT remembers the last number handed out even after
+        # those rows are pruned, so this is where the journal now begins
+        first = conn.execute(
+            "SELECT COALESCE((SELECT MIN(seq) FROM changes), (SELECT seq + 1 FROM sqlite_sequence WHERE name='changes'), 1)"
+        ).fetchone()[0]
+        if since < first - 1:
+            return None, False
+        rows = conn.execute(
+            "SELECT seq, op, path, new_path, kind, size, source, changed_at FROM changes WHERE seq > ? ORDER BY seq LIMIT ?",
+            (since, limit + 1)
+        ).fetchall()
+    return [dict(row) for row in rows[:limit]], len(rows) > limit
+
+
+# Changes made directly on disk
+
+def _walk(root):
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.name == trash.TRASH_DIR or entry.name.startswith(fileops.STAGING_PREFIX):
+                        continue
+                    try:
+                        st = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    yield os.path.relpath(entry.path, base_path).replace(os.sep, "/"), st
+                    if stat.S_ISDIR(st.st_mode):
+                        stack.append(entry.path)
+        except OSError:
+            continue
+
+
+def scan():
+    """Journal differences between the disk and the snapshot. Returns the number of changes."""
+    with get_db_connection() as conn:
+        known = {row["path"]: (row["kind"], row["size"], row["mtime_ns"], row["inode"])
+                 for row in conn.execute("SELECT path, kind, size, mtime_ns, inode FROM journal_files")}
+    # The root's row marks a snapshot that has been taken
+    seeding = "" not in known
+
+    on_disk = {}
+    for path, st in _walk(base_path):
+        on_disk[path] = (st, _state(st))
+
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        if seeding:
+            # First run: remember what is there without journalling it all
+            cursor.executemany(
+                "INSERT OR REPLACE INTO journal_files (path, kind, size, mtime_ns, inode) VALUES (?, ?, ?, ?, ?)",
+                [(path, *state) for path, (_, state) in on_disk.items()] + [("", "directory", None, None, None)]
+            )
+            log.info("Change journal: snapshot of %s entries taken", len(on_disk))
+            return 0
+
+        created = sorted(path for path in on_disk if path not in known)
+        deleted = sorted(path for path in known if path and path not in on_disk)
+        modified = [path for path, (_, state) in on_disk.items()
+                    if path in known and state[0] == "file" and known[path][0] == "file"
+                    and (state[1], state[2]) != (known[path][1], known[path][2])]
+
+        # The same inode gone from one place and new in another is a move.
+        # A rename leaves a file's size and mtime alone, which tells it
+        # apart from a new file that was given a freed inode.
+        created_by_inode = {on_disk[path][1][3]: path for path in created}
+        moves = []
+        for old in deleted:
+            new = created_by_inode.get(known[old][3])
+            if new is None:
+                continue
+            kind, size, mtime_ns, _ = on_disk[new][1]
+            if kind == known[old][0] and (kind == "directory" or (size, mtime_ns) == known[old][1:3]):
+                moves.append((old, new))
+        moved_from = {old for old, _ in moves}
+
+        # Parents sort before their contents. Moving or deleting a directory
+        # updates the snapshot for everything inside it, and every change
+        # below is checked against the snapshot as it is then, so contents
+        # that went along are not reported again. The same checks skip
+        # changes the server journalled itself while we were walking.
+        count = 0
+        for old, new in moves:
+            if _has(cursor, old) and not _has(cursor, new):
+                _record(cursor, "move", old, new, source="disk")
+                count += 1
+
+        for path in deleted:
+            if path not in moved_from and _has(cursor, path) and not os.path.lexists(_physical(path)):
+                _record(cursor, "delete", path, None, source="disk")
+                count += 1
+
+        for path in created:
+            if not _has(cursor, path):
+                _snapshot(cursor, path, on_disk[path][0], "create", source="disk")
+                count += 1
+
+        for path in modified:
+            row = cursor.execute("SELECT size, mtime_ns FROM journal_files WHERE path=?", (path,)).fetchone()
+            st, state = on_disk[path]
+            if row is not None and (row["size"], row["mtime_ns"]) != (state[1], state[2]):
+                _snapshot(cursor, path, st, "modify", source="disk")
+                count += 1
+
+    if count:
+        log.info("Change journal: %s changes made outside the server", count)
+        _notify()
+    return count
+
+
+def _has(cursor, path):
+    return cursor.execute("SELECT 1 FROM journal_files WHERE path=?", (path,)).fetchone() is not None
+
+
+def prune():
+    """Drop changes older than the retention period. Returns how many went."""
+    cutoff = (datetime.datetime.utcnow() - datetime.timedelta(seconds=retention)).isoformat()
+    with get_db_connection() as conn:
+        dropped = conn.execute("DELETE FROM changes WHERE changed_at < ?", (cutoff,)).rowcount
+    if dropped:
+        log.info("Change journal: %s changes older than %ss dropped", dropped, retention)
+    return dropped
+
+
+def start_scanner():
+    ftp.run_on_one_process("journal-scan", os.path.join(".cache", "journal-scan.lock"), scan, scan_interval)
+
+
+def start_pruner():
+    ftp.run_on_one_process("journal-prune", os.path.join(".cache", "journal-prune.lock"), prune,
+                           min(PRUNE_INTERVAL, retention))
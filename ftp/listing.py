@@ -0,0 +1,120 @@
+# ftp/listing.py
+# Builds the view-model for directory listings.
+#
+# Everything the templates used to work out per entry (icon class, size
+# label, link targets, breadcrumbs) is computed here once with plain dict
+# lookups, so rendering a large directory is just string substitution.
+
+from urllib.parse import quote
+from flask import url_for
+import ftp.thumbnails as thumbnails
+
+ICON_BY_EXTENSION = {
+    "png": "image-file-icon",
+    "jpg": "image-file-icon",
+    "jpeg": "image-file-icon",
+    "gif": "image-file-icon",
+    "webp": "image-file-icon",
+    "svg": "image-file-icon",
+    "html": "html-file-icon",
+    "htm": "html-file-icon",
+    "css": "css-file-icon",
+    "js": "js-file-icon",
+    "json": "json-file-icon",
+    "mp4": "video-file-icon",
+    "mkv": "video-file-icon",
+    "mov": "video-file-icon",
+    "mp3": "audio-file-icon",
+    "wav": "audio-file-icon",
+    "pdf": "pdf-file-icon",
+}
+
+# Fallback when the extension is unknown
+ICON_BY_MIME_TYPE = {
+    "application/json": "json-file-icon",
+}
+ICON_BY_MIME_MAJOR = {
+    "image": "image-file-icon",
+    "text": "text-file-icon",
+    "video": "video-file-icon",
+    "audio": "audio-file-icon",
+}
+
+DEFAULT_ICON = "regular-file-icon"
+SIZE_UNITS = ("B", "KB", "MB", "GB", "TB")
+
+
+def icon_class_for(name, mime_type):
+    ext = name.rsplit(".", 1)[-1].lower() if "." in name else ""
+    icon = ICON_BY_EXTENSION.get(ext)
+    if icon:
+        return icon
+    if mime_type:
+        return (ICON_BY_MIME_TYPE.get(mime_type)
+                or ICON_BY_MIME_MAJOR.get(mime_type.split("/", 1)[0], DEFAULT_ICON))
+    return DEFAULT_ICON
+
+
+def display_size(size):
+    if size is None:
+        return ""
+    value = float(size)
+    for unit in SIZE_UNITS:
+        if value < 1024 or unit == SIZE_UNITS[-1]:
+            return f"{int(value)} {unit}" if unit == "B" else f"{value:.1f} {unit}"
+        value /= 1024
+
+
+def breadcrumbs(dirpath):
+    """[(name, url), ...] for every ancestor of `dirpath`, root excluded."""
+    if not dirpath or dirpath == "root":
+        return []
+    dir_prefix = url_for("directories.list_root_directory")
+    crumbs = []
+    accumulated = []
+    for part in dirpath.strip("/").split("/"):
+        accumulated.append(part)
+        crumbs.append((part, f"{dir_prefix}{quote('/'.join(accumulated))}/"))
+    return crumbs
+
+
+def build_entries(dirpath, directories, files):
+    """
+    Attach display data to the raw scan results.
+    `directories` is a list of names, `files` a list of dicts with at least
+    "name" and "mime_type" (and "size" when known).
+    """
+    parent = "" if not dirpath or dirpath == "root" else dirpath.strip("/")
+    prefix = f"{parent}/" if parent else ""
+
+    # Resolve the URL rules once instead of calling url_for per entry
+    dir_prefix = url_for("directories.list_root_directory")
+    file_prefix = url_for("directories.view_file", filepath="_")[:-1]
+    thumb_prefix = url_for("directories.thumbnail", filepath="_")[:-1]
+
+    dir_entries = []
+    for name in directories:
+        path = prefix + name
+        dir_entries.append({
+            "name": name,
+            "path": path,
+            "url": f"{dir_prefix}{quote(path)}/",
+        })
+
+    file_entries = []
+    for f in files:
+        path = prefix + f["name"]
+        icon_class = icon_class_for(f["name"], f.get("mime_type"))
+        entry = dict(f)
+        entry.update({
+            "path": path,
+            "url": file_prefix + quote(path),
+            "icon_class": icon_class,
+            "display_size": display_size(f.get("size")),
+            "thumb_url": None,
+        })
+        if thumbnails.enabled and f.get("mime_type") in thumbnails.SUPPORTED_MIME_TYPES:
+            entry["thumb_url"] = f"{thumb_prefix}{quote(path)}?size=128"
+        file_entries.append(entry)
+
+    return dir_entries, file_entries
@@ -0,0 +1,181 @@
+# ftp/logs.py
+# Logging for the server and for the Go service it starts.
+#
+# Modules log through logging.getLogger(__name__) ("ftp.models",
+# "ftp.routes.directories", ...; the Go relay uses "ftp.go"). Requests never
+# write to stdout themselves: records go onto a bounded queue and a
+# background thread writes them out. If that thread falls behind, records
+# are dropped and counted instead of making requests wait.
+#
+#   LOG_LEVEL        DEBUG, INFO (default), WARNING or ERROR
+#   LOG_FORMAT       "text" (default, coloured on a terminal) or "json"
+#   LOG_DEBUG_RATE   debug lines per second kept from any one call site
+#                    (default 5, 0 = no limit)
+
+import copy
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+import atexit
+from colorama import Fore, Style
+
+QUEUE_SIZE = 10000
+
+LEVEL_COLOURS = {
+    logging.DEBUG: Fore.CYAN,
+    logging.INFO: Fore.GREEN,
+    logging.WARNING: Fore.YELLOW,
+    logging.ERROR: Fore.RED,
+    logging.CRITICAL: Fore.RED,
+}
+
+# Attributes every LogRecord has; anything else was passed with extra=...
+_RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "tag"}
+
+_handler = None
+_listener = None
+_output = None
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records rather than block when the queue is full."""
+
+    def __init__(self, records):
+        super().__init__(records)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        # Render the message here, while its arguments are still what the
+        # caller meant; keep the traceback as text so the writer can format it.
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        record.stack_info = None
+        return record
+
+
+class DebugRateFilter(logging.Filter):
+    """
+    Keeps at most `rate` debug records per second from each call site. The
+    next record that gets through carries how many were skipped.
+    """
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._sites = {}   # (pathname, lineno) -> (window start, kept, skipped)
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self.rate <= 0:
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            started, kept, skipped = self._sites.get(key, (now, 0, 0))
+            if now - started >= 1.0:
+                started, kept = now, 0
+            if kept >= self.rate:
+                self._sites[key] = (started, kept, skipped + 1)
+                return False
+            self._sites[key] = (started, kept + 1, 0)
+        if skipped:
+            record.skipped = skipped
+        return True
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self, colour=False):
+        super().__init__("%(asctime)s %(tag)s %(name)s: %(message)s")
+        self.colour = colour
+
+    def format(self, record):
+        if self.colour:
+            record.tag = f"{LEVEL_COLOURS.get(record.levelno, '')}[{record.levelname}]{Style.RESET_ALL}"
+        else:
+            record.tag = f"[{record.levelname}]"
+        text = super().format(record)
+        if getattr(record, "skipped", 0):
+            text += f" ({record.skipped} similar lines skipped)"
+        return text
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+def init_logging():
+    """Set up the "ftp" logger tree. Safe to call more than once."""
+    global _handler, _output
+    if _handler is not None:
+        return
+
+    _output = logging.StreamHandler(sys.stdout)
+    if os.getenv("LOG_FORMAT", "text").lower() == "json":
+        _output.setFormatter(JsonFormatter())
+    else:
+        _output.setFormatter(TextFormatter(colour=sys.stdout.isatty()))
+
+    _handler = DroppingQueueHandler(queue.Queue(QUEUE_SIZE))
+    _handler.addFilter(DebugRateFilter(float(os.getenv("LOG_DEBUG_RATE", 5))))
+
+    logger = logging.getLogger("ftp")
+    logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+    logger.addHandler(_handler)
+    logger.propagate = False
+
+    _start_listener()
+    atexit.register(_stop_listener)
+    if hasattr(os, "register_at_fork"):
+        # The writer thread does not survive fork (gunicorn workers); give
+        # each child its own queue and writer
+        os.register_at_fork(after_in_child=_after_fork)
+
+
+def _start_listener():
+    global _listener
+    _listener = logging.handlers.QueueListener(_handler.queue, _output)
+    _listener.start()
+
+
+def _stop_listener():
+    if _listener is not None and _listener._thread is not None:
+        _listener.stop()   # writes out whatever is still queued
+    if _handler is not None and _handler.dropped:
+        _output.stream.write(f"[WARNING] {_handler.dropped} log records were dropped\n")
+        _output.flush()
+
+
+def _after_fork():
+    if _handler is None:
+        return
+    _handler.queue = queue.Queue(QUEUE_SIZE)
+    _handler.dropped = 0
+    _start_listener()
@@ -0,0 +1,305 @@
+# ftp/metrics.py
+# Prometheus-style metrics, served as text at /metrics.
+#
+# Recording is lock-free on the hot path: every thread writes into its own
+# shard of each metric, and the shards are only summed when /metrics is
+# scraped. A thread takes a lock once, the first time it touches a metric,
+# to register its shard.
+#
+# Values are per process. Under the gunicorn or uvicorn multi-worker
+# profiles each scrape sees the worker that answered it.
+
+import bisect
+import threading
+import time
+from flask import Response, g, request
+import ftp.profiling as profiling
+
+# Seconds; covers a cached listing (~1ms) up to a slow upstream (30s timeout)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+COUNT_BUCKETS = (1, 10, 100, 1000, 10000, 100000)
+
+registry = []
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards = []
+        self._shards_lock = threading.Lock()
+        registry.append(self)
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._shards_lock:
+                self._shards.append(shard)
+            return shard
+
+    def _snapshot(self):
+        with self._shards_lock:
+            shards = list(self._shards)
+        # Shards belong to other threads that may add keys while we read
+        return [dict(shard) for shard in shards]
+
+    def _labels(self, values, extra=()):
+        pairs = list(zip(self.labelnames, values)) + list(extra)
+        if not pairs:
+            return ""
+        body = ",".join(f'{k}="{_escape(v)}"' for k, v in pairs)
+        return "{" + body + "}"
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def samples(self):
+        totals = {}
+        for shard in self._snapshot():
+            for labels, value in shard.items():
+                totals[labels] = totals.get(labels, 0) + value
+        for labels, value in sorted(totals.items()):
+            yield f"{self.name}{self._labels(labels)} {_number(value)}"
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS, server_timing=None):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+        self.server_timing = server_timing   # also report as this Server-Timing phase
+
+    def observe(self, value, *labels):
+        if self.server_timing is not None:
+            profiling.add_timing(self.server_timing, value)
+        shard = self._shard()
+        counts = shard.get(labels)
+        if counts is None:
+            # one slot per bucket, then +Inf, then the running sum
+            counts = shard[labels] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def samples(self):
+        totals = {}
+        for shard in self._snapshot():
+            for labels, counts in shard.items():
+                merged = totals.setdefault(labels, [0] * len(counts))
+                for i, v in enumerate(list(counts)):
+                    merged[i] += v
+        for labels, counts in sorted(totals.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else _number(bound)
+                yield f"{self.name}_bucket{self._labels(labels, [('le', le)])} {cumulative}"
+            yield f"{self.name}_sum{self._labels(labels)} {_number(counts[-1])}"
+            yield f"{self.name}_count{self._labels(labels)} {cumulative}"
+
+
+class Gauge(_Metric):
+    """Read at scrape time from `fn`, which returns a number or {labels: number}."""
+    kind = "gauge"
+
+    def __init__(self, name, help, fn, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self.fn = fn
+
+    def samples(self):
+        try:
+            value = self.fn()
+        except Exception:
+            return
+        if not isinstance(value, dict):
+            value = {(): value}
+        for labels, v in sorted(value.items()):
+            yield f"{self.name}{self._labels(labels)} {_number(v)}"
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value):
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+# Requests
+REQUESTS = Counter("ftp_requests_total", "Requests handled, by endpoint and status.", ("endpoint", "method", "status"))
+REQUEST_SECONDS = Histogram(
+    "ftp_request_duration_seconds",
+    "Time from receiving a request until its response headers are ready.",
+    ("endpoint",)
+)
+
+# Directory scans
+SCAN_SECONDS = Histogram("ftp_directory_scan_seconds", "Time spent in scan_physical_directory.", server_timing="scan")
+SCAN_ENTRIES = Histogram("ftp_directory_scan_entries", "Entries found per directory scan.", buckets=COUNT_BUCKETS)
+
+# Go proxy
+UPSTREAM_SECONDS = Histogram(
+    "ftp_upstream_duration_seconds",
+    "Time until the Go service answered with response headers.",
+    ("status",),
+    server_timing="go"
+)
+PROXY_BYTES = Counter("ftp_proxy_bytes_total", "Body bytes streamed from the Go service to clients.")
+UPSTREAM_ERRORS = Counter("ftp_upstream_errors_total", "Failed requests to the Go service.", ("reason",))
+
+# SQLite
+DB_QUERY_SECONDS = Histogram("ftp_db_query_duration_seconds", "Time spent executing SQLite statements.", server_timing="db")
+
+# Caches
+CACHE_LOOKUPS = Counter("ftp_cache_lookups_total", "Cache lookups, by cache and result (hit/miss).", ("cache", "result"))
+
+
+def _hot_cache_bytes():
+    from ftp import hotcache
+    return hotcache.cached_bytes()
+
+
+HOT_CACHE_BYTES = Gauge("ftp_hot_cache_bytes", "File data held in the in-memory hot cache.", _hot_cache_bytes)
+
+# Admission control
+ADMISSION_REJECTED = Counter(
+    "ftp_admission_rejected_total",
+    "Requests shed by admission control, by route class and reason (rate/busy).",
+    ("class", "reason")
+)
+ADMISSION_WAIT_SECONDS = Histogram(
+    "ftp_admission_wait_seconds",
+    "Time requests waited for a slot in their route class.",
+    ("class",)
+)
+
+
+def _admission_in_flight():
+    from ftp import admission
+    return admission.in_flight()
+
+
+def _admission_queued():
+    from ftp import admission
+    return admission.queued()
+
+
+ADMISSION_IN_FLIGHT = Gauge(
+    "ftp_admission_in_flight", "Requests holding a slot, by route class.", _admission_in_flight, ("class",)
+)
+ADMISSION_QUEUED = Gauge(
+    "ftp_admission_queued", "Requests waiting for a slot, by route class.", _admission_queued, ("class",)
+)
+
+
+# Delta uploads
+DELTA_BYTES = Counter(
+    "ftp_delta_bytes_total",
+    "Bytes of files rebuilt from delta uploads, by where they came from (sent/reused).",
+    ("source",)
+)
+
+# Bandwidth shaping
+SHAPING_DELAY_SECONDS = Counter(
+    "ftp_shaping_delay_seconds_total",
+    "Time bulk transfers were held back by bandwidth shaping, by transfer kind (raw/download).",
+    ("kind",)
+)
+
+
+def _shaped_transfers():
+    from ftp import shaping
+    return shaping.active_transfers()
+
+
+SHAPED_TRANSFERS = Gauge(
+    "ftp_shaped_transfers", "Bulk transfers being paced, by transfer kind.", _shaped_transfers, ("kind",)
+)
+
+
+def _backend_up():
+    from ftp import backends
+    return backends.health()
+
+
+def _backend_in_flight():
+    from ftp import backends
+    return backends.in_flight()
+
+
+GO_SERVICE_UP = Gauge(
+    "ftp_go_service_up", "Whether each Go backend passed its last health check.", _backend_up, ("backend",)
+)
+GO_BACKEND_IN_FLIGHT = Gauge(
+    "ftp_go_backend_in_flight", "Transfers in progress, by Go backend.", _backend_in_flight, ("backend",)
+)
+
+
+def init_app(app):
+    app.before_request(_start_timer)
+    app.after_request(_record_request)
+    app.add_url_rule("/metrics", "metrics", metrics_view)
+
+
+def observe_request(endpoint, method, status, seconds):
+    REQUESTS.inc(endpoint, method, str(status))
+    REQUEST_SECONDS.observe(seconds, endpoint)
+
+
+def count_bytes(chunks, counter):
+    """Pass `chunks` through, adding their sizes to `counter`."""
+    for chunk in chunks:
+        counter.inc(amount=len(chunk))
+        yield chunk
+
+
+def _start_timer():
+    g.metrics_started = time.perf_counter()
+
+
+def _record_request(response):
+    started = g.get("metrics_started")
+    if started is not None:
+        observe_request(request.endpoint or "unmatched", request.method, response.status_code,
+                        time.perf_counter() - started)
+    return response
+
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.samples())
+    return "\n".join(lines) + "\n"
+
+
+def metrics_view():
+    return Response(render(), mimetype="text/plain; version=0.0.4")
@@ -1,12 +1,15 @@
 # ftp/models.py
 from contextlib import contextmanager
-import shutil
+import logging
 import sqlite3
 import time
 import datetime
 from flask import current_app
 import os 
 from werkzeug.utils import secure_filename
+import ftp.metrics as metrics
+
+log = logging.getLogger(__name__)
 
 upload_base_path = None
 
@@ -14,9 +17,29 @@ def init_app(app):
     global upload_base_path
     upload_base_path = app.config["UPLOAD_BASE_PATH"]
 
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that records statement execution time in the metrics."""
+
+    def execute(self, *args):
+        with metrics.DB_QUERY_SECONDS.time():
+            return super().execute(*args)
+
+    def executemany(self, *args):
+        with metrics.DB_QUERY_SECONDS.time():
+            return super().executemany(*args)
+
+
+class TimedConnection(sqlite3.Connection):
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+
 @contextmanager
 def get_db_connection():
-    conn = sqlite3.connect("ftp.db")
+    conn = sqlite3.connect("ftp.db", factory=TimedConnection)
     conn.row_factory = sqlite3.Row 
     try:
         yield conn
@@ -27,34 +50,38 @@ def get_db_connection():
     finally:
         conn.close()
 
+def children_where(path):
+    """WHERE clause and arguments matching every `path` column value below `path`."""
+    return "path > ? AND path < ?", (path + "/", path + "0")   # "0" sorts right after "/"
+
 def get_directory_contents(path=None):
     """
     Fetch directories and files for a given directory.
     Returns two lists: directories and files.
     """
-    print(f"Fetching contents for directory path: '{path or 'root'}'")
+    log.debug("Fetching contents for directory path: '%s'", path or 'root')
     with get_db_connection() as conn:
         cursor = conn.cursor()
 
         # Get directory id
         if path is None or path == "root":
             dir_id = None  # root directory
-            print("Target is root directory (dir_id=None)")
+            log.debug("Target is root directory (dir_id=None)")
         else:
             parts = path.strip("/").split("/")
             dir_id = None
             for part in parts:
-                print(f"Looking up directory '{part}' with parent_id {dir_id}")
+                log.debug("Looking up directory '%s' with parent_id %s", part, dir_id)
                 cursor.execute(
                     "SELECT id FROM directories WHERE name=? AND parent_id IS ?",
                     (part, dir_id)
                 )
                 row = cursor.fetchone()
                 if row is None:
-                    print(f"Directory path '{path}' does not exist")
+                    log.warning("Directory path '%s' does not exist", path)
                     return None, None  # Path does not exist
                 dir_id = row["id"]
-            print(f"Found directory ID: {dir_id}")
+            log.debug("Found directory ID: %s", dir_id)
 
         # Fetch subdirectories
         if dir_id is None:
@@ -62,7 +89,7 @@ def get_directory_contents(path=None):
         else:
             cursor.execute("SELECT name FROM directories WHERE parent_id = ?", (dir_id,))
         directories = [r["name"] for r in cursor.fetchall()]
-        print(f"Found subdirectories: {directories}")
+        log.debug("Found %d subdirectories", len(directories))
 
         # Fetch files
         if dir_id is None:
@@ -70,7 +97,7 @@ def get_directory_contents(path=None):
         else:
             cursor.execute("SELECT name, mime_type FROM files WHERE directory_id = ?", (dir_id,))
         files = [{"name": r["name"], "mime_type": r["mime_type"]} for r in cursor.fetchall()]
-        print(f"Found files: {[f['name'] for f in files]}")
+        log.debug("Found %d files", len(files))
 
     return directories, files
 
@@ -81,17 +108,17 @@ def ensure_directory_exists(path):
     Only create and return IDs for non-root directories.
     """
     if not path or path == "root":
-        print("Path is root or empty, returning None as directory ID")
+        log.debug("Path is root or empty, returning None as directory ID")
         return None
 
-    print(f"Ensuring directory path '{path}' exists in DB")
+    log.debug("Ensuring directory path '%s' exists in DB", path)
     with get_db_connection() as conn:
         cursor = conn.cursor()
         dir_id = None
         parts = path.strip("/").split("/")
 
         for part in parts:
-            print(f"Looking for directory '{part}' with parent_id {dir_id}")
+            log.debug("Looking for directory '%s' with parent_id %s", part, dir_id)
             cursor.execute(
                 "SELECT id FROM directories WHERE name = ? AND parent_id IS ?",
                 (part, dir_id)
@@ -99,18 +126,36 @@ def ensure_directory_exists(path):
             row = cursor.fetchone()
             if row:
                 dir_id = row["id"]
-                print(f"Found existing directory '{part}' with ID {dir_id}")
+                log.debug("Found existing directory '%s' with ID %s", part, dir_id)
             else:
-                print(f"Directory '{part}' not found. Creating new one")
+                log.debug("Directory '%s' not found. Creating new one", part)
                 cursor.execute(
                     "INSERT INTO directories (name, parent_id) VALUES (?, ?)",
                     (part, dir_id)
                 )
                 dir_id = cursor.lastrowid
                 conn.commit()
-                print(f"Created directory '{part}' with new ID {dir_id}")
+                log.debug("Created directory '%s' with new ID %s", part, dir_id)
 
-    print(f"Final directory ID for path '{path}' is {dir_id}")
+    log.debug("Final directory ID for path '%s' is %s", path, dir_id)
+    return dir_id
+
+
+def lookup_directory_id(cursor, parts):
+    """
+    Directory ID for a list of path components, using an open cursor.
+    Returns None for root and False if a directory has no row.
+    """
+    dir_id = None
+    for part in parts:
+        cursor.execute(
+            "SELECT id FROM directories WHERE name=? AND parent_id IS ?",
+            (part, dir_id)
+        )
+        row = cursor.fetchone()
+        if row is None:
+            return False
+        dir_id = row["id"]
     return dir_id
 
 
@@ -120,9 +165,9 @@ def save_file_to_directory(file, dirpath):
     and also save the physical file in the folder structure.
     """
     dir_to_use = dirpath or "root"
-    print(f"Ensuring directory '{dir_to_use}' exists in DB")
+    log.debug("Ensuring directory '%s' exists in DB", dir_to_use)
     dir_id = ensure_directory_exists(dir_to_use)
-    print(f"Directory ID obtained: {dir_id}")
+    log.debug("Directory ID obtained: %s", dir_id)
 
     try:
         # Read file content for BLOB saving
@@ -131,7 +176,7 @@ def save_file_to_directory(file, dirpath):
 
         creation_date = datetime.datetime.utcnow()
 
-        print(f"Saving file '{file.filename}' metadata into database")
+        log.debug("Saving file '%s' metadata into database", file.filename)
         db_path = current_app.config["DATABASE"]
         with sqlite3.connect(db_path) as conn:
             cursor = conn.cursor()
@@ -146,26 +191,26 @@ def save_file_to_directory(file, dirpath):
                 )
             )
             conn.commit()
-            print(f"Metadata for '{file.filename}, {file.mimetype}, {file_content}, {dir_id}, {creation_date}' saved successfully in DB")
+            log.info("Metadata for '%s' (%s, %d bytes) saved in DB", file.filename, file.mimetype, len(file_content))
 
     except Exception as e:
-        print(f"[ERROR] Failed to save metadata: {e}")
+        log.error("Failed to save metadata: %s", e)
         raise
 
     # Physical file saving
     try:
         physical_dir = upload_base_path if dir_to_use == "root" else os.path.join(upload_base_path, dir_to_use)
-        print(f"Ensuring physical directory '{physical_dir}' exists")
+        log.debug("Ensuring physical directory '%s' exists", physical_dir)
         os.makedirs(physical_dir, exist_ok=True)
 
         filename = secure_filename(file.filename)
         physical_file_path = os.path.join(physical_dir, filename)
-        print(f"Saving physical file to '{physical_file_path}'")
+        log.debug("Saving physical file to '%s'", physical_file_path)
         file.save(physical_file_path)
-        print(f"Physical file saved successfully")
+        log.debug("Physical file saved successfully")
 
     except Exception as e:
-        print(f"[ERROR] Failed to save physical file: {e}")
+        log.error("Failed to save physical file: %s", e)
         raise
 
 def save_file_from_folder(file, path):
@@ -178,33 +223,49 @@ def save_file_from_folder(file, path):
     dirname = "/".join(parts[:-1]) if len(parts) > 1 else None
     filename = parts[-1]
 
-    print(f"Saving file '{filename}' to path '{path}'")
+    log.debug("Saving file '%s' to path '%s'", filename, path)
 
     try:
         with get_db_connection() as conn:
             cursor = conn.cursor()
-            print("Database connection opened")
+            log.debug("Database connection opened")
 
             dir_id = None
             if dirname:
-                print(f"Ensuring directory '{dirname}' exists")
+                log.debug("Ensuring directory '%s' exists", dirname)
                 dir_id = ensure_directory_exists(dirname)
-                print(f"Directory ID obtained: {dir_id}")
+                log.debug("Directory ID obtained: %s", dir_id)
 
             creation_date = datetime.datetime.utcnow()
 
-            print(f"Inserting file metadata into database")
+            log.debug("Inserting file metadata into database")
             cursor.execute(
                 "INSERT INTO files (name, mime_type, directory_id, creation_date) VALUES (?, ?, ?, ?)",
                 (filename, file.mimetype, dir_id, creation_date.isoformat())
             )
             conn.commit()
-            print(f"Metadata for '{filename}' saved successfully in DB")
+            log.info("Metadata for '%s' saved successfully in DB", filename)
 
     except Exception as e:
-        print(f"[ERROR] Failed to save file metadata: {e}")
+        log.error("Failed to save file metadata: %s", e)
         raise
 
+def save_file_metadata(path, mime_type, size):
+    """
+    Record a file that was written straight to disk, replacing any row it
+    already had. The content stays on disk only.
+    """
+    parts = path.strip("/").split("/")
+    dir_id = ensure_directory_exists("/".join(parts[:-1]))
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM files WHERE name=? AND directory_id IS ?", (parts[-1], dir_id))
+        cursor.execute(
+            "INSERT INTO files (name, mime_type, size, directory_id, creation_date) VALUES (?, ?, ?, ?, ?)",
+            (parts[-1], mime_type, size, dir_id, datetime.datetime.utcnow().isoformat())
+        )
+    log.debug("Metadata for '%s' (%s, %d bytes) saved in DB", path, mime_type, size)
+
 def create_directory_in_db(parent_path, new_dir_path):
     with get_db_connection() as conn:
         # Create cursor inside the same context
@@ -276,7 +337,7 @@ def get_file_from_db(filepath):
     """
     Retrieve file content, MIME type, size, and timestamps from DB by full path.
     """
-    print(f"Retrieving file from DB at path: '{filepath}'")
+    log.debug("Retrieving file from DB at path: '%s'", filepath)
     with get_db_connection() as conn:
         cursor = conn.cursor()
 
@@ -284,18 +345,18 @@ def get_file_from_db(filepath):
         filename = parts[-1]
         dir_path_parts = parts[:-1]
 
-        print(f"Filename: '{filename}', Directory parts: {dir_path_parts}")
+        log.debug("Filename: '%s', Directory parts: %s", filename, dir_path_parts)
 
         parent_id = None
         for part in dir_path_parts:
-            print(f"Looking up directory '{part}' with parent_id {parent_id}")
+            log.debug("Looking up directory '%s' with parent_id %s", part, parent_id)
             cursor.execute(
                 "SELECT id FROM directories WHERE name=? AND parent_id IS ?",
                 (part, parent_id)
             )
             row = cursor.fetchone()
             if row is None:
-                print(f"Directory '{part}' not found. File path invalid.")
+                log.warning("Directory '%s' not found. File path invalid.", part)
                 return None
             parent_id = row["id"]
 
@@ -309,7 +370,7 @@ def get_file_from_db(filepath):
             (filename, parent_id)
         )
         row = cursor.fetchone()
-        print(f"Query result for file '{filename}': {row is not None}")
+        log.debug("Query result for file '%s': %s", filename, row is not None)
 
         if row:
             return {
@@ -319,94 +380,3 @@ def get_file_from_db(filepath):
                 "created_at": row["created_at"]
             }
         return None
-
-def delete_file_from_db_and_disk(filepath):
-    if filepath.startswith("root/"):
-        filepath = filepath[5:]
-    elif filepath == "root":
-        raise ValueError("Cannot delete root")
-
-    physical_path = os.path.join(upload_base_path, filepath)
-    print(f"Deleting file '{filepath}' at physical path '{physical_path}'")
-
-    # Delete physical file
-    if os.path.exists(physical_path):
-        os.remove(physical_path)
-        print(f"Physical file deleted: {physical_path}")
-    else:
-        print(f"Physical file does not exist: {physical_path}")
-
-    # Delete from DB
-    parts = filepath.strip("/").split("/")
-    filename = parts[-1]
-    dir_parts = parts[:-1]
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        parent_id = None
-        for part in dir_parts:
-            cursor.execute(
-                "SELECT id FROM directories WHERE name=? AND parent_id IS ?",
-                (part, parent_id)
-            )
-            row = cursor.fetchone()
-            if not row:
-                raise ValueError(f"Directory '{'/'.join(dir_parts)}' does not exist in DB.")
-            parent_id = row["id"]
-
-        cursor.execute(
-            "DELETE FROM files WHERE name=? AND directory_id IS ?",
-            (filename, parent_id)
-        )
-        print(f"Deleted file '{filename}' from DB")
-
-def delete_directory_from_db_and_disk(dirpath):
-    if dirpath.startswith("root/"):
-        dirpath = dirpath[5:]
-    elif dirpath == "root":
-        raise ValueError("Cannot delete root directory")
-
-    physical_path = os.path.join(upload_base_path, dirpath)
-    print(f"Deleting directory '{dirpath}' at physical path '{physical_path}'")
-
-    # Delete physical directory recursively
-    if os.path.exists(physical_path):
-        shutil.rmtree(physical_path)
-        print(f"Physical directory deleted: {physical_path}")
-    else:
-        print(f"Physical directory does not exist: {physical_path}")
-
-    # Delete from DB recursively using a single connection
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-
-        # Find directory ID
-        parts = dirpath.strip("/").split("/")
-        parent_id = None
-        for part in parts:
-            cursor.execute(
-                "SELECT id FROM directories WHERE name=? AND parent_id IS ?",
-                (part, parent_id)
-            )
-            row = cursor.fetchone()
-            if not row:
-                raise ValueError(f"Directory '{dirpath}' does not exist in DB.")
-            parent_id = row["id"]
-
-        # Recursive deletion function
-        def delete_dir_recursive(cursor, parent_id):
-            # Delete files in this directory
-            cursor.execute("DELETE FROM files WHERE directory_id=?", (parent_id,))
-            print(f"Deleted files in directory ID {parent_id}")
-
-            # Find subdirectories
-            cursor.execute("SELECT id FROM directories WHERE parent_id=?", (parent_id,))
-            subdirs = cursor.fetchall()
-            for subdir in subdirs:
-                delete_dir_recursive(cursor, subdir["id"])
-
-            # Delete the directory itself
-            cursor.execute("DELETE FROM directories WHERE id=?", (parent_id,))
-            print(f"Deleted directory ID {parent_id}")
-
-        delete_dir_recursive(cursor, parent_id)
-        print(f"Finished deleting directory '{dirpath}' and all nested contents")
\ No newline at end of file
@@ -0,0 +1,283 @@
+# ftp/profiling.py
+# Where did the time go for this request?
+#
+# Every response carries a Server-Timing header with the main phases
+# (directory scan, SQLite, template rendering, the Go hop and the total),
+# which browsers show in the network panel next to the request.
+#
+# For deeper digging an admin can arm a capture for the next N requests
+# whose path matches a pattern:
+#
+#   curl -X POST -H "Authorization: Bearer $ADMIN_TOKEN" \
+#        -d count=5 -d match='^/photos/' -d mode=cprofile -d memory=1 \
+#        http://host/admin/profile
+#
+# Each matching request is profiled with cProfile (mode=cprofile, a .prof
+# file for pstats/snakeviz) or a stack sampler (mode=sample, folded stacks
+# for flamegraph.pl/speedscope). With memory=1 a tracemalloc snapshot of
+# the request is written as well. Files go to PROFILE_PATH. The endpoints
+# do not exist unless ADMIN_TOKEN is set, and nothing is checked per
+# request beyond one global while no capture is armed.
+
+import collections
+import cProfile
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from flask import abort, before_render_template, g, has_request_context, jsonify, request, template_rendered
+import ftp
+
+log = logging.getLogger(__name__)
+
+TIMING_DESCRIPTIONS = {
+    "scan": "Directory scan",
+    "db": "SQLite",
+    "render": "Templates",
+    "go": "Go service",
+    "app": "Total",
+}
+MAX_CAPTURES = 100
+SAMPLE_INTERVAL = 0.005  # seconds between stack samples
+
+profile_path = None
+
+_armed = None            # Plan while a capture is armed, else None
+_armed_lock = threading.Lock()
+_memory_captures = 0     # requests currently being traced by tracemalloc
+
+
+def init_app(app):
+    global profile_path
+    profile_path = app.config["PROFILE_PATH"]
+
+    app.before_request(_before_request)
+    app.after_request(_server_timing)
+    app.teardown_request(_finish_capture)
+    before_render_template.connect(_render_started, app)
+    template_rendered.connect(_render_finished, app)
+
+    if app.config["ADMIN_TOKEN"]:
+        app.add_url_rule("/admin/profile", "admin_profile", admin_profile, methods=["GET", "POST", "DELETE"])
+
+
+# Server-Timing
+
+def add_timing(name, seconds):
+    """Add `seconds` to phase `name` of the current request, if there is one."""
+    if has_request_context():
+        timings = g.setdefault("server_timing", {})
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+def format_server_timing(timings):
+    parts = []
+    for name, seconds in timings.items():
+        desc = TIMING_DESCRIPTIONS.get(name)
+        desc = f';desc="{desc}"' if desc else ""
+        parts.append(f"{name}{desc};dur={seconds * 1000:.2f}")
+    return ", ".join(parts)
+
+
+def _render_started(sender, template, context, **extra):
+    g.render_started = time.perf_counter()
+
+
+def _render_finished(sender, template, context, **extra):
+    started = g.pop("render_started", None)
+    if started is not None:
+        add_timing("render", time.perf_counter() - started)
+
+
+def _server_timing(response):
+    timings = g.pop("server_timing", {})
+    started = g.get("request_started")
+    if started is not None:
+        timings["app"] = time.perf_counter() - started
+    if timings:
+        response.headers["Server-Timing"] = format_server_timing(timings)
+    return response
+
+
+# Captures
+
+class Plan:
+    def __init__(self, count, pattern, mode, memory):
+        self.remaining = count
+        self.pattern = pattern
+        self.mode = mode
+        self.memory = memory
+
+    def describe(self):
+        return {
+            "remaining": self.remaining,
+            "match": self.pattern.pattern,
+            "mode": self.mode,
+            "memory": self.memory,
+        }
+
+
+class _StackSampler(threading.Thread):
+    """Samples one thread's stack every few milliseconds into folded stacks."""
+
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL):
+        super().__init__(name="profile-sampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def dump(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class _Capture:
+    def __init__(self, plan):
+        self.mode = plan.mode
+        self.memory = plan.memory
+        self.profiler = None
+        self.sampler = None
+        self.memory_before = None
+
+    def start(self):
+        global _memory_captures
+        if self.memory:
+            with _armed_lock:
+                _memory_captures += 1
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start(25)
+            self.memory_before = tracemalloc.take_snapshot()
+        if self.mode == "sample":
+            self.sampler = _StackSampler(threading.get_ident())
+            self.sampler.start()
+        else:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def finish(self, name):
+        if self.profiler is not None:
+            self.profiler.disable()
+        if self.sampler is not None:
+            self.sampler.stop()
+
+        os.makedirs(profile_path, exist_ok=True)
+        base = os.path.join(profile_path, name)
+        written = []
+        if self.profiler is not None:
+            self.profiler.dump_stats(base + ".prof")
+            written.append(base + ".prof")
+        if self.sampler is not None:
+            self.sampler.dump(base + ".folded")
+            written.append(base + ".folded")
+        if self.memory_before is not None:
+            snapshot = tracemalloc.take_snapshot()
+            snapshot.dump(base + ".tracemalloc")
+            with open(base + ".memory.txt", "w", encoding="utf-8") as f:
+                for stat in snapshot.compare_to(self.memory_before, "lineno")[:50]:
+                    f.write(f"{stat}\n")
+            written += [base + ".tracemalloc", base + ".memory.txt"]
+        return written
+
+    def release(self):
+        global _memory_captures
+        if not self.memory:
+            return
+        with _armed_lock:
+            _memory_captures -= 1
+            _stop_tracing_if_idle()
+
+
+def _stop_tracing_if_idle():
+    # Tracing slows every allocation down, so it only runs while needed.
+    # Called with _armed_lock held.
+    if _memory_captures == 0 and (_armed is None or not _armed.memory) and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def _claim_capture():
+    """Take one capture from the armed plan if this request matches it."""
+    global _armed
+    with _armed_lock:
+        plan = _armed
+        if plan is None or not plan.pattern.search(request.path):
+            return None
+        plan.remaining -= 1
+        if plan.remaining <= 0:
+            _armed = None
+        return plan
+
+
+def _before_request():
+    g.request_started = time.perf_counter()
+    if _armed is None:
+        return
+    plan = _claim_capture()
+    if plan is not None:
+        g.profile_capture = _Capture(plan)
+        g.profile_capture.start()
+
+
+def _finish_capture(exc):
+    capture = g.pop("profile_capture", None)
+    if capture is None:
+        return
+    endpoint = (request.endpoint or "unmatched").replace(".", "-")
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}-{int(time.time() * 1000) % 1000:03d}-{os.getpid()}-{endpoint}"
+    try:
+        written = capture.finish(name)
+        log.info("Profiled %s %s -> %s", request.method, request.path, ", ".join(written))
+    except Exception:
+        log.exception("Failed to save profile for %s", request.path)
+    finally:
+        capture.release()
+
+
+def admin_profile():
+    global _armed
+    ftp.require_admin()
+
+    if request.method == "POST":
+        try:
+            count = max(1, min(MAX_CAPTURES, int(request.values.get("count", 1))))
+            pattern = re.compile(request.values.get("match", ""))
+        except (ValueError, re.error):
+            abort(400)
+        mode = request.values.get("mode", "cprofile")
+        if mode not in ("cprofile", "sample"):
+            abort(400)
+        memory = request.values.get("memory", "0").lower() in ("1", "true", "yes", "on")
+        with _armed_lock:
+            _armed = Plan(count, pattern, mode, memory)
+            _stop_tracing_if_idle()
+        log.info("Profiling armed: %s", _armed.describe())
+    elif request.method == "DELETE":
+        with _armed_lock:
+            _armed = None
+            _stop_tracing_if_idle()
+
+    plan = _armed
+    try:
+        captures = sorted(os.listdir(profile_path))
+    except FileNotFoundError:
+        captures = []
+    return jsonify(armed=plan.describe() if plan else None, path=os.path.abspath(profile_path), captures=captures)
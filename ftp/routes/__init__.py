@@ -4,6 +4,7 @@
 
 # Import blueprints for routes
 from .directories import bp as directories_bp
+from .files import bp as files_bp
 
 def register_routes(app):
     """
@@ -13,6 +14,8 @@ def register_routes(app):
     # For example, if url_prefix="/", the route @bp.route("/") in directories.py
     # will respond to GET requests at "/".
     app.register_blueprint(directories_bp, url_prefix="/")
+    # PUT and DELETE on the same URLs; browsing stays GET in directories_bp
+    app.register_blueprint(files_bp, url_prefix="/")
 
 
     
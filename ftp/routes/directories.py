@@ -4,32 +4,45 @@
 # and uses hypermedia.py to render the response with headers.
 
 import io
+import logging
 import requests
 import mimetypes
 import datetime
+import time
 from pathlib import Path
 from flask import current_app
 from flask import Response, abort
-from flask import Blueprint, abort, flash, render_template, request, redirect, send_file, url_for
+from flask import Blueprint, abort, flash, jsonify, render_template, request, redirect, send_file, url_for
 from ftp.models import *
 from ftp.routes.hypermedia import hypermedia_response, hypermedia_file_response
+import ftp.backends as backends
+import ftp.caching as caching
+import ftp.fileops as fileops
+import ftp.hashes as hashes
+import ftp.hotcache as hotcache
+import ftp.jobs as jobs
+import ftp.journal as journal
+import ftp.metrics as metrics
+import ftp.search as search
+import ftp.tail as tail
+import ftp.thumbnails as thumbnails
+import ftp.trash as trash
 import os 
+from urllib.parse import quote
 from werkzeug.exceptions import HTTPException
 from werkzeug.utils import secure_filename
-from colorama import init, Fore, Style
+from werkzeug.wsgi import ClosingIterator
+
+log = logging.getLogger(__name__)
 
 base_path = None
 upload_base_path = None
 
 def init_app(app):
-    global base_path, go_file_server_url
+    global base_path
 
     base_path = app.config["BASE_PATH"]
-    go_file_server_url = app.config["GO_FILE_SERVER_URL"]
     
-# Initialize Colorama
-init(autoreset=True)
-
 # 510 status code from HTTPException
 # 510 is not a standard HTTP status code, hence Flask doesn't recongize it
 class NotExtended(HTTPException):
@@ -41,152 +54,234 @@ class NotExtended(HTTPException):
 # No url_prefix here; it will be set when registering the blueprint in __init__.py
 bp = Blueprint("directories", __name__) 
 
+HOP_BY_HOP_HEADERS = {"connection", "keep-alive", "transfer-encoding", "te", "trailer", "upgrade"}
+
 @bp.route("/raw/<path:filepath>", methods=["GET"], endpoint="serve_file")
 def proxy_to_file_rendering(filepath):
-    go_url = f"{go_file_server_url}/raw/{filepath}"
-    try:
-
-        headers = {}
-        if "Range" in request.headers:
-            headers["Range"] = request.headers["Range"]
+    if trash.is_hidden(filepath):
+        abort(404)
 
-        print(f"[DEBUG] Proxying file request to Go: {go_url}")
-        r = requests.get(go_url, stream=True, headers=headers, timeout=(5, 30))
-        
-        if r.status_code == 404:
-            print(f"[WARN] File not found on Go server: {filepath}")
+    # Small popular files are answered from memory, without the Go hop
+    entry = hotcache.lookup_file(filepath)
+    if entry is not None:
+        mime_type, _ = mimetypes.guess_type(filepath)
+        response = hotcache.make_response(entry, mime_type or "application/octet-stream", caching.cache_control(filepath))
+        return hashes.add_digest_headers(response, filepath)
+
+    # Ranges and validators go through to Go, which answers 206/304/412 itself
+    headers = {}
+    for name in ("Range",) + caching.CONDITIONAL_HEADERS:
+        if name in request.headers:
+            headers[name] = request.headers[name]
+    # Under the async profile the event loop reads from Go, not this thread (ftp/streaming.py)
+    fetch = request.environ.get("ftp.fetch_upstream", _fetch_from_go)
+
+    # Try the backends in the pool's order until one answers
+    error = 502
+    for backend in backends.pool.candidates(filepath):
+        go_url = f"{backend.url}/raw/{quote(filepath)}"
+        backend.begin()
+        try:
+            log.debug("Proxying file request to Go: %s", go_url)
+            started = time.perf_counter()
+            status, upstream_headers, body = fetch(go_url, headers, backend.end)
+            metrics.UPSTREAM_SECONDS.observe(time.perf_counter() - started, str(status))
+        except TimeoutError:
+            backend.end()
+            metrics.UPSTREAM_ERRORS.inc("timeout")
+            backends.pool.mark_failed(backend, "timeout")
+            log.error("Timeout when contacting Go service %s for %s", backend.url, filepath)
+            error = 504
+            continue
+        except ConnectionError as e:
+            backend.end()
+            metrics.UPSTREAM_ERRORS.inc("connection")
+            backends.pool.mark_failed(backend, "connection failed")
+            log.error("Failed to contact Go service %s: %s", backend.url, e)
+            error = 502
+            continue
+
+        if status >= 500:
+            body.close()
+            log.error("Go server %s error for file %s: %s", backend.url, filepath, status)
+            error = 502
+            continue
+        backends.pool.mark_ok(backend)
+
+        if status == 404:
+            body.close()
+            log.warning("File not found on Go server: %s", filepath)
             abort(404)
-        elif r.status_code >= 500:
-            print(f"[ERROR] Go server error for file {filepath}: {r.status_code}")
-            abort(502, description="Upstream service error")
-        
-        forwarded_headers = dict(r.headers)
-        forwarded_headers.setdefault("Cache-Control", "no-cache")
+
+        forwarded_headers = {
+            name: value for name, value in upstream_headers.items()
+            if name.lower() not in HOP_BY_HOP_HEADERS and name.lower() != "cache-control"
+        }
+        forwarded_headers["Cache-Control"] = caching.cache_control(filepath)
         forwarded_headers["X-Proxy-By"] = "Flask"
         forwarded_headers["X-Served-By"] = "Go-Microservice"
+        if status in (200, 206):
+            forwarded_headers.update(hashes.digest_headers(filepath))
 
-        print(f"[INFO] Streaming file through Flask: {filepath}, headers: {forwarded_headers}")
+        log.debug("Streaming file through Flask: %s", filepath)
+        # An event-loop body has to reach the ASGI bridge as it is
         return Response(
-            r.iter_content(chunk_size=8192),
-            status=r.status_code,
-            content_type=r.headers.get("Content-Type", "application/octet-stream"),
-            headers=forwarded_headers
+            body,
+            status=status,
+            content_type=upstream_headers.get("Content-Type", "application/octet-stream"),
+            headers=forwarded_headers,
+            direct_passthrough=hasattr(body, "__aiter__")
         )
-    
-    except requests.Timeout:
-        print(f"[ERROR] Timeout when contacting Go service for {filepath}")
+
+    if error == 504:
         abort(504, description="Upstream service timeout")
+    abort(502, description="Upstream service error")
+
+def _fetch_from_go(url, headers, done):
+    """
+    GET `url` from a Go service: (status, headers, body). `done` is called
+    once the body is closed. Fails with TimeoutError or ConnectionError.
+    """
+    try:
+        r = requests.get(url, stream=True, headers=headers, timeout=(5, 30))
+    except requests.Timeout as e:
+        raise TimeoutError(str(e)) from e
     except requests.RequestException as e:
-        print(f"[ERROR] Failed to contact Go service: {e}")
-        abort(502, description=f"Failed to contact Go service: {e}")
+        raise ConnectionError(str(e)) from e
+    body = metrics.count_bytes(r.iter_content(chunk_size=8192), metrics.PROXY_BYTES)
+    return r.status_code, r.headers, ClosingIterator(body, [r.close, done])
 
 # Syncing with filesystem
 def scan_physical_directory(dirpath):
+    started = time.perf_counter()
     abs_path = os.path.join(base_path, dirpath) if dirpath else base_path
-    print(f"{Fore.CYAN}[INFO]{Style.RESET_ALL} Scanning physical directory at: '{abs_path}'")
+    log.debug("Scanning physical directory at: '%s'", abs_path)
 
     if not os.path.exists(abs_path):
-        print(f"{Fore.RED}[ERROR]{Style.RESET_ALL} Path does not exist: '{abs_path}'")
+        log.error("Path does not exist: '%s'", abs_path)
         return None, None
     if not os.path.isdir(abs_path):
-        print(f"{Fore.RED}[ERROR]{Style.RESET_ALL} Path is not a directory: '{abs_path}'")
+        log.error("Path is not a directory: '%s'", abs_path)
         return None, None
 
+    directories = []
+    files = []
     try:
-        entries = os.listdir(abs_path)
-        print(f"{Fore.GREEN}[SUCCESS]{Style.RESET_ALL} Found {len(entries)} entries in directory")
+        # scandir gets the entry type from the directory read itself, so only
+        # files need an extra stat (for their size)
+        with os.scandir(abs_path) as it:
+            for entry in it:
+                if entry.name == trash.TRASH_DIR or entry.name.startswith(fileops.STAGING_PREFIX):
+                    continue
+                try:
+                    if entry.is_dir():
+                        directories.append(entry.name)
+                    elif entry.is_file():
+                        mime_type, _ = mimetypes.guess_type(entry.name)
+                        files.append({
+                            "name": entry.name,
+                            "mime_type": mime_type or "application/octet-stream",
+                            "size": entry.stat().st_size,
+                        })
+                except OSError:
+                    continue
     except PermissionError:
-        print(f"{Fore.RED}[ERROR]{Style.RESET_ALL} Permission denied when accessing: '{abs_path}'")
+        log.error("Permission denied when accessing: '%s'", abs_path)
         return None, None
 
-    directories = [d for d in entries if os.path.isdir(os.path.join(abs_path, d))]
-    print(f"{Fore.YELLOW}[INFO]{Style.RESET_ALL} Subdirectories found: {directories}")
-
-    files = []
-    for f in entries:
-        full_file_path = os.path.join(abs_path, f)
-        if os.path.isfile(full_file_path):
-            mime_type, _ = mimetypes.guess_type(full_file_path)
-            files.append({"name": f, "mime_type": mime_type or "application/octet-stream"})
+    log.debug("Found %s entries in directory", len(directories) + len(files))
+    metrics.SCAN_SECONDS.observe(time.perf_counter() - started)
+    metrics.SCAN_ENTRIES.observe(len(directories) + len(files))
 
     return directories, files
 
 # List root directory
 @bp.route("/", methods=["GET"])
 def list_root_directory():
-    print(f"{Fore.CYAN}[INFO]{Style.RESET_ALL} Listing contents of root directory")
+    log.debug("Listing contents of root directory")
     
     directories, files = scan_physical_directory("")
     if directories is None and files is None:
-        print(f"{Fore.RED}[ERROR]{Style.RESET_ALL} Root directory not found or inaccessible, returning 404")
+        log.warning("Root directory not found or inaccessible, returning 404")
         abort(404)
     
-    print(f"{Fore.GREEN}[SUCCESS]{Style.RESET_ALL} Root directory contains {len(directories)} directories and {len(files)} files")
+    log.debug("Root directory contains %s directories and %s files", len(directories), len(files))
     return hypermedia_response(dirpath="root", directories=directories, files=files)
 
 # List subdirectories
 @bp.route("/<path:dirpath>/", methods=["GET"])
 def list_directory(dirpath):
-    print(f"{Fore.CYAN}[INFO]{Style.RESET_ALL} Listing contents of subdirectory: '{dirpath}'")
+    if trash.is_hidden(dirpath):
+        abort(404)
+    log.debug("Listing contents of subdirectory: '%s'", dirpath)
     
     directories, files = scan_physical_directory(dirpath)
     if directories is None and files is None:
-        print(f"{Fore.RED}[ERROR]{Style.RESET_ALL} Subdirectory not found or inaccessible, returning 404")
+        log.warning("Subdirectory not found or inaccessible, returning 404")
         abort(404)
 
-    print(f"{Fore.GREEN}[SUCCESS]{Style.RESET_ALL} Subdirectory contains {len(directories)} directories and {len(files)} files")
+    log.debug("Subdirectory contains %s directories and %s files", len(directories), len(files))
     return hypermedia_response(dirpath=dirpath or "root", directories=directories, files=files)
 
 @bp.route("/upload", defaults={"dirpath": None}, methods=["POST"])
 @bp.route("/<path:dirpath>/upload", methods=["POST"])
 def upload_file(dirpath):
+    if dirpath and trash.is_hidden(dirpath):
+        abort(404)
     file = request.files.get("file")
     if not file or file.filename == "":
-        print(f"{Fore.RED}[ERROR]{Style.RESET_ALL} Upload failed: No file provided.")
+        log.warning("Upload failed: No file provided.")
         abort(400, description="No file provided")
     
     filename = secure_filename(file.filename)
-    print(f"{Fore.CYAN}[INFO]{Style.RESET_ALL} Uploading file '{filename}' to directory '{dirpath or 'root'}'")
+    log.info("Uploading file '%s' to directory '%s'", filename, dirpath or 'root')
     
     actual_dirpath = dirpath or ""
     physical_dir = os.path.join(base_path, actual_dirpath)
     try:
+        new_dir = journal.first_missing(os.path.abspath(physical_dir))
         os.makedirs(physical_dir, exist_ok=True)
-        print(f"{Fore.GREEN}[SUCCESS]{Style.RESET_ALL} Ensured upload directory exists: '{physical_dir}'")
+        if new_dir:
+            journal.record("create", new_dir)
+        log.debug("Ensured upload directory exists: '%s'", physical_dir)
     except Exception as e:
-        print(f"{Fore.RED}[ERROR]{Style.RESET_ALL} Failed to create upload directory '{physical_dir}': {e}")
+        log.error("Failed to create upload directory '%s': %s", physical_dir, e)
         flash(f"Failed to create upload directory: {e}", "error")
         return redirect(request.referrer or url_for("directories.list_directory", dirpath=actual_dirpath))
     
     physical_file_path = os.path.join(physical_dir, filename)
+    existed = os.path.exists(physical_file_path)
     try:
-        file.save(physical_file_path)
-        print(f"{Fore.GREEN}[SUCCESS]{Style.RESET_ALL} File saved physically to '{physical_file_path}'")
+        # Hashed on the way to disk, so the checksum catalog never has to read it back
+        sha256 = hashes.save_stream(file.stream, physical_file_path)
+        log.debug("File saved physically to '%s'", physical_file_path)
     except Exception as e:
-        print(f"{Fore.RED}[ERROR]{Style.RESET_ALL} Failed to save uploaded file '{filename}': {e}")
+        log.error("Failed to save uploaded file '%s': %s", filename, e)
         flash(f"Failed to save uploaded file: {e}", "error")
         return redirect(request.referrer or url_for("directories.list_directory", dirpath=actual_dirpath))
     
     mime_type, _ = mimetypes.guess_type(physical_file_path)
     mime_type = mime_type or file.mimetype or "application/octet-stream"
-    print(f"{Fore.CYAN}[INFO]{Style.RESET_ALL} Guessed MIME type: '{mime_type}'")
+    log.debug("Guessed MIME type: '%s'", mime_type)
     
     created_timestamp = os.path.getctime(physical_file_path)
     created_date = datetime.datetime.fromtimestamp(created_timestamp)
-    print(f"{Fore.CYAN}[INFO]{Style.RESET_ALL} Added created date: '{created_date}'")
+    log.debug("Added created date: '%s'", created_date)
 
     # Save metadata into DB
     try:
         save_file_to_directory(file, dirpath)
-        print(f"{Fore.GREEN}[SUCCESS]{Style.RESET_ALL} File metadata saved into database")
+        log.debug("File metadata saved into database")
     except Exception as e:
-        print(f"{Fore.RED}[ERROR]{Style.RESET_ALL} Failed to save file metadata: {e}")
+        log.error("Failed to save file metadata: %s", e)
+    hashes.store_file(physical_file_path, sha256)
+    journal.record("modify" if existed else "create", hashes.relative(physical_file_path))
 
     if not actual_dirpath:
-        print(f"{Fore.CYAN}[INFO]{Style.RESET_ALL} Redirecting to root directory listing after upload")
+        log.debug("Redirecting to root directory listing after upload")
         return redirect(url_for("directories.list_root_directory"))
     else:
-        print(f"{Fore.CYAN}[INFO]{Style.RESET_ALL} Redirecting to directory listing '{actual_dirpath}' after upload")
+        log.debug("Redirecting to directory listing '%s' after upload", actual_dirpath)
         return redirect(url_for("directories.list_directory", dirpath=actual_dirpath))
     
 # Folder Upload
@@ -197,42 +292,51 @@ def upload_folder(dirpath=None):
     Handle folder upload.
     The browser sends multiple files with relative paths.
     """
+    if dirpath and trash.is_hidden(dirpath):
+        abort(404)
     uploaded_files = request.files.getlist("files")
     if not uploaded_files:
-        print(f"{Fore.RED}[ERROR]{Style.RESET_ALL} Upload failed: No files provided")
+        log.warning("Upload failed: No files provided")
         abort(400, description="No files provided")
 
     actual_dirpath = dirpath or ""
-    print(f"{Fore.CYAN}[INFO]{Style.RESET_ALL} Uploading folder contents to directory: '{actual_dirpath or 'root'}'")
+    log.info("Uploading folder contents to directory: '%s'", actual_dirpath or 'root')
     saved_files = []
 
     for file in uploaded_files:
         # Extract relative path; webkitRelativePath is supported by some browsers
         rel_path = getattr(file, "webkitRelativePath", file.filename)
-        print(f"{Fore.CYAN}[INFO]{Style.RESET_ALL} Processing file with relative path: '{rel_path}'")
+        log.debug("Processing file with relative path: '%s'", rel_path)
+        if trash.is_hidden(rel_path):
+            abort(404)
 
         # Normalize path delimiter to OS format and prepend parent dir if any
         rel_path = rel_path.replace("/", os.path.sep)
         full_path = os.path.normpath(os.path.join(base_path, actual_dirpath, rel_path))
-        print(f"{Fore.CYAN}[INFO]{Style.RESET_ALL} Resolved full file path: '{full_path}'")
+        log.debug("Resolved full file path: '%s'", full_path)
 
         # Ensure parent directories exist
         parent_dir = os.path.dirname(full_path)
         try:
+            new_dir = journal.first_missing(os.path.abspath(parent_dir))
             os.makedirs(parent_dir, exist_ok=True)
-            print(f"{Fore.GREEN}[SUCCESS]{Style.RESET_ALL} Ensured directory exists: '{parent_dir}'")
+            if new_dir:
+                journal.record("create", new_dir)
+            log.debug("Ensured directory exists: '%s'", parent_dir)
         except Exception as e:
-            print(f"{Fore.RED}[ERROR]{Style.RESET_ALL} Failed to create directory '{parent_dir}': {e}")
+            log.error("Failed to create directory '%s': %s", parent_dir, e)
             flash(f"Failed to create directory: {e}", "error")
             return redirect(url_for("directories.list_directory", dirpath=actual_dirpath or ""))
 
         # Save file physically
         try:
-            file.save(full_path)
-            print(f"{Fore.GREEN}[SUCCESS]{Style.RESET_ALL} Saved file to '{full_path}'")
+            existed = os.path.exists(full_path)
+            hashes.store_file(full_path, hashes.save_stream(file.stream, full_path))
+            journal.record("modify" if existed else "create", hashes.relative(full_path))
+            log.debug("Saved file to '%s'", full_path)
             saved_files.append(full_path)
         except Exception as e:
-            print(f"{Fore.RED}[ERROR]{Style.RESET_ALL} Failed to save file '{full_path}': {e}")
+            log.error("Failed to save file '%s': %s", full_path, e)
             flash(f"Failed to save file: {e}", "error")
             return redirect(url_for("directories.list_directory", dirpath=actual_dirpath or ""))
 
@@ -240,7 +344,7 @@ def upload_folder(dirpath=None):
         # e.g., create_file_in_db(rel_path, actual_dirpath, ...)
 
     flash(f"Uploaded {len(saved_files)} files successfully.", "success")
-    print(f"{Fore.GREEN}[SUCCESS]{Style.RESET_ALL} Uploaded {len(saved_files)} files successfully to '{actual_dirpath or 'root'}'")
+    log.info("Uploaded %s files successfully to '%s'", len(saved_files), actual_dirpath or 'root')
     return redirect(url_for("directories.list_directory", dirpath=actual_dirpath or ""))
 
 # Create Directory 
@@ -248,16 +352,18 @@ def upload_folder(dirpath=None):
 def create_directory():
     parent_dir = request.form.get("parent_dir") or ""  # "" means root
     new_dir_name = request.form.get("dirname")
+    if trash.is_hidden(parent_dir):
+        abort(404)
 
-    print(f"{Fore.CYAN}[INFO]{Style.RESET_ALL} Received parent_dir: '{parent_dir}'")
-    print(f"{Fore.CYAN}[INFO]{Style.RESET_ALL} New directory name: '{new_dir_name}'")
+    log.debug("Received parent_dir: '%s'", parent_dir)
+    log.debug("New directory name: '%s'", new_dir_name)
 
     if not new_dir_name:
         flash("Folder name is required.", "error")
         return redirect(request.referrer or url_for("directories.list_root_directory"))
 
     path_parts = [secure_filename(p) for p in new_dir_name.strip("/").split("/") if p]
-    print(f"{Fore.CYAN}[INFO]{Style.RESET_ALL} path_parts after split and sanitize: {path_parts}")
+    log.debug("path_parts after split and sanitize: %s", path_parts)
 
     if not path_parts:
         flash("Invalid folder name.", "error")
@@ -265,7 +371,7 @@ def create_directory():
 
     physical_parent = os.path.abspath(os.path.join(base_path, parent_dir))
     physical_folder_path = os.path.abspath(os.path.normpath(os.path.join(physical_parent, *path_parts)))
-    print(f"{Fore.CYAN}[INFO]{Style.RESET_ALL} Resolved physical folder path (absolute): {physical_folder_path}")
+    log.debug("Resolved physical folder path (absolute): %s", physical_folder_path)
 
     if not physical_folder_path.startswith(os.path.abspath(base_path)):
         flash("Invalid folder path.", "error")
@@ -276,35 +382,37 @@ def create_directory():
         return redirect(request.referrer or url_for("directories.list_directory", dirpath=parent_dir))
 
     try:
+        new_dir = journal.first_missing(physical_folder_path)
         os.makedirs(physical_folder_path, exist_ok=False)
-        print(f"{Fore.GREEN}[SUCCESS]{Style.RESET_ALL} Created folder: {physical_folder_path}")
+        log.info("Created folder: %s", physical_folder_path)
     except Exception as e:
-        print(f"{Fore.RED}[ERROR]{Style.RESET_ALL} Exception during folder creation: {e}")
+        log.error("Exception during folder creation: %s", e)
         flash(f"Failed to create folder on disk: {e}", "error")
         return redirect(request.referrer or url_for("directories.list_directory", dirpath=parent_dir))
 
-    print(f"{Fore.YELLOW}[INFO]{Style.RESET_ALL} Folders currently in parent directory: {os.listdir(physical_parent)}")
 
     # Defensive DB insertion with debugging
     try:
-        print(f"{Fore.CYAN}[INFO]{Style.RESET_ALL} Calling create_directory_in_db with parent_dir='{parent_dir}' new_dir='{ '/'.join(path_parts) }'")
+        log.debug("Calling create_directory_in_db with parent_dir='%s' new_dir='%s'", parent_dir, '/'.join(path_parts))
         result = create_directory_in_db(parent_dir, "/".join(path_parts))
 
         if result is None:
             raise ValueError("Database insertion function returned None unexpectedly")
 
-        print(f"{Fore.GREEN}[SUCCESS]{Style.RESET_ALL} Database insert successful: {result}")
+        log.debug("Database insert successful: %s", result)
     except Exception as e:
         # Roll back folder creation on DB insertion failure
-        print(f"{Fore.RED}[ERROR]{Style.RESET_ALL} Database insertion failed: {e}. Rolling back folder creation...")
+        log.error("Database insertion failed: %s. Rolling back folder creation...", e)
         try:
             os.rmdir(physical_folder_path)
-            print(f"{Fore.GREEN}[SUCCESS]{Style.RESET_ALL} Rolled back folder at {physical_folder_path}")
+            log.info("Rolled back folder at %s", physical_folder_path)
         except Exception as rollback_e:
-            print(f"{Fore.RED}[ERROR]{Style.RESET_ALL} Rollback folder removal failed: {rollback_e}")
+            log.error("Rollback folder removal failed: %s", rollback_e)
         flash(f"Database error: {e}", "error")
         return redirect(request.referrer or url_for("directories.list_directory", dirpath=parent_dir))
 
+    if new_dir:
+        journal.record("create", new_dir)
     flash(f"Folder '{'/'.join(path_parts)}' created successfully.", "success")
     return redirect(url_for("directories.list_directory", dirpath=parent_dir))
 
@@ -312,15 +420,21 @@ def create_directory():
 # File Viewing
 @bp.route("/file/<path:filepath>", methods=["GET"])
 def view_file(filepath):
+    if trash.is_hidden(filepath):
+        abort(404)
 
     normalized_path = Path(base_path) / Path(filepath)
     full_path = str(normalized_path.resolve())
-    print(f"{Fore.CYAN}[DEBUG]{Style.RESET_ALL} Requested file path: '{filepath}', resolved full path: '{full_path}'")
+    log.debug("Requested file path: '%s', resolved full path: '%s'", filepath, full_path)
 
     if not os.path.isfile(full_path):
-        print(f"{Fore.RED}[ERROR]{Style.RESET_ALL} File not found: '{full_path}', returning 404")
+        log.warning("File not found: '%s', returning 404", full_path)
         abort(404)
 
+    # Follow mode: stream appended bytes over Server-Sent Events
+    if request.args.get("follow"):
+        return follow_file(full_path)
+
     mime_type, _ = mimetypes.guess_type(full_path)
     if mime_type is None:
         mime_type = "application/octet-stream"
@@ -349,13 +463,13 @@ def view_file(filepath):
             if row:
                 created_date = row[0]
     except Exception as e:
-          print(f"{Fore.RED}[ERROR]{Style.RESET_ALL} Failed to fetch creation date: {e}")
+          log.error("Failed to fetch creation date: %s", e)
 
     # Fallback if DB lookup fails
     if not created_date:
         created_date = datetime.datetime.utcnow().isoformat()
 
-    print(f"{Fore.GREEN}[INFO]{Style.RESET_ALL} Serving file '{filepath}' with MIME type '{mime_type}', size {file_size} bytes, creation date {created_date}")
+    log.debug("Serving file '%s' with MIME type '%s', size %s bytes, creation date %s", filepath, mime_type, file_size, created_date)
     return hypermedia_file_response(
         filepath=filepath,
         filename=os.path.basename(full_path),
@@ -364,6 +478,32 @@ def view_file(filepath):
         created_date=created_date
     )
 
+def follow_file(full_path):
+    if os.path.commonpath([os.path.abspath(base_path), full_path]) != os.path.abspath(base_path):
+        abort(403)
+
+    resume_from = request.headers.get("Last-Event-ID")
+    try:
+        resume_from = int(resume_from) if resume_from else None
+    except ValueError:
+        resume_from = None
+
+    try:
+        sub = tail.hub.subscribe(full_path, resume_from=resume_from)
+    except OSError as e:
+        log.error("Failed to follow '%s': %s", full_path, e)
+        abort(404)
+
+    log.info("Following '%s' (%s)", full_path, tail.hub.mode)
+    # direct_passthrough hands the stream object itself to the server, so the
+    # ASGI streaming mode can follow the file without holding a thread
+    return Response(
+        tail.SSEStream(tail.hub, sub),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        direct_passthrough=True
+    )
+
 
 # File Serving
 #
@@ -385,6 +525,37 @@ def view_file(filepath):
 
 #     return send_file(full_path, mimetype=mime_type, as_attachment=False)
 
+# Image Thumbnails
+@bp.route("/thumb/<path:filepath>", methods=["GET"])
+def thumbnail(filepath):
+    if not thumbnails.enabled or trash.is_hidden(filepath):
+        abort(404)
+
+    full_path = os.path.abspath(os.path.join(base_path, filepath))
+    if os.path.commonpath([os.path.abspath(base_path), full_path]) != os.path.abspath(base_path):
+        abort(403)
+    if not os.path.isfile(full_path):
+        abort(404)
+
+    mime_type, _ = mimetypes.guess_type(full_path)
+    if mime_type not in thumbnails.SUPPORTED_MIME_TYPES:
+        abort(404)
+
+    size = request.args.get("size", thumbnails.DEFAULT_SIZE, type=int)
+    if size not in thumbnails.THUMBNAIL_SIZES:
+        size = thumbnails.DEFAULT_SIZE
+    fmt = "webp" if "image/webp" in request.headers.get("Accept", "") else "jpeg"
+
+    try:
+        thumb_path = thumbnails.get_thumbnail(full_path, size, fmt)
+    except Exception as e:
+        log.error("Failed to create thumbnail for '%s': %s", filepath, e)
+        abort(404)
+
+    response = send_file(thumb_path, mimetype=f"image/{fmt}", max_age=86400, conditional=True)
+    response.vary.add("Accept")
+    return response
+
 # debug route for file creation
 @bp.route('/test_create_folder/')
 def test_create_folder():
@@ -399,7 +570,7 @@ def test_create_folder():
 @bp.route("/delete_file", methods=["POST"])
 def delete_file():
     filepath = request.form.get("filepath")
-    print(f"{Fore.CYAN}[DEBUG]{Style.RESET_ALL} Received filepath: {filepath}")
+    log.debug("Received filepath: %s", filepath)
 
     if not filepath:
         flash("File path is required.", "error")
@@ -407,18 +578,17 @@ def delete_file():
 
     # Normalize path
     physical_path = os.path.normpath(os.path.join(base_path, filepath))
-    print(f"{Fore.CYAN}[DEBUG]{Style.RESET_ALL} Physical path resolved: {physical_path}")
+    log.debug("Physical path resolved: %s", physical_path)
 
     if not physical_path.startswith(os.path.abspath(base_path)):
         flash("Invalid file path.", "error")
         return redirect(request.referrer)
 
     try:
-        delete_file_from_db_and_disk(filepath)
-        flash(f"File '{filepath}' deleted successfully.", "success")
-        print(f"{Fore.GREEN}[INFO]{Style.RESET_ALL} File '{filepath}' deleted successfully.")
+        trash.move_to_trash(filepath, "file")
+        flash(f"File '{filepath}' moved to the trash.", "success")
     except Exception as e:
-        print(f"{Fore.RED}[ERROR]{Style.RESET_ALL} Failed to delete file '{filepath}': {e}")
+        log.error("Failed to delete file '%s': %s", filepath, e)
         flash(f"Failed to delete file '{filepath}': {e}", "error")
 
     return redirect(request.referrer or url_for("directories.list_root_directory"))
@@ -427,7 +597,7 @@ def delete_file():
 @bp.route("/delete_directory", methods=["POST"])
 def delete_directory():
     dirpath = request.form.get("dirpath")
-    print(f"{Fore.CYAN}[DEBUG]{Style.RESET_ALL} Received dirpath: {dirpath}")
+    log.debug("Received dirpath: %s", dirpath)
 
     if not dirpath:
         flash("Directory path is required.", "error")
@@ -435,22 +605,127 @@ def delete_directory():
 
     # Normalize path
     physical_path = os.path.normpath(os.path.join(base_path, dirpath))
-    print(f"{Fore.CYAN}[DEBUG]{Style.RESET_ALL} Physical path resolved: {physical_path}")
+    log.debug("Physical path resolved: %s", physical_path)
 
     if not physical_path.startswith(os.path.abspath(base_path)):
         flash("Invalid directory path.", "error")
         return redirect(request.referrer)
 
     try:
-        delete_directory_from_db_and_disk(dirpath)
-        flash(f"Directory '{dirpath}' deleted successfully.", "success")
-        print(f"{Fore.GREEN}[INFO]{Style.RESET_ALL} Directory '{dirpath}' deleted successfully.")
+        trash.move_to_trash(dirpath, "directory")
+        flash(f"Directory '{dirpath}' moved to the trash.", "success")
     except Exception as e:
-        print(f"{Fore.RED}[ERROR]{Style.RESET_ALL} Failed to delete directory '{dirpath}': {e}")
+        log.error("Failed to delete directory '%s': %s", dirpath, e)
         flash(f"Failed to delete directory '{dirpath}': {e}", "error")
 
     return redirect(request.referrer or url_for("directories.list_root_directory"))
 
+# Move, rename and copy
+@bp.route("/move", methods=["POST"])
+def move_path():
+    src = request.form.get("src", "")
+    dest = request.form.get("dest", "")
+    if not src or not dest:
+        flash("Source and destination are required.", "error")
+        return redirect(request.referrer or url_for("directories.list_root_directory"))
+
+    try:
+        job_id = fileops.move(src, dest)
+        if job_id is None:
+            flash(f"'{src}' moved to '{dest}'.", "success")
+        else:
+            flash(f"Moving '{src}' to '{dest}' in the background (job {job_id}).", "success")
+    except (OSError, ValueError) as e:
+        log.error("Failed to move '%s' to '%s': %s", src, dest, e)
+        flash(f"Failed to move '{src}': {e}", "error")
+
+    return redirect(request.referrer or url_for("directories.list_root_directory"))
+
+@bp.route("/copy", methods=["POST"])
+def copy_path():
+    src = request.form.get("src", "")
+    dest = request.form.get("dest", "")
+    if not src or not dest:
+        flash("Source and destination are required.", "error")
+        return redirect(request.referrer or url_for("directories.list_root_directory"))
+
+    try:
+        job_id = fileops.copy(src, dest)
+        if job_id is None:
+            flash(f"'{src}' copied to '{dest}'.", "success")
+        else:
+            flash(f"Copying '{src}' to '{dest}' in the background (job {job_id}).", "success")
+    except (OSError, ValueError) as e:
+        log.error("Failed to copy '%s' to '%s': %s", src, dest, e)
+        flash(f"Failed to copy '{src}': {e}", "error")
+
+    return redirect(request.referrer or url_for("directories.list_root_directory"))
+
+# Background job progress
+@bp.route("/jobs", methods=["GET"])
+def list_jobs():
+    return jsonify(jobs=jobs.recent())
+
+@bp.route("/jobs/<int:job_id>", methods=["GET"])
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job)
+
+# Change journal, for incremental sync
+@bp.route("/changes", methods=["GET"])
+def list_changes():
+    since = request.args.get("since", type=int)
+    if since is None:
+        # Where a client that has just crawled the tree starts following it
+        return jsonify(changes=[], cursor=journal.latest(), more=False)
+    limit = max(1, min(journal.MAX_PAGE, request.args.get("limit", journal.MAX_PAGE, type=int)))
+    wait = max(0.0, request.args.get("wait", 0.0, type=float))
+
+    changes, more = journal.changes_since(since, limit, wait)
+    if changes is None:
+        abort(410, description="Changes since this cursor are no longer kept; crawl again and start from the latest cursor")
+    return jsonify(changes=changes, cursor=changes[-1]["seq"] if changes else since, more=more)
+
+# Content search
+@bp.route("/search", methods=["GET"])
+def search_content():
+    search.check_available()
+    q = request.args.get("q", "").strip()
+    if not q:
+        abort(400, description="Nothing to search for")
+    filters = {
+        "limit": max(1, min(search.MAX_RESULTS, request.args.get("limit", 50, type=int))),
+        "mime_type": request.args.get("type"),
+        "min_size": request.args.get("min_size", type=int),
+        "max_size": request.args.get("max_size", type=int),
+        "folder": request.args.get("path"),
+    }
+    return Response(search.result_lines(q, **filters), mimetype="application/x-ndjson",
+                    headers={"Cache-Control": "no-store"})
+
+# Trash
+@bp.route("/trash", methods=["GET"])
+def list_trash():
+    return render_template("trash.html", items=trash.list_items())
+
+@bp.route("/trash/restore", methods=["POST"])
+def restore_from_trash():
+    trash_id = request.form.get("trash_id", type=int)
+    if trash_id is None:
+        flash("Trash item is required.", "error")
+        return redirect(url_for("directories.list_trash"))
+
+    try:
+        path = trash.restore(trash_id)
+        flash(f"'{path}' restored.", "success")
+    except (LookupError, OSError) as e:
+        log.error("Failed to restore trash item %s: %s", trash_id, e)
+        flash(f"Failed to restore: {e}", "error")
+
+    return redirect(url_for("directories.list_trash"))
+
 INLINE_PREVIEW_TYPES = [
     'image/',      
     'text/',       
@@ -462,7 +737,7 @@ INLINE_PREVIEW_TYPES = [
 @bp.route('/download')
 def download_file():
     requested_path = request.args.get("path", "")
-    if not requested_path:
+    if not requested_path or trash.is_hidden(requested_path):
         abort(404)
 
     abs_path = os.path.abspath(os.path.join(base_path, requested_path))
@@ -486,13 +761,35 @@ def download_file():
             as_attachment = False
             break
 
-    return send_file(abs_path, mimetype=mime_type, as_attachment=as_attachment, download_name=os.path.basename(abs_path))    
+    cache_control = caching.cache_control(os.path.relpath(abs_path, base_path))
+    entry = hotcache.lookup(abs_path)
+    if entry is not None:
+        response = hotcache.make_response(entry, mime_type, cache_control,
+                                          download_name=os.path.basename(abs_path), as_attachment=as_attachment)
+        return hashes.add_digest_headers(response, hashes.relative(abs_path))
+
+    # Same strong validator as /raw; send_file answers the conditional headers
+    response = send_file(
+        abs_path,
+        mimetype=mime_type,
+        as_attachment=as_attachment,
+        download_name=os.path.basename(abs_path),
+        etag=caching.file_etag(os.stat(abs_path)),
+        conditional=True
+    )
+    response.headers["Cache-Control"] = cache_control
+    response.accept_ranges = "bytes"
+    return hashes.add_digest_headers(response, hashes.relative(abs_path))
 
 @bp.route("/favicon.ico")
 def favicon():
     return "", 204  # No content, no errors
 
 # Error Handling Pages 
+def retry_after_header(e):
+    # abort(429/503, retry_after=...) puts Retry-After on the exception
+    return {k: v for k, v in e.get_headers() if k == "Retry-After"}
+
 # NNL
 # Handle 404 Not Found errors
 @bp.app_errorhandler(404)
@@ -512,7 +809,7 @@ def access_forbidden(e):
 # Handle 503 Service Unavailable errors
 @bp.app_errorhandler(503)
 def service_unavailable(e):
-    return render_template("503.html"), 503
+    return render_template("503.html"), 503, retry_after_header(e)
 
 # Handle 400 Bad Request errors
 @bp.app_errorhandler(400)
@@ -527,7 +824,7 @@ def request_timeout(e):
 # Handle 429 Too Many Requests errors
 @bp.app_errorhandler(429)
 def too_many_request(e):
-    return render_template("429.html"), 429
+    return render_template("429.html"), 429, retry_after_header(e)
 
 # Handle 502 Bad Gateway errors
 @bp.app_errorhandler(502)
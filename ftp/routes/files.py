@@ -1,36 +1,235 @@
-# from flask import Blueprint, request, make_response
-# from ..models import save_file, get_file, delete_file
+# ftp/routes/files.py
+# Raw-body PUT and DELETE on file URLs, for curl -T and scripts:
+#
+#   curl -T report.pdf http://host/docs/report.pdf     # create or replace
+#   curl -X DELETE http://host/docs/report.pdf         # move to the trash
+#
+# The request body is the file, so there is no multipart parsing, and it
+# is streamed into a hidden staging file next to the destination as it
+# arrives, then renamed over the destination once complete: readers see the
+# old file or the new one, never half of either. Content-Length, when sent,
+# is reserved up front (ftp/hashes.py preallocate) so big files are laid out
+# in one piece and a full disk is reported before anything is written.
+# PUT bodies may be up to PUT_MAX_CONTENT_LENGTH, not the 50MB form limit,
+# since nothing is held in memory. Under gunicorn and the async profile
+# (ftp/streaming.py) there is no spooled copy either; waitress, the threaded
+# profile, buffers every request body in a temporary file of its own before
+# the view runs.
+#
+# If-Match and If-None-Match are checked against the same ETag /raw sends
+# (ftp/caching.py), so a script can replace a file only if it has not
+# changed since it was read (If-Match: "<etag>"), or create one only if it
+# does not exist yet (If-None-Match: *). Otherwise: 412 Precondition Failed.
+#
+# PATCH applies a delta to a file instead (ftp/delta.py): the client fetches
+# /signature/<path>, works out which parts of the file changed, and sends
+# only those. PATCH needs If-Match, since a delta only makes sense against
+# the version it was made from.
 
-# bp = Blueprint("files", __name__, url_prefix="/files")
+import logging
+import mimetypes
+import os
+import stat
+import uuid
+from flask import Blueprint, abort, current_app, request, send_file
+from werkzeug.exceptions import ClientDisconnected
+import ftp
+import ftp.caching as caching
+import ftp.delta as delta
+import ftp.fileops as fileops
+import ftp.hashes as hashes
+import ftp.journal as journal
+import ftp.metrics as metrics
+import ftp.trash as trash
+from ftp.models import save_file_metadata
 
-# @bp.route("/<filename>", methods=["GET"])
-# def download_file(filename):
-#     file_data = get_file(filename)
-#     if not file_data:
-#         return "File not found", 404
+log = logging.getLogger(__name__)
 
-#     response = make_response(file_data["content"])
-#     response.headers["Content-Type"] = file_data["mime_type"]
-#     response.headers["Content-Disposition"] = f'attachment; filename="{filename}"'
-#     return response
+COMMIT_LOCK = os.path.join(".cache", "put.lock")
 
+bp = Blueprint("files", __name__)
 
-# @bp.route("/<filename>", methods=["PUT"])
-# def upload_file(filename):
-#     if "content" not in request.files:
-#         return "No file uploaded", 400
 
-#     file_obj = request.files["content"]
-#     save_file(filename, file_obj)
+def _resolve(filepath):
+    try:
+        return fileops.resolve(filepath)
+    except ValueError:
+        abort(404)
 
-#     return f"Uploaded {filename}", 201
 
+def _stat(physical_path):
+    # Followed through symlinks, like the ETags /raw sends
+    try:
+        return os.stat(physical_path)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
 
-# @bp.route("/<filename>", methods=["DELETE"])
-# def remove_file(filename):
-#     success = delete_file(filename)
-#     if not success:
-#         return "File not found", 404
-#     return f"Deleted {filename}", 200
-# 
-# commented for now
\ No newline at end of file
+
+def _check_preconditions(st):
+    """412 unless the file as it is now satisfies If-Match and If-None-Match."""
+    # Folders have no ETag; only "*" can match them
+    etag = caching.file_etag(st) if st is not None and not stat.S_ISDIR(st.st_mode) else None
+    if request.if_match:
+        exists_and_matches = st is not None and (request.if_match.star_tag or (etag is not None and etag in request.if_match))
+        if not exists_and_matches:
+            abort(412)
+    if request.if_none_match and st is not None:
+        if request.if_none_match.star_tag or (etag is not None and request.if_none_match.contains_weak(etag)):
+            abort(412)
+
+
+@bp.route("/<path:filepath>", methods=["PUT"])
+def put_file(filepath):
+    rel_path, physical_path = _resolve(filepath)
+    st = _stat(physical_path)
+    if st is not None and stat.S_ISDIR(st.st_mode):
+        abort(409, description=f"'{rel_path}' is a folder")
+    _check_preconditions(st)   # early, before the body is read
+    if request.content_length is None and not request.environ.get("wsgi.input_terminated"):
+        abort(411)   # the server cannot tell where a chunked body ends
+
+    parent = os.path.dirname(physical_path)
+    new_dir = journal.first_missing(parent)
+    try:
+        os.makedirs(parent, exist_ok=True)
+    except (FileExistsError, NotADirectoryError):
+        abort(409, description=f"'{os.path.dirname(rel_path)}' is not a folder")
+    if new_dir:
+        journal.record("create", new_dir)
+
+    request.max_content_length = current_app.config["PUT_MAX_CONTENT_LENGTH"]
+    staging = os.path.join(parent, f"{fileops.STAGING_PREFIX}{uuid.uuid4().hex}")
+    try:
+        sha256 = hashes.save_stream(request.stream, staging, size=request.content_length, exclusive=True)
+        # gunicorn ends wsgi.input quietly when the client goes away midway
+        if request.content_length is not None and os.path.getsize(staging) != request.content_length:
+            raise ClientDisconnected()
+        with ftp.host_lock(COMMIT_LOCK):
+            # Again, in case someone else wrote the file while this body was arriving
+            st = _stat(physical_path)
+            _check_preconditions(st)
+            if st is not None:
+                os.chmod(staging, st.st_mode & 0o7777)
+            os.replace(staging, physical_path)
+    except ClientDisconnected:
+        log.warning("PUT '%s': client sent less than it announced", rel_path)
+        _discard(staging)
+        abort(400, description="Request body ended early")
+    except BaseException:
+        _discard(staging)
+        raise
+
+    new_st = os.stat(physical_path)
+    hashes.store_file(physical_path, sha256)
+    journal.record("modify" if st is not None else "create", rel_path)
+    mime_type = mimetypes.guess_type(physical_path)[0] or request.mimetype or "application/octet-stream"
+    try:
+        save_file_metadata(rel_path, mime_type, new_st.st_size)
+    except Exception as e:
+        log.error("Failed to save file metadata: %s", e)
+    log.info("PUT '%s' (%s bytes)", rel_path, new_st.st_size)
+
+    if st is None:
+        response = current_app.response_class(status=201)
+        response.headers["Location"] = "/" + rel_path
+    else:
+        response = current_app.response_class(status=204)
+    response.set_etag(caching.file_etag(new_st))
+    return response
+
+
+@bp.route("/signature/<path:filepath>")
+def get_signature(filepath):
+    rel_path, physical_path = _resolve(filepath)
+    if not os.path.isfile(physical_path):
+        abort(404)
+    cached = delta.signature(physical_path)
+    if cached is None:
+        abort(409, description=f"'{rel_path}' changed while it was being read")
+    signature_path, st = cached
+    # The file's own ETag, to send back in If-Match with the delta
+    response = send_file(signature_path, mimetype=delta.SIGNATURE_MIME, etag=caching.file_etag(st), conditional=True)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+@bp.route("/<path:filepath>", methods=["PATCH"])
+def patch_file(filepath):
+    rel_path, physical_path = _resolve(filepath)
+    if request.mimetype != delta.DELTA_MIME:
+        abort(415)
+    st = _stat(physical_path)
+    if st is None:
+        abort(404)
+    if stat.S_ISDIR(st.st_mode):
+        abort(409, description=f"'{rel_path}' is a folder")
+    if not request.if_match:
+        abort(428)
+    _check_preconditions(st)
+    if request.content_length is None and not request.environ.get("wsgi.input_terminated"):
+        abort(411)
+
+    max_size = current_app.config["PUT_MAX_CONTENT_LENGTH"]
+    request.max_content_length = max_size
+    staging = os.path.join(os.path.dirname(physical_path), f"{fileops.STAGING_PREFIX}{uuid.uuid4().hex}")
+    try:
+        with open(physical_path, "rb") as base:
+            _check_preconditions(os.fstat(base.fileno()))   # the version opened is the one checked
+            reused, sent = delta.apply(request.stream, base, staging, max_size)
+        sha256, signature, _ = delta.compute_signature(staging)
+        expected = delta.expected_sha256(request.headers.get("Repr-Digest"))
+        if expected is not None and expected != sha256:
+            abort(400, description="The rebuilt file does not match Repr-Digest")
+        with ftp.host_lock(COMMIT_LOCK):
+            st = _stat(physical_path)
+            _check_preconditions(st)
+            os.chmod(staging, st.st_mode & 0o7777)
+            os.replace(staging, physical_path)
+    except ClientDisconnected:
+        log.warning("PATCH '%s': client sent less than it announced", rel_path)
+        _discard(staging)
+        abort(400, description="Request body ended early")
+    except ValueError as e:
+        _discard(staging)
+        abort(400, description=f"Bad delta: {e}")
+    except BaseException:
+        _discard(staging)
+        raise
+
+    new_st = os.stat(physical_path)
+    hashes.store_file(physical_path, sha256)
+    delta.store_signature(new_st, signature)
+    metrics.DELTA_BYTES.inc("reused", amount=reused)
+    metrics.DELTA_BYTES.inc("sent", amount=sent)
+    journal.record("modify", rel_path)
+    mime_type = mimetypes.guess_type(physical_path)[0] or "application/octet-stream"
+    try:
+        save_file_metadata(rel_path, mime_type, new_st.st_size)
+    except Exception as e:
+        log.error("Failed to save file metadata: %s", e)
+    log.info("PATCH '%s' (%s bytes, %s sent, %s reused)", rel_path, new_st.st_size, sent, reused)
+
+    response = current_app.response_class(status=204)
+    response.set_etag(caching.file_etag(new_st))
+    return response
+
+
+@bp.route("/<path:filepath>", methods=["DELETE"])
+def delete_path(filepath):
+    rel_path, physical_path = _resolve(filepath)
+    kind = "directory" if os.path.isdir(physical_path) else "file"
+    with ftp.host_lock(COMMIT_LOCK):
+        st = _stat(physical_path)
+        if st is None:
+            abort(404)
+        _check_preconditions(st)
+        trash.move_to_trash(rel_path, kind)
+    log.info("DELETE '%s'", rel_path)
+    return "", 204
+
+
+def _discard(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
@@ -1,9 +1,13 @@
 #ftp/routes/hypermedia.py
 # It prepares HTML responses and adds hypermedia-specific headers.
+import logging
 import os
 from flask import current_app
 from flask import render_template, make_response, request
 import datetime
+from ftp.listing import build_entries, breadcrumbs
+
+log = logging.getLogger(__name__)
 
 base_path = None
 
@@ -14,22 +18,36 @@ def init_app(app):
 def hypermedia_response(dirpath, directories, files):
     """
     Prepare a hypermedia HTML response for a directory.
-    Automatically selects 'root.html' for root, 'directory.html' for others.
+    Automatically selects 'root.html' for root, 'directory.html' for others,
+    or just the '_listing.html' fragment when asked with X-Fragment: listing.
     """
+    # In-page navigation (static/script.js) only needs the listing itself,
+    # not the layout, toolbar and dialogs around it
+    fragment = request.headers.get("X-Fragment") == "listing"
+
     # Pick template based on whether it's the root or a subdirectory
-    template_name = "root.html" if dirpath == "root" else "directory.html"
+    if fragment:
+        template_name = "_listing.html"
+    else:
+        template_name = "root.html" if dirpath == "root" else "directory.html"
+
+    # Icons, sizes and links are resolved in Python, not in the template
+    dir_entries, file_entries = build_entries(dirpath, directories, files)
 
     # Render the HTML with the directory and file contents
     html = render_template(template_name,
                            dirpath=dirpath,
-                           directories=directories,
-                           files=files)
+                           directories=dir_entries,
+                           files=file_entries,
+                           breadcrumbs=breadcrumbs(dirpath))
 
     # Build response with hypermedia headers
     response = make_response(html)
     response.headers["Content-Type"] = "text/html"
     response.headers["Last-Modified"] = datetime.datetime.utcnow().isoformat() + "Z"
     response.headers["Allow"] = "GET, PUT, DELETE"
+    # Full page and fragment share a URL, so caches must key on the header
+    response.vary.add("X-Fragment")
 
     # Hypermedia-specific links
     links = []
@@ -72,7 +90,7 @@ def hypermedia_file_response(filepath, filename, mime_type, size, created_date =
             with open(full_path, "r", encoding="utf-8", errors="ignore") as f:
                 text_preview = f.read().splitlines()[:50]  # first 50 lines
         except Exception as e:
-            print(f"[WARN] Failed to read text file preview: {e}")
+            log.warning("Failed to read text file preview: %s", e)
 
     # Render the HTML content with file metadata
     html = render_template(
@@ -0,0 +1,396 @@
+# ftp/search.py
+# Full-text search inside the text files under BASE_PATH: logs, configs,
+# source code.
+#
+#   GET /search?q=connection refused&type=text/x-log&max_size=1000000&path=logs
+#
+# answers with JSON lines, best match first: the file, its score and up to
+# SNIPPET_LINES matching lines with their numbers, then a summary. Words
+# must all appear; "quoted words" must appear together.
+#
+# The index is an SQLite FTS5 table next to search_files, which remembers
+# the size, mtime and inode each file had when it was indexed. Only files
+# whose three changed are read again, so going over an unchanged tree
+# stats every file and opens none. Files are indexed when they are
+# text/* (or another text type in TEXT_TYPES), or of unknown type and
+# free of NUL bytes, and no bigger than SEARCH_MAX_FILE_BYTES.
+#
+# One process per host keeps the index, in a background thread at idle I/O
+# priority. It follows the change journal (ftp/journal.py), so uploads,
+# PUTs, deletes, moves and changes made on disk are searchable seconds
+# later, and walks the whole tree every SEARCH_INTERVAL seconds in case
+# anything was missed. Files are read and decoded on a pool of
+# SEARCH_WORKERS processes; SQLite tokenizes them as they are inserted.
+
+import json
+import logging
+import mimetypes
+import os
+import re
+import sqlite3
+import stat
+import time
+from concurrent.futures import ProcessPoolExecutor
+from flask import abort
+import ftp
+import ftp.hashes as hashes
+import ftp.journal as journal
+from ftp.models import children_where, get_db_connection
+
+log = logging.getLogger(__name__)
+
+SNIFF_BYTES = 8192      # of a file of unknown type, checked for NUL bytes
+INLINE_FILES = 16       # fewer changed files than this are read without the process pool
+WRITE_BYTES = 8 * 1024 * 1024   # text inserted per transaction
+MAX_RESULTS = 200
+SNIPPET_LINES = 3
+SNIPPET_CHARS = 200
+JOURNAL_PAGE = 500
+# Text, though not text/*
+TEXT_TYPES = {
+    "application/json", "application/xml", "application/javascript", "application/sql",
+    "application/toml", "application/yaml", "application/x-yaml", "application/x-sh",
+}
+
+base_path = None
+workers = None
+max_file_bytes = 0
+interval = 0
+available = False
+
+
+
+def init_app(app):
+    global base_path, workers, max_file_bytes, interval, available
+    base_path = os.path.abspath(app.config["BASE_PATH"])
+    workers = app.config["SEARCH_WORKERS"]
+    max_file_bytes = app.config["SEARCH_MAX_FILE_BYTES"]
+    interval = app.config["SEARCH_INTERVAL"]
+
+    available = ensure_tables()
+    if not available:
+        log.warning("SQLite was built without FTS5; content search is disabled")
+    elif interval > 0:
+        start_indexer()
+
+
+def ensure_tables():
+    """Create the index if needed. False if this SQLite has no FTS5."""
+    # Databases created before content search existed
+    with get_db_connection() as conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS search_files (
+                id INTEGER PRIMARY KEY,
+                path TEXT UNIQUE NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                inode INTEGER NOT NULL,
+                mime_type TEXT
+            )
+        """)
+        conn.execute("CREATE TABLE IF NOT EXISTS search_state (key TEXT PRIMARY KEY, value)")
+        try:
+            conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(body)")
+        except sqlite3.OperationalError:
+            return False
+    return True
+
+
+# Which files, and their text
+
+def _indexable(rel_path, st):
+    """MIME type to index a file under, "" if only its contents can tell, None to leave it out."""
+    if st.st_size > max_file_bytes:
+        return None
+    mime_type = mimetypes.guess_type(rel_path)[0]
+    if mime_type is None:
+        return ""
+    if mime_type.startswith("text/") or mime_type in TEXT_TYPES:
+        return mime_type
+    return None
+
+
+def extract(full_path, sniff):
+    """Text of a file, or None if it is not text. Module level so process pools can run it."""
+    try:
+        with open(full_path, "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    if sniff and b"\0" in data[:SNIFF_BYTES]:
+        return None
+    return data.decode("utf-8", errors="replace")
+
+
+def _validator(st):
+    return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+
+# Keeping the index
+
+def index_files(files, pool=None):
+    """
+    (Re)index `files`, a list of (relative path, stat result), skipping
+    those unchanged since they were indexed. Returns the number read.
+    """
+    candidates = {}
+    for rel_path, st in files:
+        mime_type = _indexable(rel_path, st)
+        if mime_type is not None:
+            candidates[rel_path] = (st, mime_type)
+
+    gone = [rel_path for rel_path, _ in files if rel_path not in candidates]
+    paths = list(candidates)
+    with get_db_connection() as conn:
+        # Files that stopped qualifying, e.g. grew past the size limit
+        _forget(conn.cursor(), gone)
+        for i in range(0, len(paths), hashes.QUERY_BATCH):
+            batch = paths[i:i + hashes.QUERY_BATCH]
+            for row in conn.execute(
+                f"SELECT path, size, mtime_ns, inode FROM search_files WHERE path IN ({','.join('?' * len(batch))})", batch
+            ):
+                if (row["size"], row["mtime_ns"], row["inode"]) == _validator(candidates[row["path"]][0]):
+                    del candidates[row["path"]]
+    if not candidates:
+        return 0
+
+    todo = list(candidates.items())
+    args = ([os.path.join(base_path, rel_path) for rel_path, _ in todo],
+            [mime_type == "" for _, (_, mime_type) in todo])
+    if pool is not None and len(todo) >= INLINE_FILES:
+        texts = pool.map(extract, *args, chunksize=8)
+    else:
+        texts = map(extract, *args)
+
+    # Written a few MB at a time, so uploads are not kept waiting for the
+    # database while files are read
+    ready = []
+    ready_bytes = 0
+    for (rel_path, (st, mime_type)), text in zip(todo, texts):
+        ready.append((rel_path, st, mime_type, text))
+        ready_bytes += len(text or "")
+        if ready_bytes >= WRITE_BYTES:
+            _write(ready)
+            ready, ready_bytes = [], 0
+    _write(ready)
+    return len(todo)
+
+
+def _write(ready):
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        for rel_path, st, mime_type, text in ready:
+            _forget(cursor, [rel_path])
+            # A file that turned out not to be text is remembered too, so it is not read again
+            cursor.execute(
+                "INSERT INTO search_files (path, size, mtime_ns, inode, mime_type) VALUES (?, ?, ?, ?, ?)",
+                (rel_path, st.st_size, st.st_mtime_ns, st.st_ino, (mime_type or "text/plain") if text is not None else None)
+            )
+            if text is not None:
+                cursor.execute("INSERT INTO search_index (rowid, body) VALUES (?, ?)", (cursor.lastrowid, text))
+
+
+def _delete(cursor, where, args):
+    cursor.execute(f"DELETE FROM search_index WHERE rowid IN (SELECT id FROM search_files WHERE {where})", args)
+    cursor.execute(f"DELETE FROM search_files WHERE {where}", args)
+
+
+def _forget(cursor, paths):
+    for i in range(0, len(paths), hashes.QUERY_BATCH):
+        batch = paths[i:i + hashes.QUERY_BATCH]
+        _delete(cursor, f"path IN ({','.join('?' * len(batch))})", batch)
+
+
+def remove(paths):
+    """Drop files, and everything inside folders, from the index."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        for path in paths:
+            where, args = children_where(path)
+            _delete(cursor, f"path = ? OR ({where})", (path,) + args)
+
+
+def move(old, new):
+    """Follow a file or folder to its new path."""
+    old_where, old_args = children_where(old)
+    new_where, new_args = children_where(new)
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        _delete(cursor, f"path = ? OR ({new_where})", (new,) + new_args)   # whatever it replaced
+        cursor.execute(
+            f"UPDATE search_files SET path = ? || substr(path, ?) WHERE path = ? OR ({old_where})",
+            (new, len(old) + 1, old) + old_args
+        )
+        moved = cursor.rowcount
+    if not moved:
+        # Not indexed under its old name (outside the tree, or never seen)
+        index_tree(new)
+
+
+def _regular_files(rel_paths):
+    files = []
+    for rel_path in rel_paths:
+        try:
+            st = os.lstat(os.path.join(base_path, rel_path))
+        except OSError:
+            continue
+        if stat.S_ISREG(st.st_mode):
+            files.append((rel_path, st))
+    return files
+
+
+def index_tree(rel_path):
+    full_path = os.path.join(base_path, rel_path)
+    if os.path.isdir(full_path) and not os.path.islink(full_path):
+        return index_files(list(hashes.walk_files(full_path)))
+    return index_files(_regular_files([rel_path]))
+
+
+def full_pass():
+    """Index every new or changed file and forget those that are gone. Returns the number read."""
+    seen = set()
+    count = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        batch = []
+        for rel_path, st in hashes.walk_files(base_path):
+            seen.add(rel_path)
+            batch.append((rel_path, st))
+            if len(batch) >= hashes.QUERY_BATCH:
+                count += index_files(batch, pool)
+                batch = []
+        count += index_files(batch, pool)
+
+    with get_db_connection() as conn:
+        gone = [row["path"] for row in conn.execute("SELECT path FROM search_files") if row["path"] not in seen]
+        _forget(conn.cursor(), gone)
+    if count or gone:
+        log.info("Search index: read %s files, forgot %s", count, len(gone))
+    return count
+
+
+def apply_changes(changes):
+    """Bring the index up to date with a page of the change journal."""
+    pending = []
+
+    def flush():
+        index_files(_regular_files(dict.fromkeys(pending)))
+        pending.clear()
+
+    for change in changes:
+        if change["op"] in ("create", "modify"):
+            # A new folder's contents are journalled one by one
+            if change["kind"] == "file":
+                pending.append(change["path"])
+            continue
+        flush()
+        if change["op"] == "delete":
+            remove([change["path"]])
+        elif change["op"] == "move":
+            move(change["path"], change["new_path"])
+    flush()
+
+
+# Background indexer
+
+def _state(key):
+    with get_db_connection() as conn:
+        row = conn.execute("SELECT value FROM search_state WHERE key=?", (key,)).fetchone()
+    return row["value"] if row else None
+
+
+def _set_state(key, value):
+    with get_db_connection() as conn:
+        conn.execute("INSERT OR REPLACE INTO search_state (key, value) VALUES (?, ?)", (key, value))
+
+
+def follow():
+    """Keep the index current: follow the journal, with a full pass every `interval` seconds."""
+    cursor = _state("journal_cursor")
+    next_pass = 0.0
+    while True:
+        if cursor is None or time.monotonic() >= next_pass:
+            # Everything journalled up to here is covered by the pass
+            start = journal.latest()
+            full_pass()
+            cursor = start
+            _set_state("journal_cursor", cursor)
+            next_pass = time.monotonic() + interval
+
+        changes, _ = journal.changes_since(cursor, JOURNAL_PAGE, wait=max(0.0, next_pass - time.monotonic()))
+        if changes is None:
+            log.warning("Search index fell behind the change journal; walking the tree again")
+            cursor = None
+            continue
+        if changes:
+            apply_changes(changes)
+            cursor = changes[-1]["seq"]
+            _set_state("journal_cursor", cursor)
+
+
+def start_indexer():
+    ftp.run_on_one_process("search-indexer", os.path.join(".cache", "search-index.lock"), follow, interval)
+
+
+# Queries
+
+def parse_query(q):
+    """'disk "out of space"' -> FTS5 query requiring every word and phrase, and the words for snippets."""
+    terms = [(phrase or word).strip() for phrase, word in re.findall(r'"([^"]*)"|(\S+)', q)]
+    terms = [term for term in terms if term]
+    match = " ".join('"' + term.replace('"', '""') + '"' for term in terms)
+    return match, [word.casefold() for term in terms for word in term.split()]
+
+
+def matching_lines(body, words):
+    lines = []
+    for number, line in enumerate(body.splitlines(), 1):
+        folded = line.casefold()
+        if any(word in folded for word in words):
+            lines.append({"line": number, "text": line.strip()[:SNIPPET_CHARS]})
+            if len(lines) == SNIPPET_LINES:
+                break
+    return lines
+
+
+def search(q, limit=50, mime_type=None, min_size=None, max_size=None, folder=None):
+    """Ranked hits, best first: [{"path", "size", "mime_type", "score"}] plus the row id."""
+    match, _ = parse_query(q)
+    sql = ["SELECT f.id, f.path, f.size, f.mime_type, bm25(search_index) AS score "
+           "FROM search_index JOIN search_files f ON f.id = search_index.rowid WHERE search_index MATCH ?"]
+    args = [match]
+    if mime_type:
+        sql.append("AND f.mime_type LIKE ? ESCAPE '\\'")
+        args.append(mime_type.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%")
+    if min_size is not None:
+        sql.append("AND f.size >= ?")
+        args.append(min_size)
+    if max_size is not None:
+        sql.append("AND f.size <= ?")
+        args.append(max_size)
+    if folder:
+        folder = folder.strip("/")
+        sql.append("AND f.path > ? AND f.path < ?")
+        args.extend((folder + "/", folder + "0"))
+    sql.append("ORDER BY score LIMIT ?")
+    args.append(limit)
+    with get_db_connection() as conn:
+        return [dict(row) for row in conn.execute(" ".join(sql), args)]
+
+
+def result_lines(q, **filters):
+    """JSON lines: one per hit with its matching lines, then {"summary": {...}}."""
+    started = time.perf_counter()
+    _, words = parse_query(q)
+    hits = search(q, **filters)
+    for hit in hits:
+        with get_db_connection() as conn:
+            row = conn.execute("SELECT body FROM search_index WHERE rowid=?", (hit.pop("id"),)).fetchone()
+        hit["score"] = round(-hit["score"], 4)   # bm25() is lower for better matches
+        hit["lines"] = matching_lines(row["body"], words) if row else []
+        yield json.dumps(hit) + "\n"
+    yield json.dumps({"summary": {"hits": len(hits), "seconds": round(time.perf_counter() - started, 3)}}) + "\n"
+
+
+def check_available():
+    if not available:
+        abort(501, description="Content search needs SQLite with FTS5")
@@ -0,0 +1,268 @@
+# ftp/serving.py
+# Server profiles used by start.py.
+#
+#   threaded   one waitress process with a thread pool (default on Windows,
+#              and what the project has always used)
+#   workers    gunicorn master + N preloaded worker processes, each with its
+#              own thread pool, so listings and previews are not serialised
+#              behind a single GIL
+#   async      uvicorn worker processes, each running an event loop that
+#              streams downloads, /raw and followed files without holding a
+#              thread per client (see ftp/streaming.py)
+#
+# Pool sizes default to values derived from the CPU count and the I/O wait
+# currently observed on the host; WEB_WORKERS / WEB_THREADS override them.
+
+import logging
+import math
+import os
+import signal
+import subprocess
+import time
+from ftp.logs import init_logging
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PROFILE = "threaded" if os.name == "nt" else "workers"
+
+# Requests here mostly wait on disk, SQLite or the Go hop. This is the
+# assumed wait:compute ratio when the host gives us nothing better to go on.
+BASE_WAIT_COMPUTE_RATIO = 3.0
+MAX_THREADS = 32
+
+
+def sample_iowait(interval=0.5):
+    """
+    Return (iowait, busy) CPU time observed over `interval` seconds, from
+    /proc/stat. Returns None where that is not available.
+    """
+    def read():
+        with open("/proc/stat") as f:
+            fields = [int(v) for v in f.readline().split()[1:]]
+        user, nice, system, idle, iowait = fields[:5]
+        return iowait, user + nice + system
+
+    try:
+        before = read()
+        time.sleep(interval)
+        after = read()
+    except (OSError, ValueError):
+        return None
+    return after[0] - before[0], after[1] - before[1]
+
+
+def plan_pools(profile):
+    """Work out (workers, threads per worker) for a profile."""
+    cpus = os.cpu_count() or 1
+
+    # Threads needed to keep one CPU busy: 1 + W/C (Goetz). Prefer the wait
+    # ratio the host is actually showing when it is higher than our guess.
+    ratio = BASE_WAIT_COMPUTE_RATIO
+    sample = sample_iowait()
+    if sample is not None:
+        iowait, busy = sample
+        if busy > 0:
+            ratio = max(ratio, iowait / busy)
+
+    if profile in ("workers", "async"):
+        workers = int(os.getenv("WEB_WORKERS", cpus))
+        cpus_per_worker = max(1.0, cpus / workers)
+    else:
+        workers = 1
+        cpus_per_worker = cpus
+
+    threads = math.ceil(cpus_per_worker * (1 + ratio))
+    threads = int(os.getenv("WEB_THREADS", min(MAX_THREADS, max(2, threads))))
+    return workers, threads
+
+
+def run(app_factory, host, port, profile=None):
+    """
+    Start the Go file service once for this host, then serve the Flask app
+    built by `app_factory` with the requested profile.
+    """
+    from ftp import start_go_service, stop_go_service
+    import atexit
+
+    init_logging()
+
+    profile = profile or os.getenv("SERVER_PROFILE", DEFAULT_PROFILE)
+    if profile == "workers" and os.name == "nt":
+        log.warning("The 'workers' profile needs a POSIX system; using 'threaded'.")
+        profile = "threaded"
+
+    workers, threads = plan_pools(profile)
+    # create_app sizes its admission limits from these, and uvicorn workers
+    # build their own app, so pass them on through the environment
+    os.environ["WEB_THREADS"] = str(threads)
+    os.environ["SERVER_PROFILE"] = profile
+
+    start_go_service()
+    atexit.register(stop_go_service)
+
+    if profile == "workers":
+        _run_gunicorn(app_factory, host, port, workers, threads)
+    elif profile == "async":
+        _run_uvicorn(host, port, workers, threads)
+    elif profile == "threaded":
+        from waitress import serve
+        log.info("Serving with waitress: %s threads", threads)
+        app = app_factory()
+        # waitress refuses bodies over 1GB by itself; PUT accepts more
+        serve(app, host=host, port=port, threads=threads,
+              max_request_body_size=app.config["PUT_MAX_CONTENT_LENGTH"])
+    else:
+        raise ValueError(f"Unknown server profile: {profile}")
+
+
+def _run_gunicorn(app_factory, host, port, workers, threads):
+    from gunicorn.app.base import BaseApplication
+    from gunicorn.workers.gthread import ThreadWorker
+
+    class DrainingWorker(ThreadWorker):
+        # A plain gthread worker told to stop drops the connections it has
+        # accepted but not read a request from yet, which is what clients
+        # see as a reset during rolling_reload. This one stops accepting
+        # first and exits once the connections it holds are served.
+        draining = False
+        accepting = True
+
+        def handle_exit(self, sig, frame):
+            self.draining = True
+
+        def notify(self):
+            super().notify()
+            if self.draining and self.accepting:
+                self.accepting = False
+                self.cfg.set("keepalive", 0)   # close connections after their current request
+                with self._lock:
+                    for listener in self.sockets:
+                        self.poller.unregister(listener)
+            if self.draining and self.nr_conns == 0:
+                self.alive = False
+
+    class PreloadedApplication(BaseApplication):
+        def load_config(self):
+            options = {
+                "bind": f"{host}:{port}",
+                "workers": workers,
+                "threads": threads,
+                "worker_class": DrainingWorker,
+                # The app (templates, static manifest, ...) is built once in the
+                # master and shared copy-on-write with every worker
+                "preload_app": True,
+                "graceful_timeout": int(os.getenv("WEB_GRACEFUL_TIMEOUT", 30)),
+                "timeout": int(os.getenv("WEB_TIMEOUT", 120)),
+                "pidfile": os.getenv("WEB_PIDFILE", os.path.join(".cache", "gunicorn.pid")),
+                # A master replaced by rolling_reload leaves the Go service to its successor
+                "pre_exec": _pass_on_go_service,
+                "on_exit": _leave_go_service,
+            }
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app_factory()
+
+    os.makedirs(".cache", exist_ok=True)
+    log.info("Serving with gunicorn: %s workers x %s threads", workers, threads)
+    PreloadedApplication().run()
+
+
+def _run_uvicorn(host, port, workers, threads):
+    import uvicorn
+
+    # uvicorn starts its workers as fresh interpreters, so they build their
+    # own app from an import string rather than from app_factory
+    log.info("Serving with uvicorn: %s workers, %s threads each for Flask views", workers, threads)
+    uvicorn.run(
+        "ftp.streaming:create_asgi_app",
+        factory=True,
+        host=host,
+        port=port,
+        workers=workers,
+        lifespan="on",
+        timeout_graceful_shutdown=int(os.getenv("WEB_GRACEFUL_TIMEOUT", 30)),
+    )
+
+
+def _pass_on_go_service(server):
+    # In the new master forked off by USR2, just before it execs
+    from ftp import go_service_handover
+    server.cfg.env_orig.update(go_service_handover())
+
+
+def _leave_go_service(server):
+    if server.reexec_pid:
+        from ftp import release_go_service
+        release_go_service()
+
+
+def rolling_reload(pidfile=None, boot_timeout=120.0):
+    """
+    Replace a running gunicorn server with one running the code now on
+    disk, without dropping requests: USR2 starts a new master, which loads
+    the app afresh, with workers of its own next to the old ones. Once as
+    many new workers are up as the old master has, TERM retires the old
+    master; its workers finish what they are serving first
+    (WEB_GRACEFUL_TIMEOUT). If the new master does not come up, the old
+    one is left serving.
+    """
+    pidfile = pidfile or os.getenv("WEB_PIDFILE", os.path.join(".cache", "gunicorn.pid"))
+    old_master = _read_pid(pidfile)
+    if old_master is None:
+        raise RuntimeError(f"No running gunicorn master found in {pidfile}")
+
+    workers = len(_workers_of(old_master))
+    log.info("Reloading gunicorn master %s and its %s workers", old_master, workers)
+    os.kill(old_master, signal.SIGUSR2)
+
+    new_master = None
+    deadline = time.monotonic() + boot_timeout
+    while time.monotonic() < deadline:
+        time.sleep(0.5)
+        if new_master is None:
+            new_master = _read_pid(pidfile + ".2")
+            if new_master is None:
+                continue
+        if not _alive(new_master):
+            raise RuntimeError("The new gunicorn master exited; the old one is still serving (see its log)")
+        if len(_workers_of(new_master)) >= workers:
+            break
+    else:
+        if new_master is not None:
+            os.kill(new_master, signal.SIGTERM)
+        raise RuntimeError(f"The new gunicorn workers did not start within {boot_timeout:.0f}s; the old master is still serving")
+
+    log.info("New master %s is up with %s workers; retiring %s", new_master, workers, old_master)
+    os.kill(old_master, signal.SIGTERM)
+    while _alive(old_master):
+        time.sleep(0.5)
+    # The new master takes over the pidfile once it notices it is on its own
+    while _read_pid(pidfile) != new_master and _alive(new_master):
+        time.sleep(0.5)
+    log.info("Reload finished")
+
+
+def _read_pid(pidfile):
+    try:
+        with open(pidfile) as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def _workers_of(master):
+    """A gunicorn master's workers: its children running the same program (not the Go service)."""
+    children = subprocess.run(["pgrep", "-P", str(master)], capture_output=True, text=True).stdout.split()
+    program = _program(master)
+    return [int(pid) for pid in children if _program(pid) == program]
+
+
+def _program(pid):
+    return subprocess.run(["ps", "-o", "comm=", "-p", str(pid)], capture_output=True, text=True).stdout.strip()
+
+
+def _alive(pid):
+    state = subprocess.run(["ps", "-o", "stat=", "-p", str(pid)], capture_output=True, text=True).stdout.strip()
+    return state != "" and not state.startswith("Z")   # an exited master can linger as a zombie
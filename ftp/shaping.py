@@ -0,0 +1,327 @@
+# ftp/shaping.py
+# Bandwidth shaping for file transfers, so that one client pulling a 40GB
+# file through /raw or /download cannot fill the uplink and starve
+# everyone else's page loads.
+#
+# The uplink is modelled as a virtual link sending SHAPING_RATE bytes per
+# second, and each client address gets a link of its own sending
+# SHAPING_CLIENT_RATE. A bulk transfer sends its body in quanta of
+# SHAPING_QUANTUM bytes times its weight: before each quantum it books the
+# next free stretch of both links and sleeps until that stretch starts.
+# Since every active transfer books one quantum at a time, they take turns
+# (deficit round robin, the usual cheap stand-in for weighted fair queuing):
+# each gets a share of the link in proportion to its weight (SHAPING_WEIGHTS,
+# for example "raw=2,download=1"), and a transfer alone on the link gets
+# all of it.
+#
+# Other responses, and file bodies of up to SHAPING_SMALL_BYTES, never wait.
+# Their bytes are still booked on the link, so bulk transfers make room for
+# them: page loads and thumbnails go first.
+#
+# The links live in a small shared memory file (.cache/shaping.state), so
+# the limits hold for the whole host however many worker processes there
+# are. Both rates can be changed while the server runs:
+#
+#   curl -X POST -H "Authorization: Bearer $ADMIN_TOKEN" \
+#        -d rate=52428800 -d client_rate=10485760 http://host/admin/shaping
+#
+# which every transfer picks up from its next quantum on. Rates set this
+# way are kept in the database across restarts; DELETE goes back to the
+# configured ones. A rate of 0 means no limit, and with both at 0 nothing
+# is shaped. The endpoint does not exist unless ADMIN_TOKEN is set.
+
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from flask import abort, jsonify, request
+import ftp
+import ftp.metrics as metrics
+from ftp.models import get_db_connection
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+STATE_PATH = os.path.join(".cache", "shaping.state")
+MAGIC = b"ftpshp01"
+HEADER = struct.Struct("<8sddd")   # magic, rate, client rate, link free at
+RATES = struct.Struct("<dd")
+LINK_FREE = struct.Struct("<d")
+SLOT = struct.Struct("<Qd")        # client key, client link free at
+SLOTS = 4096
+PROBE = 8                          # slots a client may hash to
+
+# endpoint -> weight name in SHAPING_WEIGHTS
+TRANSFER_ENDPOINTS = {
+    "directories.serve_file": "raw",
+    "directories.download_file": "download",
+}
+SETTINGS = ("rate", "client_rate")
+
+links = None
+configured = {}
+quantum = 64 * 1024
+small_bytes = 1024 * 1024
+weights = {}
+
+_active = {}
+_active_lock = threading.Lock()
+
+
+def init_app(app):
+    global links, configured, quantum, small_bytes, weights
+    configured = {"rate": app.config["SHAPING_RATE"], "client_rate": app.config["SHAPING_CLIENT_RATE"]}
+    quantum = max(1024, app.config["SHAPING_QUANTUM"])
+    small_bytes = app.config["SHAPING_SMALL_BYTES"]
+    weights = parse_weights(app.config["SHAPING_WEIGHTS"])
+
+    # Databases created before shaping existed
+    with get_db_connection() as conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS shaping_settings (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        overrides = dict(conn.execute("SELECT name, value FROM shaping_settings").fetchall())
+
+    links = Links(STATE_PATH)
+    settings = {**configured, **{k: v for k, v in overrides.items() if k in SETTINGS}}
+    links.reset(settings["rate"], settings["client_rate"])
+    if settings["rate"] or settings["client_rate"]:
+        log.info("Bandwidth shaping: %s bytes/s overall, %s bytes/s per client", settings["rate"], settings["client_rate"])
+
+    app.after_request(_shape_response)
+    if app.config["ADMIN_TOKEN"]:
+        app.add_url_rule("/admin/shaping", "admin_shaping", admin_shaping, methods=["GET", "POST", "DELETE"])
+
+
+def parse_weights(text):
+    """"raw=2,download=1" -> {"raw": 2.0, "download": 1.0}"""
+    parsed = {}
+    for part in (text or "").split(","):
+        name, _, value = part.partition("=")
+        if name.strip() and value.strip():
+            parsed[name.strip()] = max(0.01, float(value))
+    return parsed
+
+
+def client_key(client):
+    key = int.from_bytes(hashlib.blake2b((client or "").encode(), digest_size=8).digest(), "little")
+    return key or 1   # 0 marks a free slot
+
+
+class Links:
+    """The virtual links, in a file that every server process on the host maps."""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        size = HEADER.size + SLOTS * SLOT.size
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(self.fd).st_size < size:
+            os.ftruncate(self.fd, size)
+        self.map = mmap.mmap(self.fd, size)
+        # Record locks belong to the process, so threads also need this one
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def _locked(self):
+        with self.lock:
+            if fcntl is None:
+                yield
+                return
+            fcntl.lockf(self.fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+    def reset(self, rate, client_rate):
+        # Bookings from before a restart are on another clock's timeline
+        with self._locked():
+            HEADER.pack_into(self.map, 0, MAGIC, float(rate), float(client_rate), 0.0)
+            self.map[HEADER.size:] = bytes(SLOTS * SLOT.size)
+
+    def set_rates(self, rate, client_rate):
+        with self._locked():
+            RATES.pack_into(self.map, len(MAGIC), float(rate), float(client_rate))
+
+    def rates(self):
+        return RATES.unpack_from(self.map, len(MAGIC))
+
+    def enabled(self):
+        rate, client_rate = self.rates()
+        return rate > 0 or client_rate > 0
+
+    def book(self, key, nbytes):
+        """Book `nbytes` on the link and the client's link; seconds until they may be sent."""
+        now = time.monotonic()
+        with self._locked():
+            _, rate, client_rate, link_free = HEADER.unpack_from(self.map)
+            start = now
+            if rate > 0:
+                start = max(link_free, now)
+                LINK_FREE.pack_into(self.map, len(MAGIC) + RATES.size, start + nbytes / rate)
+            if client_rate > 0:
+                offset, owner = self._slot(key, now)
+                _, client_free = SLOT.unpack_from(self.map, offset)
+                client_start = max(client_free, now)
+                SLOT.pack_into(self.map, offset, owner, client_start + nbytes / client_rate)
+                start = max(start, client_start)
+        return start - now
+
+    def charge(self, nbytes):
+        """Book `nbytes` that are sent straight away, pushing bulk transfers back."""
+        now = time.monotonic()
+        with self._locked():
+            _, rate, _, link_free = HEADER.unpack_from(self.map)
+            if rate > 0:
+                LINK_FREE.pack_into(self.map, len(MAGIC) + RATES.size, max(link_free, now) + nbytes / rate)
+
+    def _slot(self, key, now):
+        """
+        (offset, owner key) of the slot holding the client's link. Open
+        addressing over a few slots: the client's own, else an idle one it
+        takes over. When all of them are busy it shares the one that frees
+        up first, which stays its owner's: both clients then wait for each
+        other, and neither loses its booking.
+        """
+        first = key % SLOTS
+        idle = shared = None
+        for i in range(PROBE):
+            offset = HEADER.size + (first + i) % SLOTS * SLOT.size
+            slot_key, free_at = SLOT.unpack_from(self.map, offset)
+            if slot_key == key:
+                return offset, key
+            if slot_key == 0 or free_at <= now:
+                idle = idle or offset
+            elif shared is None or free_at < shared[2]:
+                shared = (offset, slot_key, free_at)
+        if idle is not None:
+            return idle, key
+        return shared[0], shared[1]
+
+
+class Transfer:
+    """One bulk transfer's turns on the links."""
+
+    def __init__(self, client, name):
+        self.key = client_key(client)
+        self.name = name
+        self.quantum = max(1, int(quantum * weights.get(name, 1.0)))
+        self.credit = 0
+        self.finished = False
+        with _active_lock:
+            _active[name] = _active.get(name, 0) + 1
+
+    def take(self, nbytes):
+        """Seconds to wait before sending the next `nbytes` bytes."""
+        if nbytes <= self.credit:
+            self.credit -= nbytes
+            return 0.0
+        if not links.enabled():
+            self.credit = 0
+            return 0.0
+        booked = max(self.quantum, nbytes - self.credit)
+        delay = links.book(self.key, booked)
+        self.credit += booked - nbytes
+        if delay > 0:
+            metrics.SHAPING_DELAY_SECONDS.inc(self.name, amount=delay)
+        return delay
+
+    def finish(self):
+        with _active_lock:
+            if not self.finished:
+                self.finished = True
+                _active[self.name] -= 1
+
+
+class ShapedBody:
+    """
+    A response body sent at the pace its Transfer is given. ftp/streaming.py
+    unwraps it and waits on the event loop instead of in a thread.
+    """
+
+    def __init__(self, body, transfer):
+        self.body = body
+        self.transfer = transfer
+
+    def __iter__(self):
+        for chunk in self.body:
+            delay = self.transfer.take(len(chunk))
+            if delay > 0:
+                time.sleep(delay)
+            yield chunk
+
+    def close(self):
+        self.transfer.finish()
+        close = getattr(self.body, "close", None)
+        if close is not None:
+            close()
+
+
+def begin(endpoint, client, length):
+    """
+    The Transfer pacing a `length`-byte body (None: unknown) sent by
+    `endpoint`, or None when the body goes out straight away.
+    """
+    if links is None or not links.enabled():
+        return None
+    name = TRANSFER_ENDPOINTS.get(endpoint)
+    if name is None or (length is not None and length <= small_bytes):
+        if length:
+            links.charge(length)
+        return None
+    return Transfer(client, name)
+
+
+def _shape_response(response):
+    if request.method == "HEAD" or response.status_code in (204, 304):
+        return response
+    transfer = begin(request.endpoint, request.remote_addr, response.content_length)
+    if transfer is not None:
+        response.response = ShapedBody(response.response, transfer)
+    return response
+
+
+def active_transfers():
+    with _active_lock:
+        return {(name,): count for name, count in _active.items()}
+
+
+def admin_shaping():
+    ftp.require_admin()
+
+    if request.method == "POST":
+        try:
+            changes = {name: int(request.values[name]) for name in SETTINGS if name in request.values}
+        except ValueError:
+            abort(400)
+        if not changes or min(changes.values()) < 0:
+            abort(400)
+        with get_db_connection() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO shaping_settings (name, value) VALUES (?, ?)", changes.items()
+            )
+        rate, client_rate = links.rates()
+        links.set_rates(changes.get("rate", rate), changes.get("client_rate", client_rate))
+        log.info("Bandwidth shaping changed: %s", changes)
+    elif request.method == "DELETE":
+        with get_db_connection() as conn:
+            conn.execute("DELETE FROM shaping_settings")
+        links.set_rates(configured["rate"], configured["client_rate"])
+        log.info("Bandwidth shaping back to the configured rates")
+
+    rate, client_rate = links.rates()
+    return jsonify(
+        rate=int(rate),
+        client_rate=int(client_rate),
+        configured=configured,
+        quantum=quantum,
+        small_bytes=small_bytes,
+        weights=weights,
+        transfers={name: count for (name,), count in active_transfers().items()},   # this process only
+    )
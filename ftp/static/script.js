@@ -0,0 +1,135 @@
+// ftp/static/script.js
+// In-page navigation between directory listings.
+//
+// Links inside #listing that point at another folder are fetched with an
+// "X-Fragment: listing" header; the server then returns only the listing
+// (see hypermedia_response), which is swapped in place of the current one.
+// Anything unexpected falls back to a normal page load.
+
+(function () {
+  function currentListing() {
+    return document.getElementById("listing");
+  }
+
+  function isFolderLink(link) {
+    if (!link || link.target || link.hasAttribute("download") || !link.closest("#listing")) {
+      return false;
+    }
+    const url = new URL(link.href, location.href);
+    return url.origin === location.origin && url.pathname.endsWith("/") && !url.search;
+  }
+
+  // Toolbar forms live outside the fragment; point them at the new folder
+  function syncToolbar(listing) {
+    const data = listing.dataset;
+    const parentInput = document.querySelector(".create-folder-form input[name='parent_dir']");
+    const uploadForm = document.querySelector(".upload-file-form");
+    const uploadFolderForm = document.querySelector(".upload-folder-form");
+    const dropInput = document.getElementById("drop-input");
+
+    if (parentInput) parentInput.value = data.dirpath;
+    if (uploadForm) uploadForm.action = data.uploadUrl;
+    if (uploadFolderForm) uploadFolderForm.action = data.uploadFolderUrl;
+    if (dropInput) {
+      dropInput.dataset.dirpath = data.dirpath;
+      dropInput.dataset.uploadUrl = data.uploadUrl;
+    }
+  }
+
+  async function navigate(url, push) {
+    const res = await fetch(url, { headers: { "X-Fragment": "listing" } });
+    const type = res.headers.get("Content-Type") || "";
+    if (!res.ok || !type.startsWith("text/html")) {
+      location.href = url;
+      return;
+    }
+
+    const template = document.createElement("template");
+    template.innerHTML = await res.text();
+    const next = template.content.getElementById("listing");
+    const listing = currentListing();
+    if (!next || !listing) {
+      location.href = url;
+      return;
+    }
+
+    listing.replaceWith(next);
+    syncToolbar(next);
+    if (push) history.pushState({ listing: true }, "", url);
+    window.scrollTo(0, 0);
+    document.dispatchEvent(new CustomEvent("listing:updated", { detail: { root: next } }));
+  }
+
+  document.addEventListener("click", (e) => {
+    if (e.defaultPrevented || e.button !== 0 || e.metaKey || e.ctrlKey || e.shiftKey || e.altKey) {
+      return;
+    }
+    const link = e.target.closest("a");
+    if (!isFolderLink(link)) return;
+
+    e.preventDefault();
+    navigate(link.href, true).catch(() => { location.href = link.href; });
+  });
+
+  window.addEventListener("popstate", () => {
+    if (currentListing()) {
+      navigate(location.href, false).catch(() => location.reload());
+    }
+  });
+})();
+
+// Move, rename and copy from the context menu. Cut/Copy remember the item
+// for this tab; Paste sends it to the server, into the folder that was
+// right-clicked or else the one being shown.
+window.fileAction = (function () {
+  function post(url, fields) {
+    const form = document.createElement("form");
+    form.method = "POST";
+    form.action = url;
+    for (const [name, value] of Object.entries(fields)) {
+      const input = document.createElement("input");
+      input.type = "hidden";
+      input.name = name;
+      input.value = value;
+      form.appendChild(input);
+    }
+    document.body.appendChild(form);
+    form.submit();
+  }
+
+  function join(dir, name) {
+    return dir ? `${dir}/${name}` : name;
+  }
+
+  function split(path) {
+    const i = path.lastIndexOf("/");
+    return i < 0 ? ["", path] : [path.slice(0, i), path.slice(i + 1)];
+  }
+
+  function copyName(name) {
+    const dot = name.lastIndexOf(".");
+    return dot > 0 ? `${name.slice(0, dot)} copy${name.slice(dot)}` : `${name} copy`;
+  }
+
+  return function (action, path, type) {
+    const [dir, name] = split(path);
+    if (action === "copy" || action === "cut") {
+      sessionStorage.setItem("clipboard", JSON.stringify({ op: action, path: path }));
+    } else if (action === "paste") {
+      const clip = JSON.parse(sessionStorage.getItem("clipboard") || "null");
+      if (!clip) return true;
+      const listing = document.getElementById("listing");
+      const target = type === "folder" ? path : (listing ? listing.dataset.dirpath : dir);
+      if (clip.op === "cut") sessionStorage.removeItem("clipboard");
+      post(clip.op === "cut" ? "/move" : "/copy", { src: clip.path, dest: join(target, split(clip.path)[1]) });
+    } else if (action === "duplicate") {
+      post("/copy", { src: path, dest: join(dir, copyName(name)) });
+    } else if (action === "rename") {
+      const newName = prompt("New name", name);
+      if (newName && newName !== name) post("/move", { src: path, dest: join(dir, newName) });
+    } else {
+      return false;
+    }
+    return true;
+  };
+})();
@@ -0,0 +1,411 @@
+# ftp/streaming.py
+# ASGI serving mode for long transfers (SERVER_PROFILE=async).
+#
+# Under waitress or gunicorn a response holds its worker thread until the
+# last byte has been written, so a few slow clients pulling large files can
+# starve directory listings. StreamingApp serves the same Flask app from an
+# asyncio event loop instead:
+#
+#   - Flask views still run on a small thread pool, but the thread is handed
+#     back as soon as the view has returned its response;
+#   - file bodies (send_file / /download), followed files (SSE) and /raw
+#     proxied from the Go service are written by the event loop, one chunk
+#     at a time, and the next chunk is only read once the client has taken
+#     the previous one, so memory per transfer stays at one chunk. /raw
+#     goes through its Flask view and hooks like any other request; the
+#     view only hands the read from Go over to the event loop
+#     (UpstreamBody);
+#   - any other streamed body is pulled chunk by chunk on the pool, so it
+#     never holds a thread while a slow client drains the socket;
+#   - transfers held back by bandwidth shaping (ftp/shaping.py) wait for
+#     their turn on the event loop, not in a pool thread;
+#   - request bodies reach the view as they arrive (RequestBody): the event
+#     loop only takes the next piece from the client once the view has read
+#     most of the previous ones, so a PUT of several GB is never held in
+#     memory or spooled to disk on the way in.
+
+import asyncio
+import collections
+import functools
+import io
+import logging
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.exceptions import ClientDisconnected, default_exceptions
+from werkzeug.wsgi import FileWrapper, _RangeWrapper
+import ftp.metrics as metrics
+import ftp.shaping as shaping
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+CHUNK_SIZE = 64 * 1024
+BODY_BUFFER_SIZE = 1024 * 1024   # request body read ahead of the view, at most
+
+_DONE = object()
+
+log = logging.getLogger(__name__)
+
+
+class FileBody(FileWrapper):
+    """
+    wsgi.file_wrapper for the bridge: send_file() wraps the open file in
+    this, and StreamingApp streams it from the event loop instead of
+    iterating it on a thread.
+    """
+
+    def __init__(self, file, buffer_size=CHUNK_SIZE):
+        super().__init__(file, buffer_size)
+
+
+class RequestBody(io.RawIOBase):
+    """
+    wsgi.input for the bridge. The event loop feeds in the body as the
+    client sends it; the view reads it on its pool thread, waiting for more
+    when it gets ahead of the client.
+    """
+
+    def __init__(self, loop):
+        self._loop = loop
+        self._cond = threading.Condition()
+        self._chunks = collections.deque()
+        self._buffered = 0
+        self._ended = False
+        self._disconnected = False
+        self._discarding = False
+        self._room = asyncio.Event()
+        self._room.set()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        with self._cond:
+            while not self._chunks and not self._ended:
+                self._cond.wait()
+            if not self._chunks:
+                if self._disconnected:
+                    raise ClientDisconnected()
+                return 0
+            chunk = self._chunks[0]
+            n = min(len(buffer), len(chunk))
+            buffer[:n] = chunk[:n]
+            if n < len(chunk):
+                self._chunks[0] = chunk[n:]
+            else:
+                self._chunks.popleft()
+            self._buffered -= n
+            if self._buffered < BODY_BUFFER_SIZE:
+                self._loop.call_soon_threadsafe(self._room.set)
+            return n
+
+    async def feed(self, data):
+        """Hand over a piece of the body; returns once there is room for the next."""
+        with self._cond:
+            if self._discarding or not data:
+                return
+            self._chunks.append(memoryview(data))
+            self._buffered += len(data)
+            if self._buffered >= BODY_BUFFER_SIZE:
+                self._room.clear()
+            self._cond.notify_all()
+        await self._room.wait()
+
+    def end(self, disconnected=False):
+        with self._cond:
+            self._ended = True
+            self._disconnected = disconnected
+            self._cond.notify_all()
+
+    def discard(self):
+        """The view is done: drop whatever of the body it did not read."""
+        with self._cond:
+            self._discarding = True
+            self._chunks.clear()
+            self._buffered = 0
+        self._loop.call_soon_threadsafe(self._room.set)
+
+
+class StreamingApp:
+    """ASGI application wrapping the Flask app."""
+
+    def __init__(self, flask_app, threads=8):
+        self.flask_app = flask_app
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="flask")
+        self.client = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self.client is not None:
+                    await self.client.aclose()
+                self.executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _http(self, scope, receive, send):
+        loop = asyncio.get_running_loop()
+        body = RequestBody(loop)
+        # The only reader of `receive`: the body, then the disconnect
+        disconnected = asyncio.ensure_future(_receive(receive, body))
+        try:
+            environ = build_environ(scope, io.BufferedReader(body, CHUNK_SIZE))
+            if self._too_large(environ):
+                # Refused before the view runs, without reading any of the body
+                body.discard()
+                await self._send_error(environ, 413, send, disconnected, lambda status: None)
+                return
+            if scope["method"] == "GET" and httpx is not None:
+                # The /raw view asks through this for the Go service's answer
+                environ["ftp.fetch_upstream"] = functools.partial(self._fetch_upstream, loop)
+
+            try:
+                status, headers, chunks = await loop.run_in_executor(self.executor, self._call_flask, environ)
+            finally:
+                body.discard()
+            await self._respond(status, headers, chunks, send, disconnected)
+        finally:
+            disconnected.cancel()
+
+    def _call_flask(self, environ):
+        """Run the Flask app up to the point where it returns its body."""
+        return _call_wsgi(self.flask_app, environ)
+
+    def _too_large(self, environ):
+        """Content-Length over anything any view accepts (PUT has the highest limit)."""
+        config = self.flask_app.config
+        limits = [config.get("MAX_CONTENT_LENGTH"), config.get("PUT_MAX_CONTENT_LENGTH")]
+        if None in limits:
+            return False
+        try:
+            return int(environ.get("CONTENT_LENGTH") or 0) > max(limits)
+        except ValueError:
+            return False
+
+    def _render_error(self, environ, code, **kwargs):
+        # Same error pages as the synchronous routes (404.html, 502.html, ...)
+        with self.flask_app.request_context(environ):
+            response = self.flask_app.make_response(
+                self.flask_app.handle_http_exception(default_exceptions[code](**kwargs))
+            )
+        return _call_wsgi(response, environ)
+
+    async def _send_error(self, environ, code, send, disconnected, headers_ready, **kwargs):
+        loop = asyncio.get_running_loop()
+        error = await loop.run_in_executor(self.executor, lambda: self._render_error(environ, code, **kwargs))
+        headers_ready(error[0])
+        await self._respond(*error, send, disconnected)
+
+    async def _respond(self, status, headers, chunks, send, disconnected):
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers],
+        })
+        try:
+            completed = await _pump(self._body_chunks(chunks), send, disconnected)
+        finally:
+            if hasattr(chunks, "close"):
+                chunks.close()
+        if completed:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    def _body_chunks(self, chunks):
+        if isinstance(chunks, shaping.ShapedBody):
+            return _paced_chunks(self._body_chunks(chunks.body), chunks.transfer)
+        if isinstance(chunks, FileBody):
+            return _file_chunks(chunks.file, 0, None)
+        if isinstance(chunks, _RangeWrapper) and isinstance(chunks.iterable, FileBody):
+            return _file_chunks(chunks.iterable.file, chunks.start_byte, chunks.end_byte)
+        if hasattr(chunks, "__aiter__"):
+            return chunks
+        return _pool_chunks(iter(chunks))
+
+    def _fetch_upstream(self, loop, url, headers, done):
+        """
+        ftp.fetch_upstream for the /raw view (directories._fetch_from_go):
+        waits here for the Go service's headers, and leaves the body to the
+        event loop.
+        """
+        r = asyncio.run_coroutine_threadsafe(self._open_upstream(url, headers), loop).result()
+        return r.status_code, r.headers, UpstreamBody(r, loop, done)
+
+    async def _open_upstream(self, url, headers):
+        if self.client is None:
+            self.client = httpx.AsyncClient(timeout=httpx.Timeout(30, connect=5))
+        try:
+            return await self.client.send(self.client.build_request("GET", url, headers=headers), stream=True)
+        except httpx.TimeoutException as e:
+            raise TimeoutError(str(e)) from e
+        except httpx.HTTPError as e:
+            raise ConnectionError(str(e)) from e
+
+
+class UpstreamBody:
+    """A /raw body from the Go service, relayed by the event loop chunk by chunk."""
+
+    def __init__(self, response, loop, done):
+        self._response = response
+        self._loop = loop
+        self._done = done
+        self._closed = False
+
+    def __aiter__(self):
+        return _count_async_bytes(self._response.aiter_raw(CHUNK_SIZE))
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        # On the event loop after sending, or on a pool thread if the view gave up on it
+        asyncio.run_coroutine_threadsafe(self._response.aclose(), self._loop)
+        self._done()
+
+
+def create_asgi_app():
+    """Factory for `uvicorn --factory ftp.streaming:create_asgi_app`."""
+    from ftp import create_app
+    return StreamingApp(create_app(start_go=False), threads=int(os.getenv("WEB_THREADS", 8)))
+
+
+def build_environ(scope, body):
+    """PEP 3333 environ for an ASGI HTTP scope."""
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "REMOTE_PORT": str(client[1]),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body,
+        "wsgi.input_terminated": True,   # ends where the body ends, so bodies without Content-Length work
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+        "wsgi.file_wrapper": FileBody,
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        key = name if name in ("CONTENT_TYPE", "CONTENT_LENGTH") else f"HTTP_{name}"
+        if key in environ:
+            sep = "; " if key == "HTTP_COOKIE" else ","
+            environ[key] = f"{environ[key]}{sep}{value}"
+        else:
+            environ[key] = value
+    return environ
+
+
+def _call_wsgi(app, environ):
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started["status"] = int(status.split(" ", 1)[0])
+        started["headers"] = headers
+
+    chunks = app(environ, start_response)
+    return started["status"], started["headers"], chunks
+
+
+async def _receive(receive, body):
+    """Feed the request body into `body`, then return once the client disconnects."""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            body.end(disconnected=True)
+            return
+        await body.feed(message.get("body", b""))
+        if not message.get("more_body", False):
+            body.end()
+            break
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+async def _pump(chunks, send, disconnected):
+    """
+    Send chunks until they run out (True) or the client goes away (False).
+    `send` only returns once the transport can take more, so a slow client
+    slows down how fast we read, not how much we buffer.
+    """
+    chunks = chunks.__aiter__()
+    try:
+        while True:
+            following = asyncio.ensure_future(chunks.__anext__())
+            await asyncio.wait({following, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+            if not following.done():
+                following.cancel()
+                await asyncio.wait({following})
+                return False
+            try:
+                chunk = following.result()
+            except StopAsyncIteration:
+                return True
+            if chunk:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+    finally:
+        if hasattr(chunks, "aclose"):
+            await chunks.aclose()
+
+
+async def _file_chunks(file, start, end):
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, file.seek, start)
+    remaining = None if end is None else end - start
+    while remaining is None or remaining > 0:
+        size = CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining)
+        data = await loop.run_in_executor(None, file.read, size)
+        if not data:
+            return
+        if remaining is not None:
+            remaining -= len(data)
+        yield data
+
+
+async def _count_async_bytes(chunks):
+    async for chunk in chunks:
+        metrics.PROXY_BYTES.inc(amount=len(chunk))
+        yield chunk
+
+
+async def _paced_chunks(chunks, transfer):
+    """Pass `chunks` through at the pace of a shaped transfer (ftp/shaping.py)."""
+    try:
+        async for chunk in chunks:
+            delay = transfer.take(len(chunk))
+            if delay > 0:
+                await asyncio.sleep(delay)
+            yield chunk
+    finally:
+        if hasattr(chunks, "aclose"):
+            await chunks.aclose()
+
+
+async def _pool_chunks(iterator):
+    loop = asyncio.get_running_loop()
+    while True:
+        chunk = await loop.run_in_executor(None, next, iterator, _DONE)
+        if chunk is _DONE:
+            return
+        yield chunk
@@ -0,0 +1,399 @@
+# ftp/tail.py
+# Live "follow" support for growing files (logs, build output, ...).
+#
+# A single TailHub owns one reader per followed file, no matter how many
+# browsers are watching it. Appended bytes are read once and fanned out to
+# every subscriber queue. Change notification uses inotify on Linux and
+# falls back to stat polling everywhere else.
+#
+# A rotated log (renamed away, then created again under its name) is picked
+# up under the new name: inotify also watches each followed file's folder for
+# that name appearing, since the watch on the file itself stays with the old,
+# renamed file.
+
+import asyncio
+import codecs
+import ctypes
+import ctypes.util
+import os
+import queue
+import select
+import struct
+import threading
+import time
+
+# inotify constants (see <sys/inotify.h>)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_DELETE_SELF | IN_MOVE_SELF
+DIR_WATCH_MASK = IN_CREATE | IN_MOVED_TO
+EVENT_HEADER = struct.Struct("iIII")
+
+hub = None
+
+READ_CHUNK = 64 * 1024
+BACKLOG_BYTES = 8 * 1024
+SUBSCRIBER_QUEUE_SIZE = 256
+
+
+def init_app(app):
+    global hub
+    hub = TailHub(poll_interval=app.config["TAIL_POLL_INTERVAL"])
+
+
+def _load_inotify():
+    """Return libc with inotify symbols, or None when unavailable."""
+    if not hasattr(os, "pread"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+def _read_at(fd, size, offset):
+    if hasattr(os, "pread"):
+        return os.pread(fd, size, offset)
+    # Windows has no pread; every read happens under the hub lock so seek+read is safe
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, size)
+
+
+class Subscription:
+    """One viewer of a followed file. Events are (kind, offset, data) tuples."""
+
+    def __init__(self, tail):
+        self.tail = tail
+        self.queue = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.closed = False
+        self.wakeup = None    # called after each push; set by async readers
+
+    def push(self, event):
+        if self.closed:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            # A viewer that cannot keep up is dropped instead of stalling the reader;
+            # the browser reconnects with Last-Event-ID and resumes from its offset.
+            self.closed = True
+            with self.queue.mutex:
+                self.queue.queue.clear()
+            self.queue.put_nowait(("lagged", None, b""))
+        if self.wakeup is not None:
+            self.wakeup()
+
+
+class _FollowedFile:
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+        st = os.fstat(self.fd)
+        self.ino = st.st_ino
+        self.offset = st.st_size
+        self.subscribers = set()
+        self.wd = None
+        self.dir_wd = None
+
+    def close(self):
+        try:
+            os.close(self.fd)
+        except OSError:
+            pass
+
+
+class TailHub:
+    """Shares a single reader per file between all of its followers."""
+
+    def __init__(self, poll_interval=1.0):
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._files = {}      # path -> _FollowedFile
+        self._watches = {}    # inotify wd -> [_FollowedFile]
+        self._dir_watches = {}   # inotify wd of a folder -> [_FollowedFile] in it
+        self._thread = None
+        self._libc = _load_inotify()
+        self._inotify_fd = None
+        if self._libc is not None:
+            fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0:
+                self._inotify_fd = fd
+            else:
+                self._libc = None
+
+    @property
+    def mode(self):
+        return "inotify" if self._inotify_fd is not None else "polling"
+
+    def subscribe(self, path, resume_from=None):
+        """
+        Start following `path`. The subscriber first receives a backlog
+        (from `resume_from` if given, otherwise the last few KB), then every
+        byte appended afterwards.
+        """
+        path = os.path.abspath(path)
+        with self._lock:
+            followed = self._files.get(path)
+            if followed is None:
+                followed = _FollowedFile(path)
+                self._files[path] = followed
+                self._add_watch(followed)
+                self._add_dir_watch(followed)
+            sub = Subscription(followed)
+            followed.subscribers.add(sub)
+
+            end = followed.offset
+            start = max(0, end - BACKLOG_BYTES)
+            if resume_from is not None and 0 <= resume_from <= end:
+                start = max(resume_from, end - BACKLOG_BYTES * 8)
+            if start < end:
+                sub.push(("data", end, _read_at(followed.fd, end - start, start)))
+
+            self._ensure_thread()
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            sub.closed = True
+            followed = sub.tail
+            followed.subscribers.discard(sub)
+            if not followed.subscribers and self._files.get(followed.path) is followed:
+                del self._files[followed.path]
+                self._remove_watch(followed)
+                self._remove_dir_watch(followed)
+                followed.close()
+
+    def _add_watch(self, followed):
+        if self._inotify_fd is None:
+            return
+        wd = self._libc.inotify_add_watch(self._inotify_fd, os.fsencode(followed.path), WATCH_MASK)
+        if wd >= 0:
+            followed.wd = wd
+            self._watches.setdefault(wd, []).append(followed)
+
+    def _remove_watch(self, followed):
+        if followed.wd is None:
+            return
+        # Several paths may share a wd (hard links); only drop it when unused
+        watchers = self._watches.get(followed.wd, [])
+        if followed in watchers:
+            watchers.remove(followed)
+        if not watchers:
+            self._watches.pop(followed.wd, None)
+            self._libc.inotify_rm_watch(self._inotify_fd, followed.wd)
+        followed.wd = None
+
+    def _add_dir_watch(self, followed):
+        if self._inotify_fd is None:
+            return
+        wd = self._libc.inotify_add_watch(self._inotify_fd, os.fsencode(os.path.dirname(followed.path)), DIR_WATCH_MASK)
+        if wd >= 0:
+            followed.dir_wd = wd
+            self._dir_watches.setdefault(wd, []).append(followed)
+
+    def _remove_dir_watch(self, followed):
+        if followed.dir_wd is None:
+            return
+        watchers = self._dir_watches.get(followed.dir_wd, [])
+        if followed in watchers:
+            watchers.remove(followed)
+        if not watchers:
+            self._dir_watches.pop(followed.dir_wd, None)
+            self._libc.inotify_rm_watch(self._inotify_fd, followed.dir_wd)
+        followed.dir_wd = None
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="tail-hub", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            if self._inotify_fd is not None:
+                changed = self._wait_inotify()
+            else:
+                time.sleep(self.poll_interval)
+                with self._lock:
+                    changed = list(self._files.values())
+
+            with self._lock:
+                for followed in changed:
+                    if self._files.get(followed.path) is followed:
+                        self._pump(followed)
+                if not self._files:
+                    self._thread = None
+                    return
+
+    def _wait_inotify(self):
+        # Blocks in the kernel until one of the watched files changes. The
+        # timeout only exists so an idle hub thread can notice it has no files.
+        ready, _, _ = select.select([self._inotify_fd], [], [], 30)
+        if not ready:
+            return []
+        try:
+            buf = os.read(self._inotify_fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        changed = []
+        pos = 0
+        with self._lock:
+            while pos + EVENT_HEADER.size <= len(buf):
+                wd, mask, _cookie, name_len = EVENT_HEADER.unpack_from(buf, pos)
+                name = buf[pos + EVENT_HEADER.size:pos + EVENT_HEADER.size + name_len].rstrip(b"\0")
+                pos += EVENT_HEADER.size + name_len
+                if wd in self._dir_watches:
+                    # Something appeared in a folder: a followed name recreated?
+                    in_folder = self._dir_watches[wd]
+                    if mask & IN_IGNORED:
+                        del self._dir_watches[wd]
+                    for followed in in_folder:
+                        if mask & IN_IGNORED:
+                            followed.dir_wd = None
+                        elif os.fsencode(os.path.basename(followed.path)) == name and followed not in changed:
+                            changed.append(followed)
+                    continue
+                watchers = self._watches.get(wd, [])
+                if mask & IN_IGNORED:
+                    self._watches.pop(wd, None)
+                for followed in watchers:
+                    if mask & IN_IGNORED:
+                        followed.wd = None
+                    if followed not in changed:
+                        changed.append(followed)
+        return changed
+
+    def _pump(self, followed):
+        """Read everything appended since the last pump and fan it out."""
+        try:
+            st = os.stat(followed.path)
+        except OSError:
+            st = None
+
+        if st is None or st.st_ino != followed.ino:
+            # Rotated or deleted. Lines written to the old file before the
+            # writer let go of it are still sent; then switch to the new
+            # file under the same name, once there is one.
+            self._drain(followed, os.fstat(followed.fd).st_size)
+            if st is None:
+                return
+            followed.close()
+            self._remove_watch(followed)
+            followed.fd = os.open(followed.path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+            followed.ino = os.fstat(followed.fd).st_ino
+            followed.offset = 0
+            self._add_watch(followed)
+            self._broadcast(followed, ("reset", 0, b""))
+            size = os.fstat(followed.fd).st_size
+        else:
+            size = st.st_size
+
+        if size < followed.offset:
+            # Truncated in place (e.g. `> logfile`)
+            followed.offset = 0
+            self._broadcast(followed, ("reset", 0, b""))
+
+        self._drain(followed, size)
+
+    def _drain(self, followed, size):
+        while followed.offset < size:
+            data = _read_at(followed.fd, min(READ_CHUNK, size - followed.offset), followed.offset)
+            if not data:
+                break
+            followed.offset += len(data)
+            self._broadcast(followed, ("data", followed.offset, data))
+
+    def _broadcast(self, followed, event):
+        for sub in list(followed.subscribers):
+            sub.push(event)
+
+
+class SSEStream:
+    """
+    Server-Sent Events for a subscription. The event id is the byte offset
+    reached, so a reconnecting EventSource resumes where it left off.
+
+    Iterating it blocks a thread per viewer, which is what WSGI servers do.
+    The ASGI streaming mode iterates it asynchronously instead, so a viewer
+    only costs a queue and an event (see ftp/streaming.py).
+    """
+
+    def __init__(self, hub, sub, keepalive=15):
+        self.hub = hub
+        self.sub = sub
+        self.keepalive = keepalive
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.closed = False
+
+    def __iter__(self):
+        try:
+            yield b"retry: 2000\n\n"
+            while True:
+                try:
+                    event = self.sub.queue.get(timeout=self.keepalive)
+                except queue.Empty:
+                    yield b": keepalive\n\n"
+                    continue
+                chunk = self._format(event)
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            self.close()
+
+    async def __aiter__(self):
+        loop = asyncio.get_running_loop()
+        wakeup = asyncio.Event()
+        self.sub.wakeup = lambda: loop.call_soon_threadsafe(wakeup.set)
+        try:
+            yield b"retry: 2000\n\n"
+            while True:
+                # Clear before looking, so a push in between still wakes us
+                wakeup.clear()
+                try:
+                    event = self.sub.queue.get_nowait()
+                except queue.Empty:
+                    try:
+                        await asyncio.wait_for(wakeup.wait(), self.keepalive)
+                    except asyncio.TimeoutError:
+                        yield b": keepalive\n\n"
+                    continue
+                chunk = self._format(event)
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            self.close()
+
+    def _format(self, event):
+        kind, offset, data = event
+        if kind == "lagged":
+            # No id here: the browser keeps the last offset it really received
+            return None
+        if kind == "reset":
+            self.decoder.reset()
+            return f"id: {offset}\nevent: reset\ndata: \n\n".encode("utf-8")
+
+        text = self.decoder.decode(data).replace("\r\n", "\n").replace("\r", "\n")
+        lines = "\n".join(f"data: {line}" for line in text.split("\n"))
+        return f"id: {offset}\n{lines}\n\n".encode("utf-8")
+
+    def close(self):
+        # Called by the WSGI server (or the ASGI bridge) when the client goes away
+        if not self.closed:
+            self.closed = True
+            self.sub.wakeup = None
+            self.hub.unsubscribe(self.sub)
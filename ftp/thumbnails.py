@@ -0,0 +1,165 @@
+# ftp/thumbnails.py
+# Resized image previews for directory listings.
+#
+# Thumbnails are rendered in a process pool (Pillow decoding is CPU bound
+# and would otherwise hold the GIL), written to a disk cache keyed by the
+# identity of the source content, and evicted least recently used first once the cache
+# grows past its byte budget. Concurrent requests for the same thumbnail
+# share a single render job.
+
+import hashlib
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import ftp.metrics as metrics
+
+try:
+    import PIL  # noqa: F401  (only needed to know whether thumbnails are possible)
+    enabled = True
+except ImportError:
+    enabled = False
+
+THUMBNAIL_SIZES = (128, 256, 512)
+DEFAULT_SIZE = 256
+
+# Source formats Pillow can decode for us; SVG and friends keep their icon
+SUPPORTED_MIME_TYPES = {
+    "image/jpeg", "image/png", "image/gif", "image/webp", "image/bmp", "image/tiff",
+}
+
+cache_dir = None
+max_cache_bytes = 0
+max_workers = None
+
+_pool = None
+_lock = threading.RLock()
+_inflight = {}        # cache key -> Future
+_cache_bytes = 0
+
+
+def init_app(app):
+    global cache_dir, max_cache_bytes, max_workers, _cache_bytes
+    cache_dir = os.path.abspath(app.config["THUMBNAIL_CACHE_PATH"])
+    max_cache_bytes = app.config["THUMBNAIL_CACHE_MAX_BYTES"]
+    max_workers = app.config["THUMBNAIL_WORKERS"]
+    os.makedirs(cache_dir, exist_ok=True)
+    _cache_bytes = sum(size for _, _, size in _cached_files())
+
+    app.jinja_env.globals["thumbnails_enabled"] = enabled
+
+
+def _render(src_path, dest_path, size, fmt):
+    """Runs inside a pool worker. Returns the number of bytes written."""
+    from PIL import Image, ImageOps
+
+    with Image.open(src_path) as img:
+        # Let the JPEG decoder downscale while decoding; much cheaper than a full decode
+        img.draft("RGB", (size * 2, size * 2))
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((size, size))
+
+        if fmt == "jpeg" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        elif fmt == "webp" and img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+
+        tmp_path = f"{dest_path}.{os.getpid()}.tmp"
+        options = {"quality": 80, "method": 4} if fmt == "webp" else {"quality": 80, "optimize": True}
+        img.save(tmp_path, format=fmt.upper(), **options)
+
+    os.replace(tmp_path, dest_path)
+    return os.path.getsize(dest_path)
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=max_workers)
+    return _pool
+
+
+def cache_key(st, size, fmt):
+    """Identify a thumbnail by the exact version of its source file."""
+    ident = f"{st.st_dev}:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}:{size}:{fmt}"
+    return hashlib.sha256(ident.encode()).hexdigest()
+
+
+def _cache_path(key, fmt):
+    return os.path.join(cache_dir, key[:2], f"{key}.{'jpg' if fmt == 'jpeg' else fmt}")
+
+
+def _cached_files():
+    for dirpath, _, filenames in os.walk(cache_dir):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            yield path, st.st_mtime, st.st_size
+
+
+def _evict():
+    """Drop least recently used thumbnails until the cache is back under 90% of budget."""
+    global _cache_bytes
+    target = max_cache_bytes * 0.9
+    for path, _, size in sorted(_cached_files(), key=lambda entry: entry[1]):
+        if _cache_bytes <= target:
+            break
+        try:
+            os.remove(path)
+            _cache_bytes -= size
+        except OSError:
+            pass
+
+
+def _job_done(key, future):
+    global _cache_bytes
+    with _lock:
+        _inflight.pop(key, None)
+        if future.exception() is None:
+            _cache_bytes += future.result()
+            if _cache_bytes > max_cache_bytes:
+                _evict()
+
+
+def get_thumbnail(full_path, size, fmt, timeout=30):
+    """
+    Return the path of a cached thumbnail for `full_path`, rendering it first
+    if needed. Raises OSError if the source cannot be read and whatever
+    Pillow raised if it cannot be decoded.
+    """
+    global _pool
+    st = os.stat(full_path)
+    key = cache_key(st, size, fmt)
+    dest_path = _cache_path(key, fmt)
+
+    try:
+        # Touch on hit so eviction is least-recently-used rather than oldest-first
+        os.utime(dest_path)
+        metrics.CACHE_LOOKUPS.inc("thumbnails", "hit")
+        return dest_path
+    except FileNotFoundError:
+        metrics.CACHE_LOOKUPS.inc("thumbnails", "miss")
+
+    with _lock:
+        future = _inflight.get(key)
+        if future is None:
+            os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+            try:
+                future = _get_pool().submit(_render, full_path, dest_path, size, fmt)
+            except BrokenProcessPool:
+                # A worker died (e.g. OOM on a huge image); start a fresh pool
+                _pool = None
+                future = _get_pool().submit(_render, full_path, dest_path, size, fmt)
+            _inflight[key] = future
+            future.add_done_callback(lambda f: _job_done(key, f))
+
+    future.result(timeout=timeout)
+    return dest_path
+
+
+def shutdown():
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,289 @@
+# ftp/trash.py
+# Deleting moves things to the trash instead of removing them on the spot.
+#
+# A delete is one rename into a trash folder on the same filesystem as the
+# item (".ftp-trash" at the top of that filesystem inside the upload base,
+# so the rename never has to copy), plus one transaction that records it in
+# the `trash` table and renames its `files`/`directories` rows out of the
+# way. That takes the same time for one file as for a million, so the
+# request returns straight away.
+#
+# Items can be restored from /trash until they are older than
+# TRASH_RETENTION seconds. After that a background purger deletes them,
+# a few thousand entries per second at most, at idle I/O priority where
+# the OS supports it, so purging never competes with serving files. Only
+# one process per host purges at a time.
+
+import ctypes
+import datetime
+import logging
+import os
+import platform
+import threading
+import time
+import ftp
+import ftp.hashes as hashes
+import ftp.journal as journal
+from ftp.models import ensure_directory_exists, get_db_connection, lookup_directory_id
+
+log = logging.getLogger(__name__)
+
+TRASH_DIR = ".ftp-trash"
+PURGE_BATCH = 100
+
+# ioprio_set(2) is not wrapped by Python; syscall numbers per architecture
+IOPRIO_SET_SYSCALLS = {"x86_64": 251, "aarch64": 30, "i686": 289, "armv7l": 314}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+
+upload_base_path = None
+retention = 0
+purge_interval = 0
+purge_rate = 0
+
+
+
+def init_app(app):
+    global upload_base_path, retention, purge_interval, purge_rate
+    upload_base_path = os.path.abspath(app.config["UPLOAD_BASE_PATH"])
+    retention = app.config["TRASH_RETENTION"]
+    purge_interval = app.config["TRASH_PURGE_INTERVAL"]
+    purge_rate = app.config["TRASH_PURGE_RATE"]
+
+    # Databases created before the trash existed
+    with get_db_connection() as conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS trash (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                original_path TEXT NOT NULL,
+                trash_path TEXT,
+                kind TEXT NOT NULL,
+                item_name TEXT NOT NULL,
+                deleted_at DATETIME NOT NULL,
+                state TEXT NOT NULL DEFAULT 'trashed'
+            )
+        """)
+
+    if purge_interval > 0:
+        start_purger()
+
+
+def is_hidden(path):
+    """True for paths inside a trash folder, which are never served."""
+    return TRASH_DIR in path.replace("\\", "/").split("/")
+
+
+def _normalize(path):
+    if path.startswith("root/"):
+        path = path[5:]
+    path = path.strip("/")
+    if not path or path == "root" or is_hidden(path):
+        raise ValueError("Cannot delete this path")
+    return path
+
+
+def _trash_dir_for(physical_path):
+    """Trash folder on the same filesystem as `physical_path`."""
+    device = os.lstat(physical_path).st_dev
+    top = os.path.dirname(physical_path)
+    while top != upload_base_path:
+        parent = os.path.dirname(top)
+        if os.path.commonpath([upload_base_path, parent]) != upload_base_path or os.lstat(parent).st_dev != device:
+            break
+        top = parent
+    return os.path.join(top, TRASH_DIR)
+
+
+def _table(kind):
+    return ("files", "directory_id") if kind == "file" else ("directories", "parent_id")
+
+
+def move_to_trash(path, kind):
+    """Move a file or directory (relative to the upload base) to the trash. Returns the trash id."""
+    path = _normalize(path)
+    physical_path = os.path.join(upload_base_path, path)
+    if not os.path.lexists(physical_path):
+        raise FileNotFoundError(f"'{path}' does not exist")
+    if (kind == "directory") != os.path.isdir(physical_path):
+        raise ValueError(f"'{path}' is not a {kind}")
+
+    trash_dir = _trash_dir_for(physical_path)
+    os.makedirs(trash_dir, exist_ok=True)
+
+    parts = path.split("/")
+    table, parent_column = _table(kind)
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT INTO trash (original_path, kind, item_name, deleted_at) VALUES (?, ?, ?, ?)",
+            (path, kind, parts[-1], datetime.datetime.utcnow().isoformat())
+        )
+        trash_id = cursor.lastrowid
+        trash_path = os.path.join(trash_dir, f"{trash_id}-{parts[-1]}")
+        cursor.execute("UPDATE trash SET trash_path=? WHERE id=?", (trash_path, trash_id))
+
+        # Rename the rows out of the namespace; names never contain "/"
+        parent_id = lookup_directory_id(cursor, parts[:-1])
+        if parent_id is not False:
+            cursor.execute(
+                f"UPDATE {table} SET name=?, {parent_column}=NULL WHERE name=? AND {parent_column} IS ?",
+                (f"{TRASH_DIR}/{trash_id}", parts[-1], parent_id)
+            )
+        hashes.move(cursor, path, hashes.relative(trash_path))
+
+        # Last, so a failed rename rolls the transaction back
+        os.rename(physical_path, trash_path)
+        journal.record("delete", path, kind=kind, conn=conn)
+
+    log.info("Moved %s '%s' to the trash (%s)", kind, path, trash_id)
+    return trash_id
+
+
+def restore(trash_id):
+    """Put a trashed item back where it was. Returns its path."""
+    with get_db_connection() as conn:
+        row = conn.execute("SELECT * FROM trash WHERE id=? AND state='trashed'", (trash_id,)).fetchone()
+    if row is None:
+        raise LookupError("This item is no longer in the trash.")
+
+    path = row["original_path"]
+    physical_path = os.path.join(upload_base_path, path)
+    if os.path.lexists(physical_path):
+        raise FileExistsError(f"'{path}' already exists.")
+    new_dir = journal.first_missing(os.path.dirname(physical_path))
+    os.makedirs(os.path.dirname(physical_path), exist_ok=True)
+    if new_dir:
+        journal.record("create", new_dir)
+    dirname = os.path.dirname(path)
+    parent_id = ensure_directory_exists(dirname) if dirname else None
+
+    table, parent_column = _table(row["kind"])
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        # Claims the item; fails if the purger got to it first
+        cursor.execute("DELETE FROM trash WHERE id=? AND state='trashed'", (trash_id,))
+        if cursor.rowcount == 0:
+            raise LookupError("This item is no longer in the trash.")
+        cursor.execute(
+            f"UPDATE {table} SET name=?, {parent_column}=? WHERE name=? AND {parent_column} IS NULL",
+            (row["item_name"], parent_id, f"{TRASH_DIR}/{trash_id}")
+        )
+        hashes.move(cursor, hashes.relative(row["trash_path"]), path)
+        os.rename(row["trash_path"], physical_path)
+        journal.record("create", path, conn=conn)
+
+    log.info("Restored '%s' from the trash (%s)", path, trash_id)
+    return path
+
+
+def list_items():
+    with get_db_connection() as conn:
+        rows = conn.execute(
+            "SELECT id, original_path, kind, deleted_at FROM trash WHERE state='trashed' ORDER BY deleted_at DESC"
+        ).fetchall()
+    items = []
+    for row in rows:
+        deleted_at = datetime.datetime.fromisoformat(row["deleted_at"])
+        items.append({
+            "id": row["id"],
+            "path": row["original_path"],
+            "kind": row["kind"],
+            "deleted_at": deleted_at,
+            "purge_at": deleted_at + datetime.timedelta(seconds=retention),
+        })
+    return items
+
+
+# Purging
+
+def purge_expired():
+    """Delete everything that has been in the trash longer than the retention period."""
+    cutoff = (datetime.datetime.utcnow() - datetime.timedelta(seconds=retention)).isoformat()
+    with get_db_connection() as conn:
+        # 'purging' rows were left by a purge that was interrupted
+        rows = conn.execute(
+            "SELECT id, trash_path, kind FROM trash WHERE state IN ('trashed', 'purging') AND deleted_at <= ?",
+            (cutoff,)
+        ).fetchall()
+
+    for row in rows:
+        with get_db_connection() as conn:
+            conn.execute("UPDATE trash SET state='purging' WHERE id=?", (row["id"],))
+        if row["trash_path"]:
+            _remove_tree(row["trash_path"])
+        _delete_rows(row["id"], row["kind"])
+        log.info("Purged trash item %s", row["id"])
+    return len(rows)
+
+
+def _remove_tree(path):
+    """Delete `path` bottom-up, at most `purge_rate` entries per second."""
+    removed = 0
+    started = time.monotonic()
+
+    def paced():
+        nonlocal removed
+        removed += 1
+        if purge_rate > 0 and removed % PURGE_BATCH == 0:
+            ahead = removed / purge_rate - (time.monotonic() - started)
+            if ahead > 0:
+                time.sleep(ahead)
+
+    try:
+        if not os.path.isdir(path) or os.path.islink(path):
+            os.unlink(path)
+            return
+    except FileNotFoundError:
+        return
+
+    for dirpath, dirnames, filenames in os.walk(path, topdown=False):
+        for name in filenames:
+            try:
+                os.unlink(os.path.join(dirpath, name))
+            except FileNotFoundError:
+                pass
+            paced()
+        for name in dirnames:
+            full = os.path.join(dirpath, name)
+            try:
+                os.unlink(full) if os.path.islink(full) else os.rmdir(full)
+            except FileNotFoundError:
+                pass
+            paced()
+    os.rmdir(path)
+
+
+def _delete_rows(trash_id, kind):
+    name = f"{TRASH_DIR}/{trash_id}"
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        if kind == "file":
+            cursor.execute("DELETE FROM files WHERE name=? AND directory_id IS NULL", (name,))
+        else:
+            cursor.execute("SELECT id FROM directories WHERE name=? AND parent_id IS NULL", (name,))
+            pending = [row["id"] for row in cursor.fetchall()]
+            while pending:
+                batch, pending = pending[:PURGE_BATCH], pending[PURGE_BATCH:]
+                marks = ",".join("?" * len(batch))
+                cursor.execute(f"SELECT id FROM directories WHERE parent_id IN ({marks})", batch)
+                pending.extend(row["id"] for row in cursor.fetchall())
+                cursor.execute(f"DELETE FROM files WHERE directory_id IN ({marks})", batch)
+                cursor.execute(f"DELETE FROM directories WHERE id IN ({marks})", batch)
+        cursor.execute("DELETE FROM trash WHERE id=?", (trash_id,))
+
+
+def lower_io_priority():
+    """Put the calling thread in the idle I/O class: its disk I/O only runs when nothing else wants the disk."""
+    number = IOPRIO_SET_SYSCALLS.get(platform.machine())
+    if os.name != "posix" or number is None:
+        return
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.syscall(number, IOPRIO_WHO_PROCESS, threading.get_native_id(), IOPRIO_CLASS_IDLE << 13)
+    except (OSError, AttributeError):
+        pass
+
+
+def start_purger():
+    ftp.run_on_one_process("trash-purger", os.path.join(".cache", "trash-purge.lock"), purge_expired,
+                           purge_interval, wait_first=True)
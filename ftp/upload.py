@@ -0,0 +1,174 @@
+# ftp/upload.py
+# Command-line upload client that sends only what changed:
+#
+#   python -m ftp.upload http://host/docs/big.iso big.iso
+#
+# If the server already has a version of the file, the client fetches its
+# block signatures (GET /signature/<path>) and slides a window over the
+# local file, one byte at a time where it does not match: the window's
+# Adler-32 is updated as it moves rather than recomputed, and only windows
+# whose Adler-32 is in the signature are hashed with SHA-256. Blocks found
+# are sent as references to the server's copy, everything else as data, in
+# a PATCH (see ftp/delta.py for the formats). Otherwise the whole file goes
+# up in a plain PUT.
+#
+# Sliding one byte at a time runs in Python, at about 1MB/s, so after a
+# mismatch it only slides across two blocks (far enough to find the old
+# blocks again after a deletion, or an insertion shorter than a block) and
+# then moves a whole block at a time, at the speed of zlib, finding blocks
+# still in step with the last one found. Every ROLL_EVERY bytes it slides
+# across a block again, in case the old blocks come back at another offset
+# after a longer insertion, until ROLL_BUDGET bytes have been slid over.
+
+import argparse
+import base64
+import hashlib
+import mmap
+import os
+import sys
+import urllib.parse
+import zlib
+import requests
+import ftp.delta as delta
+
+ROLL_EVERY = 1024 * 1024        # bytes between attempts to slide into step with the old blocks
+ROLL_BUDGET = 4 * 1024 * 1024   # bytes slid over one at a time per file, at most
+
+
+def _operations(signature_data, data):
+    """
+    ("copy", offset, length) for ranges of the old file found in `data`
+    and ("data", start, end) for the parts of `data` in between, in order.
+    """
+    block_size, base_size, blocks = delta.parse_signature(signature_data)
+    table = {}
+    for index, (weak, _) in enumerate(blocks):
+        table.setdefault(weak, []).append(index)
+
+    def match(start, end, weak):
+        if weak not in table:
+            return None
+        strong = hashlib.sha256(data[start:end]).digest()[:16]
+        for index in table[weak]:
+            if blocks[index][1] == strong and min(block_size, base_size - index * block_size) == end - start:
+                return index
+        return None
+
+    n = len(data)
+    literal_start = i = 0
+    weak = None
+    slide_until = 2 * block_size              # slide byte by byte up to here,
+    next_slide = slide_until + ROLL_EVERY     # then a block at a time up to here
+    rolled = 0
+    while i + block_size <= n:
+        if weak is None:
+            weak = zlib.adler32(data[i:i + block_size])
+        index = match(i, i + block_size, weak)
+        if index is not None:
+            yield "data", literal_start, i
+            yield "copy", index * block_size, block_size
+            i += block_size
+            literal_start = i
+            weak = None
+            slide_until = i + 2 * block_size if rolled < ROLL_BUDGET else i
+            next_slide = slide_until + ROLL_EVERY
+            continue
+        if i >= slide_until:
+            i += block_size
+            weak = None
+            if i >= next_slide and rolled < ROLL_BUDGET:
+                slide_until = i + block_size
+                next_slide = slide_until + ROLL_EVERY
+            continue
+        # Roll the window on by one byte
+        if i + block_size < n:
+            a, b = weak & 0xFFFF, weak >> 16
+            out, into = data[i], data[i + block_size]
+            a = (a - out + into) % delta.ADLER_MOD
+            b = (b - block_size * out + a - 1) % delta.ADLER_MOD
+            weak = (b << 16) | a
+        i += 1
+        rolled += 1
+
+    # The old file's last block may be short, and the new one may end with it
+    tail = base_size % block_size
+    if tail and n - literal_start >= tail:
+        index = match(n - tail, n, zlib.adler32(data[n - tail:n]))
+        if index is not None:
+            yield "data", literal_start, n - tail
+            yield "copy", index * block_size, tail
+            return
+    yield "data", literal_start, n
+
+
+def make_delta(signature_data, data):
+    """
+    Yield the delta that turns the file `signature_data` describes into
+    `data` (bytes or an mmap), in pieces of at most about 1MB.
+    """
+    yield delta.DELTA_MAGIC
+    copy = None   # (offset, length), extended while reused ranges follow on
+    for kind, first, second in _operations(signature_data, data):
+        if kind == "copy":
+            if copy is not None and copy[0] + copy[1] == first:
+                copy = (copy[0], copy[1] + second)
+                continue
+            if copy is not None:
+                yield b"C" + delta.COPY.pack(*copy)
+            copy = (first, second)
+        elif first < second:
+            if copy is not None:
+                yield b"C" + delta.COPY.pack(*copy)
+                copy = None
+            for i in range(first, second, delta.WRITE_SIZE):
+                piece = data[i:min(second, i + delta.WRITE_SIZE)]
+                yield b"D" + delta.DATA.pack(len(piece)) + piece
+    if copy is not None:
+        yield b"C" + delta.COPY.pack(*copy)
+    yield b"E"
+
+
+def upload(url, path):
+    """Upload the file at `path` to `url`, sending only its changes if the server has a version."""
+    parts = urllib.parse.urlsplit(url)
+    signature_url = urllib.parse.urlunsplit((parts.scheme, parts.netloc, "/signature" + parts.path, "", ""))
+    with open(path, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+        sha256 = hashlib.sha256(data).digest()
+        digest = {"Repr-Digest": f"sha-256=:{base64.b64encode(sha256).decode('ascii')}:"}
+
+        r = requests.get(signature_url, timeout=300)
+        if r.status_code == 404:
+            f.seek(0)
+            r = requests.put(url, data=f, headers={"If-None-Match": "*"}, timeout=300)
+            r.raise_for_status()
+            return len(data), len(data)
+        r.raise_for_status()
+
+        sent = 0
+
+        def body():
+            nonlocal sent
+            for piece in make_delta(r.content, data):
+                if piece[:1] == b"D":
+                    sent += len(piece) - 1 - delta.DATA.size
+                yield piece
+
+        headers = {"Content-Type": delta.DELTA_MIME, "If-Match": r.headers["ETag"], **digest}
+        patched = requests.patch(url, data=body(), headers=headers, timeout=300)
+        patched.raise_for_status()
+        return len(data), sent
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m ftp.upload",
+                                     description="Upload a file, sending only what changed since the server's copy.")
+    parser.add_argument("url", help="the file's URL, e.g. http://host/docs/big.iso")
+    parser.add_argument("file")
+    args = parser.parse_args(argv)
+    size, sent = upload(args.url, args.file)
+    print(f"{args.file}: sent {sent} of {size} bytes", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,10 @@
+//go:build windows
+
+package main
+
+import "os"
+
+// fileInode is 0 on Windows, like the st_ino Flask sees there
+func fileInode(info os.FileInfo) uint64 {
+	return 0
+}
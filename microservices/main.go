@@ -1,6 +1,7 @@
 package main
 
 import (
+	"fmt"
 	"log"
 	"mime"
 	"net/http"
@@ -46,15 +47,39 @@ func serveFile(w http.ResponseWriter, r * http.Request) {
 		mimeType = "application/octet-stream" 
 	}
 	w.Header().Set("Content-Type", mimeType)
+	// ServeFile answers If-None-Match / If-Range / If-Match against this tag
+	w.Header().Set("ETag", fileETag(info))
 
 	http.ServeFile(w, r, fullPath)
 	log.Printf("[INFO] Served file: %s (MIME: %s)\n", fullPath, mimeType)
 
 }
 
+// Strong validator, built exactly like ftp/caching.py's file_etag:
+// "<inode>-<size>-<mtime in ns>" in hex. Inodes are left out on Windows.
+func fileETag(info os.FileInfo) string {
+	return fmt.Sprintf("\"%x-%x-%x\"", fileInode(info), info.Size(), info.ModTime().UnixNano())
+}
+
+// Health check for the Flask proxy's backend pool
+func healthz(w http.ResponseWriter, r *http.Request) {
+	if _, err := os.Stat(basePath); err != nil {
+		http.Error(w, "BASE_PATH not accessible", http.StatusServiceUnavailable)
+		return
+	}
+	w.Write([]byte("ok"))
+}
+
 func main() {
 
+	// GO_PORT lets several instances run side by side behind the proxy
+	port := os.Getenv("GO_PORT")
+	if port == "" {
+		port = "8000"
+	}
+
 	http.HandleFunc("/raw/", serveFile)
-	log.Println("Go file server running on :8000")
-	log.Fatal(http.ListenAndServe(":8000", nil))
+	http.HandleFunc("/healthz", healthz)
+	log.Printf("Go file server running on :%s\n", port)
+	log.Fatal(http.ListenAndServe(":"+port, nil))
 }
\ No newline at end of file
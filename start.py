@@ -1,9 +1,12 @@
 # start.py
 from pathlib import Path
+import logging
 import os
+import sys
 from dotenv import load_dotenv
-from waitress import serve
 from ftp import create_app
+from ftp.logs import init_logging
+from ftp.serving import run, rolling_reload
 
 ENV_PATH = Path(".env")
 
@@ -12,13 +15,19 @@ if not ENV_PATH.exists():
     run_wizard(ENV_PATH)
 
 load_dotenv(dotenv_path=ENV_PATH)
-
-app = create_app()
+init_logging()
+log = logging.getLogger("ftp.start")
 
 if __name__ == "__main__":
+    # `python start.py reload` replaces a running server with the code now on disk
+    if sys.argv[1:] == ["reload"]:
+        rolling_reload()
+        sys.exit(0)
+
     PORT = int(os.getenv("PORT", 5000))
     HOST = os.getenv("HOST", "127.0.0.1")
 
-    print("Starting FTP server via Waitress...")
-    print(f"Webserver serving at: http://{HOST}:{PORT}")
-    serve(app, host=HOST, port=PORT, threads=8)
\ No newline at end of file
+    log.info("Starting FTP server...")
+    log.info("Webserver serving at: http://%s:%s", HOST, PORT)
+    # The Go service is started once by run(), not by every worker's app
+    run(lambda: create_app(start_go=False), host=HOST, port=PORT)